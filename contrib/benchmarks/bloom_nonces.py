@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+"""Measure the backend calls BloomNonceStore saves.
+
+Uses NONCES nonces, REPLAY_PERCENT of which are replays of earlier
+ones, against an SQLiteStore in DIRECTORY (default: a temporary
+directory), directly from one thread and through a BloomNonceStore in
+front of a fresh store from THREADS threads.  Counts the backend
+transactions each makes, and prints filter sizes for a few traffic
+levels.  Nonces are only batched while other threads wait for a
+write, so the savings grow with the number of threads.
+
+Usage: python contrib/benchmarks/bloom_nonces.py [NONCES] [REPLAY_PERCENT] [THREADS] [DIRECTORY]
+"""
+
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+from openid.store import nonce, sqlstore
+from openid.store.bloomstore import BloomNonceStore, bloomSize
+
+SERVER_URL = 'http://op.example.com/openid'
+
+
+class CountingStore(sqlstore.SQLiteStore):
+    """An SQLiteStore that counts its nonce transactions."""
+    transactions = 0
+
+    def useNonce(self, *args):
+        self.transactions += 1
+        return sqlstore.SQLiteStore.useNonce(self, *args)
+
+    def useNonces(self, nonces):
+        self.transactions += 1
+        return sqlstore.SQLiteStore.useNonces(self, nonces)
+
+
+def makeTraffic(count, replay_percent):
+    now = int(time.time())
+    traffic = []
+    for i in range(count):
+        if traffic and random.random() * 100 < replay_percent:
+            traffic.append(random.choice(traffic))
+        else:
+            traffic.append((SERVER_URL, now, '%08d' % (i,)))
+    return traffic
+
+
+def run(store, traffic, threads=1):
+    accepted = []
+
+    def worker(part):
+        accepted.append(sum(1 for args in part if store.useNonce(*args)))
+
+    workers = [threading.Thread(target=worker, args=(traffic[i::threads],))
+               for i in range(threads)]
+    start = time.time()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return sum(accepted), time.time() - start
+
+
+def main():
+    count = int(sys.argv[1]) if sys.argv[1:] else 20000
+    replay_percent = float(sys.argv[2]) if sys.argv[2:] else 0.5
+    threads = int(sys.argv[3]) if sys.argv[3:] else 16
+    parent = sys.argv[4] if sys.argv[4:] else None
+    traffic = makeTraffic(count, replay_percent)
+
+    temp_dir = tempfile.mkdtemp(dir=parent)
+    try:
+        print('%-8s %10s %14s %10s' % ('store', 'accepted', 'transactions',
+                                      'seconds'))
+        direct = CountingStore(sqlite3.connect(
+            os.path.join(temp_dir, 'direct.db'), check_same_thread=False))
+        direct.createTables()
+        accepted, elapsed = run(direct, traffic)
+        print('%-8s %10d %14d %10.2f' % ('direct', accepted,
+                                         direct.transactions, elapsed))
+
+        backend = CountingStore(sqlite3.connect(
+            os.path.join(temp_dir, 'bloom.db'), check_same_thread=False))
+        backend.createTables()
+        bloom = BloomNonceStore(backend, capacity=count)
+        accepted, elapsed = run(bloom, traffic, threads)
+        print('%-8s %10d %14d %10.2f' % ('bloom', accepted,
+                                         backend.transactions, elapsed))
+    finally:
+        shutil.rmtree(temp_dir)
+
+    print()
+    print('Filter size for nonce.SKEW = %d seconds, 0.1%% false positives:'
+          % (nonce.SKEW,))
+    for per_second in [10, 100, 1000]:
+        bits, hashes = bloomSize(per_second * nonce.SKEW, 0.001)
+        print('%6d nonces/s: %8.1f MiB per filter, %d hashes' % (
+            per_second, bits / 8 / 2 ** 20, hashes))
+
+
+if __name__ == '__main__':
+    main()
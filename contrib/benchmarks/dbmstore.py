@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""Compare DBMStore with the other persistent single-host stores.
+
+Times useNonce, storeAssociation and getAssociation, and a
+cleanupNonces with every nonce expired, against a FileOpenIDStore, a
+DBMStore and an SQLiteStore in DIRECTORY (default: a temporary
+directory).  The dbm module DBMStore picked is printed with its
+results; dbm.dumb is much slower than dbm.gnu as the store grows.
+
+Usage: python contrib/benchmarks/dbmstore.py [NONCES] [ASSOCS] [DIRECTORY]
+"""
+
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+from openid.association import Association
+from openid.store import nonce, sqlstore
+from openid.store.dbmstore import DBMStore
+from openid.store.filestore import FileOpenIDStore
+
+SERVER_URL = 'http://op.example.com/openid'
+
+
+def rate(count, start):
+    return count / (time.time() - start)
+
+
+def run(store, nonces, assocs):
+    now = int(time.time())
+    start = time.time()
+    for i in range(nonces):
+        store.useNonce(SERVER_URL, now - i % 3600, '%06d' % (i,))
+    use_rate = rate(nonces, start)
+
+    start = time.time()
+    for i in range(assocs):
+        store.storeAssociation('%s/%d' % (SERVER_URL, i % 10), Association(
+            'handle-%d' % (i,), b'x' * 20, now, 3600, 'HMAC-SHA1'))
+    store_rate = rate(assocs, start)
+
+    start = time.time()
+    for i in range(assocs):
+        store.getAssociation('%s/%d' % (SERVER_URL, i % 10))
+    get_rate = rate(assocs, start)
+
+    orig_skew = nonce.SKEW
+    nonce.SKEW = 0
+    try:
+        start = time.time()
+        store.cleanupNonces()
+        cleanup = time.time() - start
+    finally:
+        nonce.SKEW = orig_skew
+    return use_rate, store_rate, get_rate, cleanup
+
+
+def main():
+    nonces = int(sys.argv[1]) if sys.argv[1:] else 2000
+    assocs = int(sys.argv[2]) if sys.argv[2:] else 500
+    parent = sys.argv[3] if sys.argv[3:] else None
+    temp_dir = tempfile.mkdtemp(dir=parent)
+    try:
+        sqlite_store = sqlstore.SQLiteStore(
+            sqlite3.connect(os.path.join(temp_dir, 'openid.sqlite')))
+        sqlite_store.createTables()
+        dbm_store = DBMStore(os.path.join(temp_dir, 'openid.db'))
+        stores = [
+            ('file', FileOpenIDStore(os.path.join(temp_dir, 'files'))),
+            (dbm_store.backend, dbm_store),
+            ('sqlite', sqlite_store),
+            ]
+        print('%-9s %12s %12s %12s %12s' % (
+            'store', 'useNonce/s', 'store/s', 'get/s', 'cleanup ms'))
+        for name, store in stores:
+            use_rate, store_rate, get_rate, cleanup = run(
+                store, nonces, assocs)
+            print('%-9s %12.0f %12.0f %12.0f %12.1f' % (
+                name, use_rate, store_rate, get_rate, cleanup * 1e3))
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+"""Measure associate throughput with the shared secret computed in a
+process pool.
+
+Answers REQUESTS DH-SHA1 associate requests from THREADS threads, as a
+threaded server would, first computing the shared secrets inline and
+then in a ProcessPoolExecutor of PROCESSES processes (default: one per
+core), and prints the requests answered per second.  The pool only
+helps on a machine with more than one core.
+
+Usage: python contrib/benchmarks/dh_executor.py [REQUESTS] [THREADS] [PROCESSES]
+"""
+
+import concurrent.futures
+import os
+import sys
+import time
+
+from openid.dh import DiffieHellman
+from openid.server import server
+from openid.store.memstore import MemoryStore
+
+OP_ENDPOINT = 'http://op.example.com/openid'
+
+
+def run(op, sessions, threads):
+    def answer(session):
+        assoc = op.signatory.createAssociation(dumb=False)
+        return server.AssociateRequest(session, 'HMAC-SHA1').answer(assoc)
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+        list(pool.map(answer, sessions))
+    return len(sessions) / (time.perf_counter() - start)
+
+
+def main():
+    count = int(sys.argv[1]) if sys.argv[1:] else 400
+    threads = int(sys.argv[2]) if sys.argv[2:] else 8
+    processes = int(sys.argv[3]) if sys.argv[3:] else os.cpu_count()
+
+    op = server.Server(MemoryStore(), OP_ENDPOINT)
+    sessions = [
+        server.DiffieHellmanSHA1ServerSession(
+            DiffieHellman.fromDefaults(), DiffieHellman.fromDefaults().public)
+        for _ in range(count)]
+
+    print('inline:           %8.1f requests/s' % (run(op, sessions, threads),))
+    with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+        server.DiffieHellmanSHA1ServerSession.executor = executor
+        try:
+            rate = run(op, sessions, threads)
+        finally:
+            server.DiffieHellmanSHA1ServerSession.executor = None
+    print('%2d processes:     %8.1f requests/s' % (processes, rate))
+
+
+if __name__ == '__main__':
+    main()
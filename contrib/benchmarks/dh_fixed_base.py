@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+"""Compare fixed-base exponentiation with pow for the default DH group.
+
+For each window size from 1 to MAX_WINDOW, builds a
+FixedBaseExponentiator for DiffieHellman.DEFAULT_MOD and DEFAULT_GEN,
+and prints the time taken to build it and to load it from a cache
+file, the size of its table, and the time it takes to make a public
+key from each of COUNT random private keys, against pow.
+
+Usage: python contrib/benchmarks/dh_fixed_base.py [COUNT] [MAX_WINDOW]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from openid import cryptutil
+from openid.dh import DiffieHellman, FixedBaseExponentiator
+
+MODULUS = DiffieHellman.DEFAULT_MOD
+GENERATOR = DiffieHellman.DEFAULT_GEN
+
+
+def timePerCall(function, exponents):
+    start = time.perf_counter()
+    for exponent in exponents:
+        function(exponent)
+    return (time.perf_counter() - start) / len(exponents)
+
+
+def main():
+    count = int(sys.argv[1]) if sys.argv[1:] else 500
+    max_window = int(sys.argv[2]) if sys.argv[2:] else 10
+    exponents = [cryptutil.randrange(1, MODULUS - 1) for _ in range(count)]
+
+    pow_time = timePerCall(lambda e: pow(GENERATOR, e, MODULUS), exponents)
+    print('pow: %.1f us per public key' % (pow_time * 1e6,))
+    print()
+    print('%6s %10s %10s %10s %12s %8s' % (
+        'window', 'build ms', 'load ms', 'table MB', 'us per key', 'speedup'))
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(temp_dir, 'table')
+        for window in range(1, max_window + 1):
+            start = time.perf_counter()
+            exponentiator = FixedBaseExponentiator(MODULUS, GENERATOR, window)
+            build_time = time.perf_counter() - start
+
+            exponentiator.save(filename)
+            size = os.path.getsize(filename)
+            start = time.perf_counter()
+            FixedBaseExponentiator.load(filename, MODULUS, GENERATOR, window)
+            load_time = time.perf_counter() - start
+
+            key_time = timePerCall(exponentiator, exponents)
+            print('%6d %10.1f %10.1f %10.2f %12.1f %7.1fx' % (
+                window, build_time * 1000, load_time * 1000, size / 2 ** 20,
+                key_time * 1e6, pow_time / key_time))
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""Measure associate request latency with and without a KeyPairPool.
+
+Sends BURSTS bursts of BURST DH-SHA1 associate requests to a Server,
+pausing IDLE seconds between bursts, as when many relying parties
+associate at once.  Prints the median and 99th percentile latency of
+the requests, and how often the pool was empty, without a pool and
+with a pool of DEPTH key pairs filled by a thread and by a process.
+
+Usage: python contrib/benchmarks/dh_pool.py [BURSTS] [BURST] [IDLE] [DEPTH]
+"""
+
+import concurrent.futures
+import sys
+import time
+
+from openid import cryptutil
+from openid.dh import DiffieHellman, KeyPairPool
+from openid.message import Message
+from openid.server import server
+from openid.store.memstore import MemoryStore
+
+OP_ENDPOINT = 'http://op.example.com/openid'
+
+
+def makeRequests(count):
+    requests = []
+    for _ in range(count):
+        consumer_dh = DiffieHellman.fromDefaults()
+        requests.append(Message.fromPostArgs({
+            'openid.ns': 'http://specs.openid.net/auth/2.0',
+            'openid.mode': 'associate',
+            'openid.assoc_type': 'HMAC-SHA1',
+            'openid.session_type': 'DH-SHA1',
+            'openid.dh_consumer_public':
+                cryptutil.longToBase64(consumer_dh.public),
+            }))
+    return requests
+
+
+def run(op, requests, bursts, burst, idle):
+    latencies = []
+    for i in range(bursts):
+        time.sleep(idle)
+        for message in requests[i * burst:(i + 1) * burst]:
+            start = time.perf_counter()
+            request = op.decoder.decode(message.toPostArgs())
+            op.handleRequest(request)
+            latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return (latencies[len(latencies) // 2],
+            latencies[int(len(latencies) * 0.99)])
+
+
+def main():
+    bursts = int(sys.argv[1]) if sys.argv[1:] else 10
+    burst = int(sys.argv[2]) if sys.argv[2:] else 50
+    idle = float(sys.argv[3]) if sys.argv[3:] else 1.0
+    depth = int(sys.argv[4]) if sys.argv[4:] else 64
+    requests = makeRequests(bursts * burst)
+    op = server.Server(MemoryStore(), OP_ENDPOINT)
+
+    print('%-8s %10s %10s %8s' % ('pool', 'p50 ms', 'p99 ms', 'misses'))
+    p50, p99 = run(op, requests, bursts, burst, idle)
+    print('%-8s %10.2f %10.2f %8s' % ('none', p50 * 1000, p99 * 1000, '-'))
+
+    with concurrent.futures.ProcessPoolExecutor(1) as executor:
+        for name, pool_executor in [('thread', None), ('process', executor)]:
+            pool = KeyPairPool(depth=depth, executor=pool_executor)
+            server.DiffieHellmanSHA1ServerSession.key_pool = pool
+            try:
+                p50, p99 = run(op, requests, bursts, burst, idle)
+            finally:
+                server.DiffieHellmanSHA1ServerSession.key_pool = None
+                pool.close()
+            print('%-8s %10.2f %10.2f %8d' % (name, p50 * 1000, p99 * 1000,
+                                              pool.getStats()['misses']))
+
+
+if __name__ == '__main__':
+    main()
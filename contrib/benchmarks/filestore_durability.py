@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+"""Measure FileOpenIDStore.storeAssociation throughput for each
+durability level.
+
+Stores ASSOCS associations, spread over a few server URLs, into a
+fresh store in DIRECTORY (default: a temporary directory) for each
+level.  Run it on the filesystem you intend to use; fsync costs vary
+by orders of magnitude between disks.
+
+Usage: python contrib/benchmarks/filestore_durability.py [ASSOCS] [DIRECTORY]
+"""
+
+import shutil
+import sys
+import tempfile
+import time
+
+from openid.association import Association
+from openid.store import filestore
+
+
+def run(durability, count, parent):
+    temp_dir = tempfile.mkdtemp(dir=parent)
+    try:
+        store = filestore.FileOpenIDStore(temp_dir, durability=durability)
+        now = int(time.time())
+        start = time.time()
+        for i in range(count):
+            server_url = 'http://op%d.example.com/openid' % (i % 4,)
+            assoc = Association('handle-%d' % i, b'x' * 20, now + i, 3600,
+                                'HMAC-SHA1')
+            store.storeAssociation(server_url, assoc)
+        elapsed = time.time() - start
+        store.close()
+        return count / elapsed
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def main():
+    count = int(sys.argv[1]) if sys.argv[1:] else 500
+    parent = sys.argv[2] if sys.argv[2:] else None
+    print('%-10s %16s' % ('level', 'associations/s'))
+    for durability in [filestore.SYNC_FULL, filestore.SYNC_DIRECTORY,
+                       filestore.SYNC_GROUP]:
+        print('%-10s %16.0f' % (durability, run(durability, count, parent)))
+
+
+if __name__ == '__main__':
+    main()
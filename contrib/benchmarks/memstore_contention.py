@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""Measure MemoryStore throughput when shared between threads.
+
+Compares a plain C{MemoryStore} guarded by a single global lock with
+C{ShardedMemoryStore} for 1 to 64 threads doing a mix of C{useNonce}
+and C{getAssociation} calls.
+
+Usage: python contrib/benchmarks/memstore_contention.py [OPS_PER_THREAD]
+"""
+
+import sys
+import threading
+import time
+
+from openid.association import Association
+from openid.cryptutil import randomString
+from openid.store.memstore import MemoryStore, ShardedMemoryStore
+
+THREAD_COUNTS = [1, 2, 4, 8, 16, 32, 64]
+SERVER_COUNT = 64
+
+
+class GlobalLockStore(object):
+    """A MemoryStore behind a single lock, as used before sharding."""
+    def __init__(self):
+        self.store = MemoryStore()
+        self.lock = threading.Lock()
+
+    def storeAssociation(self, server_url, assoc):
+        with self.lock:
+            return self.store.storeAssociation(server_url, assoc)
+
+    def getAssociation(self, server_url, handle=None):
+        with self.lock:
+            return self.store.getAssociation(server_url, handle)
+
+    def useNonce(self, server_url, timestamp, salt):
+        with self.lock:
+            return self.store.useNonce(server_url, timestamp, salt)
+
+
+def populate(store):
+    now = int(time.time())
+    servers = ['http://op%d.example.com/openid' % i
+               for i in range(SERVER_COUNT)]
+    for server_url in servers:
+        assoc = Association(randomString(8, 'abcdef'), randomString(20),
+                            now, 3600, 'HMAC-SHA1')
+        store.storeAssociation(server_url, assoc)
+    return servers
+
+
+def worker(store, servers, ident, ops):
+    now = int(time.time())
+    for i in range(ops):
+        server_url = servers[i % len(servers)]
+        store.getAssociation(server_url)
+        store.useNonce(server_url, now, '%d-%d' % (ident, i))
+
+
+def run(store_factory, thread_count, ops):
+    store = store_factory()
+    servers = populate(store)
+    threads = [threading.Thread(target=worker,
+                                args=(store, servers, n, ops))
+               for n in range(thread_count)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    return (thread_count * ops) / elapsed
+
+
+def main():
+    ops = int(sys.argv[1]) if sys.argv[1:] else 5000
+    print('%8s %18s %18s' % ('threads', 'global lock op/s', 'sharded op/s'))
+    for thread_count in THREAD_COUNTS:
+        global_rate = run(GlobalLockStore, thread_count, ops)
+        sharded_rate = run(ShardedMemoryStore, thread_count, ops)
+        print('%8d %18.0f %18.0f' % (thread_count, global_rate, sharded_rate))
+
+
+if __name__ == '__main__':
+    main()
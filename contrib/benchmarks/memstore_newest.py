@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""Measure newest-association lookup in MemoryStore.
+
+Stores ASSOCS associations for a single server URL and times
+C{getAssociation(server_url)} against a linear scan over the same
+associations, which is what the store used to do.  Also times
+C{cleanupAssociations} when a tenth of them have expired.
+
+Usage: python contrib/benchmarks/memstore_newest.py [ASSOCS] [LOOKUPS]
+"""
+
+import sys
+import time
+
+from openid.association import Association
+from openid.store.memstore import MemoryStore
+
+SERVER_URL = 'http://op.example.com/openid'
+
+
+def linearBest(server_assocs):
+    best = None
+    for assoc in server_assocs.assocs.values():
+        if best is None or best.issued < assoc.issued:
+            best = assoc
+    return best
+
+
+def main():
+    count = int(sys.argv[1]) if sys.argv[1:] else 10000
+    lookups = int(sys.argv[2]) if sys.argv[2:] else 1000
+    now = int(time.time())
+
+    store = MemoryStore()
+    for i in range(count):
+        # One in ten associations is already expired
+        lifetime = 1 if i % 10 == 0 else 3600
+        assoc = Association('handle-%d' % i, b'x' * 20, now - 60 + i % 50,
+                            lifetime, 'HMAC-SHA1')
+        store.storeAssociation(SERVER_URL, assoc)
+    server_assocs = store.server_assocs[SERVER_URL]
+
+    start = time.time()
+    for _ in range(lookups):
+        linearBest(server_assocs)
+    linear = (time.time() - start) / lookups
+
+    # The first lookup builds the index for everything stored so far
+    start = time.time()
+    store.getAssociation(SERVER_URL)
+    first = time.time() - start
+
+    start = time.time()
+    for _ in range(lookups):
+        store.getAssociation(SERVER_URL)
+    indexed = (time.time() - start) / lookups
+
+    start = time.time()
+    removed = store.cleanupAssociations()
+    cleanup = time.time() - start
+
+    print('%d associations for one server' % (count,))
+    print('linear scan:       %10.2f us/lookup' % (linear * 1e6,))
+    print('first lookup:      %10.2f ms (builds index)' % (first * 1e3,))
+    print('indexed lookup:    %10.2f us/lookup' % (indexed * 1e6,))
+    print('cleanup (%5d):    %10.2f ms' % (removed, cleanup * 1e3))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""Measure MemoryStore nonce memory use and cleanup time.
+
+Fills a store with NONCES nonces spread over twice the C{nonce.SKEW}
+window, so half of them are expired by the time C{cleanupNonces}
+runs, and compares against the flat dict of (server_url, timestamp,
+salt) tuples the store used to keep.
+
+Usage: python contrib/benchmarks/memstore_nonces.py [NONCES]
+"""
+
+import sys
+import time
+import tracemalloc
+
+from openid.store import nonce
+from openid.store.memstore import MemoryStore
+
+SERVER_URL = 'http://op.example.com/openid'
+
+
+def flatCleanup(nonces, now):
+    expired = [anonce for anonce in nonces
+               if abs(anonce[1] - now) > nonce.SKEW]
+    for anonce in expired:
+        del nonces[anonce]
+    return len(expired)
+
+
+def main():
+    count = int(sys.argv[1]) if sys.argv[1:] else 500000
+    now = int(time.time())
+    start_stamp = now - 2 * nonce.SKEW
+    step = 2.0 * nonce.SKEW / count
+    stamps = [int(start_stamp + i * step) for i in range(count)]
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    flat = {}
+    for i, stamp in enumerate(stamps):
+        flat[(str(SERVER_URL), int(str(stamp)), '%06d' % i)] = None
+    flat_bytes = tracemalloc.get_traced_memory()[0] - before
+
+    before = tracemalloc.get_traced_memory()[0]
+    store = MemoryStore()
+    # Let the store accept the old timestamps while filling it
+    orig_skew = nonce.SKEW
+    nonce.SKEW = 3 * orig_skew
+    try:
+        for i, stamp in enumerate(stamps):
+            store.useNonce(SERVER_URL, int(str(stamp)), '%06d' % i)
+    finally:
+        nonce.SKEW = orig_skew
+    bucket_bytes = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    start = time.time()
+    flat_removed = flatCleanup(flat, now)
+    flat_time = time.time() - start
+
+    start = time.time()
+    bucket_removed = store.cleanupNonces()
+    bucket_time = time.time() - start
+
+    print('%d nonces' % (count,))
+    print('%-10s %12s %14s %12s' % ('', 'bytes/nonce', 'cleanup ms', 'removed'))
+    print('%-10s %12.1f %14.2f %12d' % ('flat', flat_bytes / count,
+                                        flat_time * 1e3, flat_removed))
+    print('%-10s %12.1f %14.2f %12d' % ('bucketed', bucket_bytes / count,
+                                        bucket_time * 1e3, bucket_removed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+"""Compare useNonce and cleanupNonces across the local nonce backends.
+
+Uses NONCES fresh nonces against a FileOpenIDStore and an
+MmapNonceStore in DIRECTORY (default: a temporary directory), then
+times a cleanup with every nonce expired.
+
+Usage: python contrib/benchmarks/nonce_backends.py [NONCES] [DIRECTORY]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from openid.store import nonce
+from openid.store.filestore import FileOpenIDStore
+from openid.store.mmapstore import MmapNonceStore
+
+SERVER_URL = 'http://op.example.com/openid'
+
+
+def run(store, count):
+    now = int(time.time())
+    start = time.time()
+    for i in range(count):
+        store.useNonce(SERVER_URL, now - i % 3600, '%06d' % (i,))
+    use_rate = count / (time.time() - start)
+
+    orig_skew = nonce.SKEW
+    nonce.SKEW = 0
+    try:
+        start = time.time()
+        store.cleanupNonces()
+        cleanup = time.time() - start
+    finally:
+        nonce.SKEW = orig_skew
+    return use_rate, cleanup
+
+
+def main():
+    count = int(sys.argv[1]) if sys.argv[1:] else 20000
+    parent = sys.argv[2] if sys.argv[2:] else None
+    temp_dir = tempfile.mkdtemp(dir=parent)
+    try:
+        stores = [
+            ('file', FileOpenIDStore(os.path.join(temp_dir, 'files'))),
+            ('mmap', MmapNonceStore(os.path.join(temp_dir, 'nonces.tbl'),
+                                    slots=4 * count)),
+            ]
+        print('%-6s %14s %14s' % ('store', 'useNonce/s', 'cleanup ms'))
+        for name, store in stores:
+            use_rate, cleanup = run(store, count)
+            print('%-6s %14.0f %14.1f' % (name, use_rate, cleanup * 1e3))
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    main()
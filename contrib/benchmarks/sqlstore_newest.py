@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""Measure newest-association lookup in SQLiteStore.
+
+Stores ASSOCS associations for one server, a tenth of them expired,
+and times C{getAssociation(server_url)} against the old approach of
+fetching every row for the server and picking the newest in Python.
+
+Usage: python contrib/benchmarks/sqlstore_newest.py [ASSOCS] [LOOKUPS]
+"""
+
+import sqlite3
+import sys
+import time
+
+from openid.association import Association
+from openid.store import sqlstore
+
+SERVER_URL = 'http://op.example.com/openid'
+GET_ASSOCS_SQL = ('SELECT handle, secret, issued, lifetime, assoc_type '
+                  'FROM %(associations)s WHERE server_url = ?;')
+
+
+def fetchAllNewest(store):
+    cur = store.conn.cursor()
+    cur.execute(GET_ASSOCS_SQL % store._table_names, [SERVER_URL])
+    newest = None
+    for values in cur.fetchall():
+        values = list(values)
+        values[1] = store.blobDecode(values[1])
+        assoc = Association(*values)
+        if assoc.expiresIn and (newest is None or
+                                newest.issued < assoc.issued):
+            newest = assoc
+    cur.close()
+    return newest
+
+
+def main():
+    count = int(sys.argv[1]) if sys.argv[1:] else 5000
+    lookups = int(sys.argv[2]) if sys.argv[2:] else 200
+    now = int(time.time())
+
+    store = sqlstore.SQLiteStore(sqlite3.connect(':memory:'))
+    store.createTables()
+    for i in range(count):
+        lifetime = 1 if i % 10 == 0 else 3600
+        store.storeAssociation(SERVER_URL, Association(
+            'handle-%d' % i, b'x' * 20, now - 60 - i, lifetime, 'HMAC-SHA1'))
+
+    start = time.time()
+    for _ in range(lookups):
+        fetchAllNewest(store)
+    fetch_all = (time.time() - start) / lookups
+
+    start = time.time()
+    for _ in range(lookups):
+        store.getAssociation(SERVER_URL)
+    in_sql = (time.time() - start) / lookups
+
+    print('%d associations for one server' % (count,))
+    print('fetch all rows:   %10.3f ms/lookup' % (fetch_all * 1e3,))
+    print('ORDER BY/LIMIT 1: %10.3f ms/lookup' % (in_sql * 1e3,))
+
+
+if __name__ == '__main__':
+    main()
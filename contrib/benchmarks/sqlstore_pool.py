@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+"""Measure SQLiteStore throughput from several worker threads.
+
+Compares a store with a single connection, shared between threads
+behind a lock as was needed before pooling, with a pooled store, on an
+SQLite file in DIRECTORY (default: a temporary directory).  Each
+operation is one useNonce and one getAssociation.
+
+Usage: python contrib/benchmarks/sqlstore_pool.py [OPS_PER_THREAD] [DIRECTORY]
+"""
+
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+from openid.association import Association
+from openid.store import sqlstore
+
+THREAD_COUNTS = [1, 2, 4, 8, 16]
+SERVER_URL = 'http://op.example.com/openid'
+
+
+class LockedStore(object):
+    """A single-connection store shared between threads behind a lock."""
+    def __init__(self, store):
+        self.store = store
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        method = getattr(self.store, name)
+
+        def locked(*args):
+            with self.lock:
+                return method(*args)
+        return locked
+
+
+def worker(store, ident, ops):
+    now = int(time.time())
+    for i in range(ops):
+        store.useNonce(SERVER_URL, now, '%d-%d' % (ident, i))
+        store.getAssociation(SERVER_URL)
+
+
+def run(store, thread_count, ops):
+    threads = [threading.Thread(target=worker, args=(store, n, ops))
+               for n in range(thread_count)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return thread_count * ops / (time.time() - start)
+
+
+def makeStores(db_name):
+    def connect():
+        return sqlite3.connect(db_name, check_same_thread=False, timeout=30)
+
+    single = sqlstore.SQLiteStore(connect())
+    single.createTables()
+    single.storeAssociation(SERVER_URL, Association(
+        'handle', b'x' * 20, int(time.time()), 3600, 'HMAC-SHA1'))
+    pooled = sqlstore.SQLiteStore(connection_factory=connect, pool_size=16)
+    return LockedStore(single), pooled
+
+
+def main():
+    ops = int(sys.argv[1]) if sys.argv[1:] else 200
+    parent = sys.argv[2] if sys.argv[2:] else None
+    print('%8s %16s %16s' % ('threads', 'locked op/s', 'pooled op/s'))
+    for thread_count in THREAD_COUNTS:
+        temp_dir = tempfile.mkdtemp(dir=parent)
+        try:
+            locked, pooled = makeStores(os.path.join(temp_dir, 'openid.db'))
+            locked_rate = run(locked, thread_count, ops)
+            pooled_rate = run(pooled, thread_count, ops)
+            pooled.close()
+        finally:
+            shutil.rmtree(temp_dir)
+        print('%8d %16.0f %16.0f' % (thread_count, locked_rate, pooled_rate))
+
+
+if __name__ == '__main__':
+    main()
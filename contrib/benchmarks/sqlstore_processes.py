@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+"""Measure SQLiteStore throughput from several worker processes.
+
+Forks worker processes that share one SQLite file in DIRECTORY
+(default: a temporary directory), as the workers of a pre-forking
+server would.  Each operation is one useNonce and one
+storeAssociation.  Compares a store made with a plain connection per
+process (the default rollback journal) against
+C{SQLiteStore.concurrent}, made once before forking, and counts the
+operations that failed with "database is locked".
+
+Usage: python contrib/benchmarks/sqlstore_processes.py [OPS_PER_PROCESS] [DIRECTORY]
+"""
+
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+from openid.association import Association
+from openid.store import sqlstore
+
+PROCESS_COUNTS = [1, 2, 4, 8]
+SERVER_URL = 'http://op.example.com/openid'
+
+
+def worker(make_store, ident, ops):
+    """Run ops operations, returning the number that failed."""
+    store = make_store()
+    now = int(time.time())
+    failed = 0
+    for i in range(ops):
+        try:
+            store.useNonce(SERVER_URL, now, '%d-%d' % (ident, i))
+            store.storeAssociation(SERVER_URL, Association(
+                'handle-%d-%d' % (ident, i), b'x' * 20, now, 3600,
+                'HMAC-SHA1'))
+        except sqlite3.OperationalError:
+            failed += 1
+    return failed
+
+
+def run(make_store, process_count, ops):
+    """Fork process_count workers; return operations per second and
+    the number of failed operations."""
+    read_fd, write_fd = os.pipe()
+    start = time.time()
+    pids = []
+    for ident in range(process_count):
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            try:
+                failed = worker(make_store, ident, ops)
+                os.write(write_fd, b'%d\n' % (failed,))
+            finally:
+                os._exit(0)
+        pids.append(pid)
+
+    os.close(write_fd)
+    for pid in pids:
+        os.waitpid(pid, 0)
+    elapsed = time.time() - start
+    with os.fdopen(read_fd, 'rb') as results:
+        failed = sum(int(line) for line in results)
+    return process_count * ops / elapsed, failed
+
+
+def main():
+    ops = int(sys.argv[1]) if sys.argv[1:] else 500
+    parent = sys.argv[2] if sys.argv[2:] else None
+    print('%9s %14s %8s %14s %8s' % ('processes', 'plain op/s', 'locked',
+                                     'tuned op/s', 'locked'))
+    for process_count in PROCESS_COUNTS:
+        temp_dir = tempfile.mkdtemp(dir=parent)
+        try:
+            plain_name = os.path.join(temp_dir, 'plain.db')
+            sqlstore.SQLiteStore(sqlite3.connect(plain_name)).createTables()
+
+            def plain():
+                return sqlstore.SQLiteStore(sqlite3.connect(plain_name))
+
+            tuned_store = sqlstore.SQLiteStore.concurrent(
+                os.path.join(temp_dir, 'tuned.db'))
+            tuned_store.createTables()
+
+            plain_rate, plain_failed = run(plain, process_count, ops)
+            tuned_rate, tuned_failed = run(
+                lambda: tuned_store, process_count, ops)
+            tuned_store.close()
+        finally:
+            shutil.rmtree(temp_dir)
+        print('%9d %14.0f %8d %14.0f %8d' % (
+            process_count, plain_rate, plain_failed, tuned_rate,
+            tuned_failed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""Compare Signatory.verify with Signatory.verifyMany.
+
+Signs COUNT assertions with HANDLES dumb-mode associations kept in an
+SQLiteStore, as an audit job re-checking logged assertions would find
+them, and checks them all one at a time with Signatory.verify and in
+one batch with Signatory.verifyMany.  Prints the assertions checked
+per second and the store lookups made by each.
+
+Usage: python contrib/benchmarks/verify_many.py [COUNT] [HANDLES]
+"""
+
+import random
+import sqlite3
+import sys
+import time
+
+from openid.message import Message, OPENID2_NS
+from openid.server.server import Signatory
+from openid.store import sqlstore
+
+
+class CountingStore(sqlstore.SQLiteStore):
+    """An SQLiteStore that counts its association lookups."""
+    lookups = 0
+
+    def getAssociation(self, *args):
+        self.lookups += 1
+        return sqlstore.SQLiteStore.getAssociation(self, *args)
+
+
+def main():
+    count = int(sys.argv[1]) if sys.argv[1:] else 20000
+    handles = int(sys.argv[2]) if sys.argv[2:] else 20
+
+    store = CountingStore(sqlite3.connect(':memory:'))
+    store.createTables()
+    signatory = Signatory(store)
+    assocs = [signatory.createAssociation(dumb=True) for _ in range(handles)]
+
+    items = []
+    for i in range(count):
+        assoc = random.choice(assocs)
+        message = Message(OPENID2_NS)
+        message.updateArgs(OPENID2_NS, {
+            'mode': 'id_res',
+            'op_endpoint': 'http://op.example.com/openid',
+            'claimed_id': 'http://user%d.example.com/' % (i,),
+            'identity': 'http://user%d.example.com/' % (i,),
+            'return_to': 'http://rp.example.com/return?n=%d' % (i,),
+            'response_nonce': '2026-10-16T00:00:00Z%08d' % (i,),
+            })
+        items.append((assoc.handle, assoc.signMessage(message)))
+
+    print('%-12s %12s %10s' % ('method', 'per second', 'lookups'))
+
+    store.lookups = 0
+    start = time.perf_counter()
+    valid = [signatory.verify(handle, message) for handle, message in items]
+    elapsed = time.perf_counter() - start
+    assert all(valid)
+    print('%-12s %12.0f %10d' % ('verify', count / elapsed, store.lookups))
+
+    store.lookups = 0
+    start = time.perf_counter()
+    valid = signatory.verifyMany(items)
+    elapsed = time.perf_counter() - start
+    assert all(valid)
+    print('%-12s %12.0f %10d' % ('verifyMany', count / elapsed,
+                                 store.lookups))
+
+
+if __name__ == '__main__':
+    main()
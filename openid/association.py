@@ -30,8 +30,10 @@ __all__ = [
     'encrypted_negotiator',
     'SessionNegotiator',
     'Association',
+    'checkSignaturesGrouped',
 ]
 
+import hmac
 import time
 
 from openid import cryptutil
@@ -255,11 +257,17 @@ class Association(object):
         'assoc_type',
     ]
 
-    _macs = {
-        'HMAC-SHA1': cryptutil.hmacSha1,
-        'HMAC-SHA256': cryptutil.hmacSha256,
+    # The hashlib name of the digest each association type's HMAC uses
+    _mac_digests = {
+        'HMAC-SHA1': 'sha1',
+        'HMAC-SHA256': 'sha256',
     }
 
+    # Instance attributes that are not part of the association: the
+    # HMAC object keyed with the secret, which each signature starts
+    # from a copy of, with the secret and type it was made for.
+    _cache_attributes = ('_mac_cache',)
+
     @classmethod
     def fromExpiresIn(cls, expires_in, handle, secret, assoc_type):
         """
@@ -384,7 +392,8 @@ class Association(object):
 
         @rtype: C{bool}
         """
-        return type(self) is type(other) and self.__dict__ == other.__dict__
+        return (type(self) is type(other) and
+                self.__getstate__() == other.__getstate__())
 
     def __ne__(self, other):
         """
@@ -399,6 +408,12 @@ class Association(object):
         """
         return not (self == other)
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in self._cache_attributes:
+            state.pop(name, None)
+        return state
+
     def serialize(self):
         """
         Convert an association to KV form.
@@ -468,14 +483,30 @@ class Association(object):
         @rtype: bytes
         """
         kv = kvform.seqToKV(pairs)
+        mac = self._getMac()
+        mac.update(kv)
+        return mac.digest()
 
-        try:
-            mac = self._macs[self.assoc_type]
-        except KeyError:
-            raise ValueError(
-                'Unknown association type: %r' % (self.assoc_type,))
+    def _getMac(self):
+        """Return a new HMAC object keyed with the secret.
 
-        return mac(self.secret, kv)
+        Keying an HMAC object hashes the padded key twice, so that is
+        done once per association and each signature starts from a
+        copy.
+        """
+        cache = self.__dict__.get('_mac_cache')
+        if (cache is None or cache[0] is not self.secret or
+                cache[1] != self.assoc_type):
+            try:
+                digest = self._mac_digests[self.assoc_type]
+            except KeyError:
+                raise ValueError(
+                    'Unknown association type: %r' % (self.assoc_type,))
+
+            cache = (self.secret, self.assoc_type,
+                     hmac.new(self.secret, digestmod=digest))
+            self._mac_cache = cache
+        return cache[2].copy()
 
     def getMessageSignature(self, message):
         """Return the signature of a message.
@@ -526,12 +557,45 @@ class Association(object):
         @raises ValueError: if the message has no signature or no signature
             can be calculated for it.
         """
+        return self._checkSignature(message, self._getMac())
+
+    def checkMessageSignatures(self, messages):
+        """Check the signatures of many messages signed with this
+        association.
+
+        This gives the same answers as calling
+        C{L{checkMessageSignature}} on each message, except that a
+        message with no signature or signed list, or one that cannot be
+        signed, is reported as not matching instead of raising
+        C{ValueError}.
+
+        @param messages: The messages to check.
+        @type messages: iterable of L{openid.message.Message}
+
+        @return: Whether each message's signature matches.
+        @rtype: C{list} of C{bool}
+        """
+        prototype = self._getMac()
+        results = []
+        for message in messages:
+            try:
+                results.append(self._checkSignature(message, prototype.copy()))
+            except ValueError:
+                results.append(False)
+        return results
+
+    def _checkSignature(self, message, mac):
+        """Return whether the message's signature matches the one
+        calculated with mac, an HMAC object keyed with the secret.
+
+        @raises ValueError: if the message has no signature or no
+            signature can be calculated for it.
+        """
         message_sig = message.getArg(OPENID_NS, 'sig')
         if not message_sig:
             raise ValueError("%s has no sig." % (message,))
-        calculated_sig = self.getMessageSignature(message)
-        # remember, getMessageSignature returns bytes
-        calculated_sig = calculated_sig.decode('utf-8')
+        mac.update(kvform.seqToKV(self._makePairs(message)))
+        calculated_sig = oidutil.toBase64(mac.digest()).decode('utf-8')
         return cryptutil.const_eq(calculated_sig, message_sig)
 
     def _makePairs(self, message):
@@ -552,3 +616,57 @@ class Association(object):
             self.__class__.__name__,
             self.assoc_type,
             self.handle)
+
+
+def checkSignaturesGrouped(items, lookup, executor=None, chunk_size=1000):
+    """Check the signatures of many messages, looking up each
+    association once.
+
+    @param items: (key, message) pairs, where the key identifies the
+        association that signed the message.
+    @type items: iterable of (hashable, L{openid.message.Message})
+
+    @param lookup: Called once with each distinct key, and returns the
+        association to check those messages with, or C{None} if the
+        messages cannot be checked.
+    @type lookup: callable
+
+    @param executor: If not C{None}, a C{concurrent.futures} executor
+        to check the messages in, C{chunk_size} at a time.  With a
+        C{ProcessPoolExecutor}, the associations and messages are
+        pickled to the worker processes.
+
+    @return: Whether each message's signature matches, in the order of
+        C{items}.
+    @rtype: C{list} of C{bool}
+    """
+    groups = {}
+    count = 0
+    for index, (key, message) in enumerate(items):
+        indices, messages = groups.setdefault(key, ([], []))
+        indices.append(index)
+        messages.append(message)
+        count = index + 1
+
+    results = [False] * count
+    futures = []
+    for key, (indices, messages) in groups.items():
+        assoc = lookup(key)
+        if assoc is None:
+            continue
+
+        for start in range(0, len(messages), chunk_size):
+            chunk = messages[start:start + chunk_size]
+            chunk_indices = indices[start:start + chunk_size]
+            if executor is None:
+                valid = assoc.checkMessageSignatures(chunk)
+                for index, ok in zip(chunk_indices, valid):
+                    results[index] = ok
+            else:
+                futures.append((chunk_indices, executor.submit(
+                    assoc.checkMessageSignatures, chunk)))
+
+    for chunk_indices, future in futures:
+        for index, ok in zip(chunk_indices, future.result()):
+            results[index] = ok
+    return results
@@ -200,7 +200,7 @@ from openid.message import Message, OPENID_NS, OPENID2_NS, OPENID1_NS, \
 from openid import cryptutil
 from openid import oidutil
 from openid.association import Association, default_negotiator, \
-     SessionNegotiator
+     SessionNegotiator, checkSignaturesGrouped
 from openid.dh import DiffieHellman
 from openid.store.nonce import mkNonce, split as splitNonce
 from openid.yadis.manager import Discovery
@@ -453,14 +453,26 @@ class Consumer(object):
 
 
 class DiffieHellmanSHA1ConsumerSession(object):
+    """
+    @cvar key_pool: If not C{None}, a C{L{KeyPairPool<openid.dh.KeyPairPool>}}
+        that sessions made without a C{dh} take their key pair from.
+
+    @cvar executor: If not C{None}, a C{concurrent.futures} executor
+        to compute the shared secret in.
+    """
     session_type = 'DH-SHA1'
     hash_func = staticmethod(cryptutil.sha1)
     secret_size = 20
     allowed_assoc_types = ['HMAC-SHA1']
+    key_pool = None
+    executor = None
 
     def __init__(self, dh=None):
         if dh is None:
-            dh = DiffieHellman.fromDefaults()
+            if self.key_pool is not None:
+                dh = DiffieHellman.fromPool(self.key_pool)
+            else:
+                dh = DiffieHellman.fromDefaults()
 
         self.dh = dh
 
@@ -478,12 +490,24 @@ class DiffieHellmanSHA1ConsumerSession(object):
         return args
 
     def extractSecret(self, response):
+        dh_server_public, enc_mac_key = self._getServerValues(response)
+        return self.dh.xorSecret(dh_server_public, enc_mac_key,
+                                 self.hash_func, self.executor)
+
+    async def extractSecretAsync(self, response):
+        """As C{L{extractSecret}}, computing the shared secret without
+        blocking the event loop."""
+        dh_server_public, enc_mac_key = self._getServerValues(response)
+        return await self.dh.xorSecretAsync(dh_server_public, enc_mac_key,
+                                            self.hash_func, self.executor)
+
+    def _getServerValues(self, response):
         dh_server_public64 = response.getArg(
             OPENID_NS, 'dh_server_public', no_default)
         enc_mac_key64 = response.getArg(OPENID_NS, 'enc_mac_key', no_default)
         dh_server_public = cryptutil.base64ToLong(dh_server_public64)
         enc_mac_key = oidutil.fromBase64(enc_mac_key64)
-        return self.dh.xorSecret(dh_server_public, enc_mac_key, self.hash_func)
+        return dh_server_public, enc_mac_key
 
 
 class DiffieHellmanSHA256ConsumerSession(DiffieHellmanSHA1ConsumerSession):
@@ -504,6 +528,9 @@ class PlainTextConsumerSession(object):
         mac_key64 = response.getArg(OPENID_NS, 'mac_key', no_default)
         return oidutil.fromBase64(mac_key64)
 
+    async def extractSecretAsync(self, response):
+        return self.extractSecret(response)
+
 
 class SetupNeededError(Exception):
     """Internally-used exception that indicates that an immediate-mode
@@ -807,6 +834,43 @@ class GenericConsumer(object):
             if not self._checkAuth(message, server_url):
                 raise ProtocolError('Server denied check_authentication')
 
+    def verifySignatures(self, responses, executor=None, chunk_size=1000):
+        """Check the signatures of many positive assertions against
+        the associations in the store, such as when re-checking logged
+        assertions.
+
+        Each association is looked up once, however many assertions it
+        signed.  Unlike C{L{complete}}, this never contacts the
+        server: an assertion signed with an association that is not in
+        the store, or has expired, is reported as not verified.
+
+        @param responses: (server URL, message) pairs, where the server
+            URL is the OP endpoint the message came from.
+        @type responses: iterable of (str, L{openid.message.Message})
+
+        @param executor: If not C{None}, a C{concurrent.futures}
+            executor to check the messages in, C{chunk_size} at a
+            time, for very large batches.
+
+        @return: Whether each signature is valid, in the order of
+            C{responses}.
+        @rtype: [bool]
+        """
+        def lookup(key):
+            server_url, assoc_handle = key
+            if self.store is None or assoc_handle is None:
+                return None
+
+            assoc = self.store.getAssociation(server_url, assoc_handle)
+            if assoc is None or assoc.expiresIn <= 0:
+                return None
+            return assoc
+
+        items = (((server_url, message.getArg(OPENID_NS, 'assoc_handle')),
+                  message)
+                 for server_url, message in responses)
+        return checkSignaturesGrouped(items, lookup, executor, chunk_size)
+
     def _idResCheckForFields(self, message):
         # XXX: this should be handled by the code that processes the
         # response (that is, if a field is missing, we should not have
@@ -1,3 +1,10 @@
+import asyncio
+import collections
+import json
+import logging
+import os
+import threading
+
 from openid import cryptutil
 
 
@@ -13,35 +20,475 @@ def strxor(x, y):
     return bytes([a ^ b for a, b in zip(x, y)])
 
 
+class FixedBaseExponentiator(object):
+    """
+    Raises one fixed base to any power modulo a fixed modulus, faster
+    than C{pow}, using a table of precomputed powers of the base.
+
+    The exponent is split into C{window}-bit digits, and the table
+    holds M{base^(d * 2^(window * i))} for every digit value M{d} and
+    position M{i}, so raising the base to a power takes one
+    multiplication for each nonzero digit and no squarings.  A larger
+    window means fewer multiplications but an exponentially larger
+    table: for a 1024-bit modulus, a 6-bit window takes about 171
+    multiplications and 1.7 MB, and an 8-bit window 128 multiplications
+    and 5 MB.
+
+    The table can be saved to a file with C{L{save}} and read back
+    with C{L{load}}, which checks that the file is for the same group
+    and undamaged.  Only keep it where no one else can write to it: a
+    wrong table gives wrong public keys.
+
+    @ivar modulus: The modulus.
+    @ivar base: The base.
+    @ivar window: The number of exponent bits handled per step.
+    @ivar bits: Exponents of up to this many bits use the table;
+        larger ones are passed to C{pow}.
+    """
+
+    def __init__(self, modulus, base, window=6, bits=None, table=None):
+        if window < 1:
+            raise ValueError('Window must be at least 1 bit')
+        if bits is None:
+            bits = modulus.bit_length()
+
+        self.modulus = modulus
+        self.base = base
+        self.window = window
+        self.bits = bits
+        if table is None:
+            table = self._build()
+        self.table = table
+
+    def _build(self):
+        modulus = self.modulus
+        rows = -(-self.bits // self.window)
+        table = []
+        power = self.base % modulus
+        for _ in range(rows):
+            row = [1, power]
+            for _ in range(2, 1 << self.window):
+                row.append(row[-1] * power % modulus)
+            table.append(row)
+            power = row[-1] * power % modulus
+        return table
+
+    def __call__(self, exponent):
+        """Return base to the power of exponent, modulo the modulus.
+
+        (int) -> int
+        """
+        if exponent < 0 or exponent.bit_length() > self.bits:
+            return pow(self.base, exponent, self.modulus)
+
+        modulus = self.modulus
+        window = self.window
+        mask = (1 << window) - 1
+        result = 1
+        for row in self.table:
+            if not exponent:
+                break
+            digit = exponent & mask
+            if digit:
+                result = result * row[digit] % modulus
+            exponent >>= window
+        return result % modulus
+
+    def _header(self):
+        return {'modulus': '%x' % (self.modulus,), 'base': '%x' % (self.base,),
+                'window': self.window, 'bits': self.bits}
+
+    def save(self, filename):
+        """Write the table to filename, replacing it atomically."""
+        size = (self.modulus.bit_length() + 7) // 8
+        data = b''.join(value.to_bytes(size, 'big')
+                        for row in self.table for value in row[1:])
+        header = self._header()
+        header['sha256'] = cryptutil.sha256(data).hex()
+
+        temp_name = '%s.%d.tmp' % (filename, os.getpid())
+        fd = os.open(temp_name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(json.dumps(header).encode('ascii') + b'\n')
+            f.write(data)
+        os.replace(temp_name, filename)
+
+    def load(cls, filename, modulus, base, window=6, bits=None):
+        """Read a table written by C{L{save}}.
+
+        @raises ValueError: If the file does not hold a table for this
+            modulus, base, window and size, or has been damaged.
+        """
+        exponentiator = cls.__new__(cls)
+        exponentiator.modulus = modulus
+        exponentiator.base = base
+        exponentiator.window = window
+        exponentiator.bits = bits or modulus.bit_length()
+
+        with open(filename, 'rb') as f:
+            header = json.loads(f.readline().decode('ascii'))
+            data = f.read()
+        digest = header.pop('sha256', None)
+        if header != exponentiator._header():
+            raise ValueError('%s holds a table for another group' %
+                             (filename,))
+        if digest != cryptutil.sha256(data).hex():
+            raise ValueError('%s is damaged' % (filename,))
+
+        size = (modulus.bit_length() + 7) // 8
+        width = (1 << window) - 1
+        rows = -(-exponentiator.bits // window)
+        if len(data) != rows * width * size:
+            raise ValueError('%s is the wrong size' % (filename,))
+
+        table = []
+        offset = 0
+        for _ in range(rows):
+            row = [1]
+            for _ in range(width):
+                row.append(int.from_bytes(data[offset:offset + size], 'big'))
+                offset += size
+            table.append(row)
+        exponentiator.table = table
+        return exponentiator
+
+    load = classmethod(load)
+
+
+_fixed_base_lock = threading.Lock()
+_fixed_base = {}
+
+
+def getFixedBaseExponentiator(modulus, base, window, cache=None):
+    """Return the process's C{L{FixedBaseExponentiator}} for the
+    given modulus, base and window, making it on first use.
+
+    @param cache: A file to read the table from, or to save it to if
+        there is no good table in it yet.
+    @type cache: C{str} or C{NoneType}
+    """
+    key = (modulus, base, window)
+    exponentiator = _fixed_base.get(key)
+    if exponentiator is not None:
+        return exponentiator
+
+    with _fixed_base_lock:
+        exponentiator = _fixed_base.get(key)
+        if exponentiator is not None:
+            return exponentiator
+
+        if cache is not None:
+            try:
+                exponentiator = FixedBaseExponentiator.load(
+                    cache, modulus, base, window)
+            except FileNotFoundError:
+                pass
+            except (OSError, ValueError) as why:
+                logging.warning('Not using fixed-base exponentiation table '
+                                'from %s: %s', cache, why)
+
+        if exponentiator is None:
+            exponentiator = FixedBaseExponentiator(modulus, base, window)
+            if cache is not None:
+                try:
+                    exponentiator.save(cache)
+                except OSError as why:
+                    logging.warning('Could not save fixed-base '
+                                    'exponentiation table to %s: %s',
+                                    cache, why)
+
+        _fixed_base[key] = exponentiator
+        return exponentiator
+
+
 class DiffieHellman(object):
+    """
+    @cvar fixed_base_window: The window size of the
+        C{L{FixedBaseExponentiator}} used to make public keys in the
+        default group, or C{None} to use C{pow}.
+    @type fixed_base_window: C{int} or C{NoneType}
+
+    @cvar fixed_base_cache: A file to keep that exponentiator's table
+        in between runs, or C{None} to make it afresh in each process.
+    @type fixed_base_cache: C{str} or C{NoneType}
+    """
     DEFAULT_MOD = 155172898181473697471232257763715539915724801966915404479707795314057629378541917580651227423698188993727816152646631438561595825688188889951272158842675419950341258706556549803580104870537681476726513255747040765857479291291572334510643245094715007229621094194349783925984760375594985848253359305585439638443
 
     DEFAULT_GEN = 2
 
+    fixed_base_window = 6
+    fixed_base_cache = None
+
     def fromDefaults(cls):
         return cls(cls.DEFAULT_MOD, cls.DEFAULT_GEN)
 
     fromDefaults = classmethod(fromDefaults)
 
-    def __init__(self, modulus, generator):
+    def fromPool(cls, pool):
+        """Make a DiffieHellman with a key pair from a
+        C{L{KeyPairPool}}, in the pool's group."""
+        return cls(pool.modulus, pool.generator, pool.get())
+
+    fromPool = classmethod(fromPool)
+
+    def __init__(self, modulus, generator, key_pair=None):
+        """
+        @param key_pair: A (private, public) key pair in this group,
+            made beforehand.  If C{None}, one is made now.
+        """
         self.modulus = int(modulus)
         self.generator = int(generator)
 
-        self._setPrivate(cryptutil.randrange(1, modulus - 1))
+        if key_pair is None:
+            self._setPrivate(cryptutil.randrange(1, modulus - 1))
+        else:
+            self.private, self.public = key_pair
 
     def _setPrivate(self, private):
         """This is here to make testing easier"""
         self.private = private
-        self.public = pow(self.generator, self.private, self.modulus)
+        if self.fixed_base_window and self.usingDefaultValues():
+            exponentiator = getFixedBaseExponentiator(
+                self.modulus, self.generator, self.fixed_base_window,
+                self.fixed_base_cache)
+            self.public = exponentiator(self.private)
+        else:
+            self.public = pow(self.generator, self.private, self.modulus)
 
     def usingDefaultValues(self):
         return (self.modulus == self.DEFAULT_MOD and
                 self.generator == self.DEFAULT_GEN)
 
-    def getSharedSecret(self, composite):
-        return pow(composite, self.private, self.modulus)
+    def getSharedSecret(self, composite, executor=None):
+        """Return the secret shared with the holder of the public key
+        composite.
+
+        @param executor: If not C{None}, a C{concurrent.futures}
+            executor to do the exponentiation in.  A
+            C{ProcessPoolExecutor} lets the exponentiations of several
+            threads run on several cores at once.
+        """
+        if executor is None:
+            return pow(composite, self.private, self.modulus)
+        return executor.submit(pow, composite, self.private,
+                               self.modulus).result()
+
+    async def getSharedSecretAsync(self, composite, executor=None):
+        """As C{L{getSharedSecret}}, without blocking the event loop.
+        The exponentiation is done in executor, or the loop's default
+        executor if it is C{None}."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, pow, composite,
+                                          self.private, self.modulus)
+
+    def xorSecret(self, composite, secret, hash_func, executor=None):
+        dh_shared = self.getSharedSecret(composite, executor)
+        return self._xorShared(dh_shared, secret, hash_func)
 
-    def xorSecret(self, composite, secret, hash_func):
-        dh_shared = self.getSharedSecret(composite)
+    async def xorSecretAsync(self, composite, secret, hash_func,
+                             executor=None):
+        """As C{L{xorSecret}}, without blocking the event loop."""
+        dh_shared = await self.getSharedSecretAsync(composite, executor)
+        return self._xorShared(dh_shared, secret, hash_func)
+
+    def _xorShared(self, dh_shared, secret, hash_func):
         hashed_dh_shared = hash_func(cryptutil.longToBinary(dh_shared))
         return strxor(secret, hashed_dh_shared)
+
+
+def _generateKeyPairs(modulus, generator, count):
+    """Make count key pairs in the given group.  At module level so
+    that it can be run in another process."""
+    pairs = []
+    for _ in range(count):
+        dh = DiffieHellman(modulus, generator)
+        pairs.append((dh.private, dh.public))
+    return pairs
+
+
+# Held while a pool starts afresh after a fork.
+_fork_lock = threading.Lock()
+
+
+class KeyPairPool(object):
+    """
+    A supply of Diffie-Hellman key pairs, made ahead of time so that
+    making a key pair is not part of answering an associate request.
+
+    A background thread keeps the pool filled to C{depth} pairs,
+    starting again whenever it falls to C{low_water}.  If an
+    C{executor} is given, such as a
+    C{concurrent.futures.ProcessPoolExecutor}, the pairs are made by
+    it, so that making them does not compete with request handling for
+    the interpreter lock.  When the pool is empty, C{L{get}} makes a
+    pair itself, so it never waits for the background thread.
+
+    To use a pool for every associate request::
+
+        from openid.consumer.consumer import DiffieHellmanSHA1ConsumerSession
+        from openid.dh import KeyPairPool
+        from openid.server.server import DiffieHellmanSHA1ServerSession
+
+        pool = KeyPairPool()
+        DiffieHellmanSHA1ServerSession.key_pool = pool
+        DiffieHellmanSHA1ConsumerSession.key_pool = pool
+
+    Key pairs must not be reused, and each is handed out once.  A pool
+    used in a child process after a C{fork} drops the pairs it
+    inherited, which the parent may hand out too, and starts a new
+    background thread.  The child does not use the C{executor}, which
+    belongs to the parent, and makes its pairs in that thread.
+
+    @ivar modulus: The modulus of the group the pairs are in.
+    @ivar generator: The generator of the group the pairs are in.
+
+    @ivar hits: The number of pairs handed out from the pool.
+    @type hits: C{int}
+
+    @ivar misses: The number of pairs made by C{L{get}} because the
+        pool was empty.
+    @type misses: C{int}
+    """
+
+    def __init__(self, modulus=DiffieHellman.DEFAULT_MOD,
+                 generator=DiffieHellman.DEFAULT_GEN, depth=64,
+                 low_water=None, executor=None, batch_size=8):
+        """
+        @param depth: The number of pairs to keep ready.
+        @type depth: C{int}
+
+        @param low_water: Start filling the pool again when it holds
+            this many pairs.  Defaults to three quarters of C{depth}.
+        @type low_water: C{int} or C{NoneType}
+
+        @param executor: Where to make the pairs, or C{None} to make
+            them in the background thread.
+
+        @param batch_size: The most pairs to ask the executor for at
+            once.
+        @type batch_size: C{int}
+        """
+        if low_water is None:
+            low_water = depth * 3 // 4
+
+        self.modulus = int(modulus)
+        self.generator = int(generator)
+        self.depth = depth
+        self.low_water = low_water
+        self.executor = executor
+        self.batch_size = batch_size
+        self.hits = 0
+        self.misses = 0
+
+        self._pid = os.getpid()
+        self._pairs = collections.deque()
+        self._lock = threading.Lock()
+        self._wanted = threading.Condition(self._lock)
+        self._stopped = False
+        self._startThread()
+
+    def _startThread(self):
+        self._thread = threading.Thread(target=self._run,
+                                        name='KeyPairPool fill')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _checkFork(self):
+        """Start afresh in a child process, so that no pair is ever
+        handed out by two processes."""
+        if self._pid == os.getpid():
+            return
+
+        with _fork_lock:
+            if self._pid != os.getpid():
+                # The old lock may have been held by the parent's
+                # filler thread, which does not exist here.
+                self._lock = threading.Lock()
+                self._wanted = threading.Condition(self._lock)
+                self._pairs = collections.deque()
+                self.executor = None
+                self._pid = os.getpid()
+                if not self._stopped:
+                    self._startThread()
+
+    def matches(self, modulus, generator):
+        """Whether this pool's pairs are in the given group.
+
+        (int, int) -> bool
+        """
+        return self.modulus == modulus and self.generator == generator
+
+    def get(self):
+        """Return an unused key pair, made now if the pool is empty.
+
+        @return: A (private, public) key pair.
+        @rtype: (C{int}, C{int})
+        """
+        self._checkFork()
+        with self._lock:
+            if self._pairs:
+                pair = self._pairs.popleft()
+                self.hits += 1
+            else:
+                pair = None
+                self.misses += 1
+            if len(self._pairs) <= self.low_water:
+                self._wanted.notify()
+
+        if pair is None:
+            pair = _generateKeyPairs(self.modulus, self.generator, 1)[0]
+        return pair
+
+    def getStats(self):
+        """Return how full the pool is, and how often it was empty.
+
+        @rtype: C{dict}
+        """
+        with self._lock:
+            return {
+                'depth': len(self._pairs),
+                'target': self.depth,
+                'hits': self.hits,
+                'misses': self.misses,
+                }
+
+    def close(self):
+        """Stop the background thread, and discard the pairs."""
+        with self._lock:
+            self._stopped = True
+            self._pairs.clear()
+            self._wanted.notify()
+        self._thread.join()
+
+    def _run(self):
+        filling = True
+        while True:
+            with self._lock:
+                while not self._stopped and not (
+                        filling or len(self._pairs) <= self.low_water):
+                    self._wanted.wait()
+                if self._stopped:
+                    return
+                wanted = self.depth - len(self._pairs)
+                filling = wanted > 0
+                if not filling:
+                    continue
+
+            try:
+                if self.executor is None:
+                    pairs = _generateKeyPairs(self.modulus, self.generator, 1)
+                else:
+                    pairs = self.executor.submit(
+                        _generateKeyPairs, self.modulus, self.generator,
+                        min(wanted, self.batch_size)).result()
+            except Exception:
+                logging.exception('Error making Diffie-Hellman key pairs')
+                with self._lock:
+                    filling = False
+                    if not self._stopped:
+                        self._wanted.wait(1)
+                continue
+
+            with self._lock:
+                if not self._stopped:
+                    self._pairs.extend(pairs)
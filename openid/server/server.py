@@ -128,6 +128,7 @@ from openid.dh import DiffieHellman
 from openid.store.nonce import mkNonce
 from openid.server.trustroot import TrustRoot, verifyReturnTo
 from openid.association import Association, default_negotiator, getSecretSize
+from openid.association import checkSignaturesGrouped
 from openid.message import Message, InvalidOpenIDNamespace, \
      OPENID_NS, OPENID2_NS, IDENTIFIER_SELECT, OPENID1_URL_LIMIT
 from openid.urinorm import urinorm
@@ -288,6 +289,9 @@ class PlainTextServerSession(object):
     def answer(self, secret):
         return {'mac_key': oidutil.toBase64(secret)}
 
+    async def answerAsync(self, secret):
+        return self.answer(secret)
+
 
 class DiffieHellmanSHA1ServerSession(object):
     """An object that knows how to handle association requests with the
@@ -304,6 +308,15 @@ class DiffieHellmanSHA1ServerSession(object):
         associate request
     @type consumer_pubkey: long
 
+    @cvar key_pool: If not C{None}, a C{L{KeyPairPool<openid.dh.KeyPairPool>}}
+        to take key pairs from for requests in the pool's group.
+    @type key_pool: L{openid.dh.KeyPairPool}
+
+    @cvar executor: If not C{None}, a C{concurrent.futures} executor
+        to compute the shared secret in, such as a
+        C{ProcessPoolExecutor} so that many associate requests can be
+        answered on several cores at once.
+
     @see: U{OpenID Specs, Mode: associate
         <http://openid.net/specs.bml#mode-associate>}
     @see: AssociateRequest
@@ -311,6 +324,8 @@ class DiffieHellmanSHA1ServerSession(object):
     session_type = 'DH-SHA1'
     hash_func = staticmethod(cryptutil.sha1)
     allowed_assoc_types = ['HMAC-SHA1']
+    key_pool = None
+    executor = None
 
     def __init__(self, dh, consumer_pubkey):
         self.dh = dh
@@ -344,9 +359,15 @@ class DiffieHellmanSHA1ServerSession(object):
         if dh_modulus or dh_gen:
             dh_modulus = cryptutil.base64ToLong(dh_modulus)
             dh_gen = cryptutil.base64ToLong(dh_gen)
-            dh = DiffieHellman(dh_modulus, dh_gen)
         else:
-            dh = DiffieHellman.fromDefaults()
+            dh_modulus = DiffieHellman.DEFAULT_MOD
+            dh_gen = DiffieHellman.DEFAULT_GEN
+
+        if cls.key_pool is not None and cls.key_pool.matches(dh_modulus,
+                                                             dh_gen):
+            dh = DiffieHellman.fromPool(cls.key_pool)
+        else:
+            dh = DiffieHellman(dh_modulus, dh_gen)
 
         consumer_pubkey = message.getArg(OPENID_NS, 'dh_consumer_public')
         if consumer_pubkey is None:
@@ -362,7 +383,20 @@ class DiffieHellmanSHA1ServerSession(object):
     def answer(self, secret):
         mac_key = self.dh.xorSecret(self.consumer_pubkey,
                                     secret,
-                                    self.hash_func)
+                                    self.hash_func,
+                                    self.executor)
+        return self._answerFields(mac_key)
+
+    async def answerAsync(self, secret):
+        """As C{L{answer}}, computing the shared secret without
+        blocking the event loop."""
+        mac_key = await self.dh.xorSecretAsync(self.consumer_pubkey,
+                                               secret,
+                                               self.hash_func,
+                                               self.executor)
+        return self._answerFields(mac_key)
+
+    def _answerFields(self, mac_key):
         return {
             'dh_server_public': cryptutil.longToBase64(self.dh.public),
             'enc_mac_key': oidutil.toBase64(mac_key),
@@ -467,14 +501,25 @@ class AssociateRequest(OpenIDRequest):
             to the consumer's X{public key} if appropriate.
         @returntype: L{OpenIDResponse}
         """
+        return self._makeResponse(assoc, self.session.answer(assoc.secret))
+
+    async def answerAsync(self, assoc):
+        """As C{L{answer}}, without blocking the event loop while the
+        secret is encrypted.
+
+        @returntype: L{OpenIDResponse}
+        """
+        session_fields = await self.session.answerAsync(assoc.secret)
+        return self._makeResponse(assoc, session_fields)
+
+    def _makeResponse(self, assoc, session_fields):
         response = OpenIDResponse(self)
         response.fields.updateArgs(OPENID_NS, {
             'expires_in': str(assoc.expiresIn),
             'assoc_type': self.assoc_type,
             'assoc_handle': assoc.handle,
             })
-        response.fields.updateArgs(OPENID_NS,
-                                   self.session.answer(assoc.secret))
+        response.fields.updateArgs(OPENID_NS, session_fields)
 
         if not (self.session.session_type == 'no-encryption' and
                 self.message.isOpenID1()):
@@ -1175,6 +1220,37 @@ class Signatory(object):
             return False
         return valid
 
+    def verifyMany(self, items, executor=None, chunk_size=1000):
+        """Verify the signatures of many messages, such as when
+        re-checking logged assertions.
+
+        Each association is looked up once, however many messages it
+        signed, and its messages are checked together.
+
+        @param items: (assoc_handle, message) pairs, as passed to
+            C{L{verify}}.
+        @type items: iterable of (str, L{openid.message.Message})
+
+        @param executor: If not C{None}, a C{concurrent.futures}
+            executor to check the messages in, C{chunk_size} at a
+            time, for very large batches.
+
+        @returns: Whether each signature is valid, in the order of
+            C{items}.
+        @returntype: [bool]
+        """
+        def lookup(assoc_handle):
+            if assoc_handle is None:
+                return None
+
+            assoc = self.getAssociation(assoc_handle, dumb=True)
+            if not assoc:
+                logging.error("failed to get assoc with handle %r to verify "
+                              "messages" % (assoc_handle,))
+            return assoc
+
+        return checkSignaturesGrouped(items, lookup, executor, chunk_size)
+
     def sign(self, response):
         """Sign a response.
 
@@ -2,7 +2,10 @@
 This package contains the modules related to this library's use of
 persistent storage.
 
-@sort: interface, filestore, sqlstore, memstore
+@sort: interface, filestore, sqlstore, memstore, mmapstore, dbmstore,
+    cachingstore, bloomstore, instrumentedstore, asyncstore, migrate
 """
 
-__all__ = ['interface', 'filestore', 'sqlstore', 'memstore', 'nonce']
+__all__ = ['interface', 'filestore', 'sqlstore', 'memstore', 'mmapstore',
+           'dbmstore', 'cachingstore', 'bloomstore', 'instrumentedstore',
+           'asyncstore', 'migrate', 'nonce']
@@ -0,0 +1,244 @@
+"""
+This module contains C{L{AsyncOpenIDStore}}, the asyncio counterpart
+of the C{L{OpenIDStore<openid.store.interface.OpenIDStore>}}
+interface, and implementations of it for the bundled stores.
+
+The in-memory stores never wait on I/O, so C{L{AsyncMemoryStore}}
+calls them directly.  Stores that do wait (files, databases, or any
+store you have written) are run in a small thread pool by
+C{L{ThreadedAsyncStore}}, so that the event loop is not blocked and no
+thread is needed per request.  C{L{asyncStore}} picks the right one::
+
+    from openid.store.asyncstore import asyncStore
+    from openid.store.filestore import FileOpenIDStore
+
+    store = asyncStore(FileOpenIDStore('/var/lib/openid'))
+    ...
+    if await store.useNonce(server_url, timestamp, salt):
+        ...
+"""
+
+import asyncio
+import concurrent.futures
+import functools
+
+from openid.store.filestore import FileOpenIDStore
+from openid.store.memstore import MemoryStore, ShardedMemoryStore
+
+try:
+    from openid.store.sqlstore import SQLStore
+except ImportError:
+    # sqlstore needs a PostgreSQL driver to import.
+    SQLStore = None
+
+
+class AsyncOpenIDStore(object):
+    """
+    The interface for stores used from asyncio code.  Each method is a
+    coroutine that behaves as the method of the same name in
+    C{L{OpenIDStore<openid.store.interface.OpenIDStore>}}; see there
+    for their arguments and results.
+
+    @sort: storeAssociation, getAssociation, removeAssociation,
+        useNonce
+    """
+
+    async def storeAssociation(self, server_url, association):
+        """Put an association into storage.
+
+        @rtype: C{NoneType}
+        """
+        raise NotImplementedError
+
+    async def getAssociation(self, server_url, handle=None):
+        """Return the association for the server URL and, if given,
+        handle, or C{None} if there is no such unexpired association.
+
+        @rtype: C{L{Association<openid.association.Association>}} or
+            C{NoneType}
+        """
+        raise NotImplementedError
+
+    async def removeAssociation(self, server_url, handle):
+        """Remove an association, returning whether it was there.
+
+        @rtype: C{bool}
+        """
+        raise NotImplementedError
+
+    async def useNonce(self, server_url, timestamp, salt):
+        """Return whether the nonce is valid and has not been used
+        before, and mark it used.
+
+        @rtype: C{bool}
+        """
+        raise NotImplementedError
+
+    async def cleanupNonces(self):
+        """Remove expired nonces from the store.
+
+        @return: the number of nonces expired.
+        @rtype: C{int}
+        """
+        raise NotImplementedError
+
+    async def cleanupAssociations(self):
+        """Remove expired associations from the store.
+
+        @return: the number of associations expired.
+        @rtype: C{int}
+        """
+        raise NotImplementedError
+
+    async def cleanup(self):
+        """Shortcut for C{L{cleanupNonces}()}, C{L{cleanupAssociations}()}.
+        """
+        return await self.cleanupNonces(), await self.cleanupAssociations()
+
+
+class AsyncMemoryStore(AsyncOpenIDStore):
+    """
+    An C{L{AsyncOpenIDStore}} that keeps everything in memory, in a
+    C{L{MemoryStore<openid.store.memstore.MemoryStore>}} or
+    C{L{ShardedMemoryStore<openid.store.memstore.ShardedMemoryStore>}}.
+    Their methods never wait on I/O, so they are called directly from
+    the event loop.
+
+    @ivar store: The memory store holding the data.
+    """
+
+    def __init__(self, store=None):
+        """
+        @param store: The memory store to use.  If none is given, a
+            new, unbounded C{L{MemoryStore}} is made.
+        @type store: C{L{MemoryStore}} or C{L{ShardedMemoryStore}}
+        """
+        if store is None:
+            store = MemoryStore()
+        self.store = store
+
+    async def storeAssociation(self, server_url, association):
+        return self.store.storeAssociation(server_url, association)
+
+    async def getAssociation(self, server_url, handle=None):
+        return self.store.getAssociation(server_url, handle)
+
+    async def removeAssociation(self, server_url, handle):
+        return self.store.removeAssociation(server_url, handle)
+
+    async def useNonce(self, server_url, timestamp, salt):
+        return self.store.useNonce(server_url, timestamp, salt)
+
+    async def cleanupNonces(self):
+        return self.store.cleanupNonces()
+
+    async def cleanupAssociations(self):
+        return self.store.cleanupAssociations()
+
+
+class ThreadedAsyncStore(AsyncOpenIDStore):
+    """
+    An C{L{AsyncOpenIDStore}} that runs the methods of an ordinary
+    C{L{OpenIDStore<openid.store.interface.OpenIDStore>}} in a thread
+    pool, so that they do not block the event loop.
+
+    The store is called from up to C{max_workers} threads at once, so
+    only give more than one worker to a store that is safe to share
+    between threads.
+
+    @ivar store: The store being wrapped.
+
+    @ivar executor: The executor the store's methods run in.
+    @type executor: C{concurrent.futures.Executor}
+    """
+
+    def __init__(self, store, executor=None, max_workers=1):
+        """
+        @param store: The store to wrap.
+        @type store: C{L{OpenIDStore<openid.store.interface.OpenIDStore>}}
+
+        @param executor: The executor to run the store's methods in.
+            If none is given, a thread pool of C{max_workers} threads
+            is made, and shut down by C{L{close}}.
+        @type executor: C{concurrent.futures.Executor} or C{NoneType}
+
+        @param max_workers: The size of the thread pool to make.
+        @type max_workers: C{int}
+        """
+        self.store = store
+        self._own_executor = executor is None
+        if executor is None:
+            executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=max_workers, thread_name_prefix='openid-store')
+        self.executor = executor
+
+    def close(self):
+        """Shut down the thread pool, if this object made it, waiting
+        for calls in progress to finish."""
+        if self._own_executor:
+            self.executor.shutdown(wait=True)
+
+    def _call(self, method, *args):
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(
+            self.executor, functools.partial(method, *args))
+
+    async def storeAssociation(self, server_url, association):
+        return await self._call(
+            self.store.storeAssociation, server_url, association)
+
+    async def getAssociation(self, server_url, handle=None):
+        return await self._call(self.store.getAssociation, server_url, handle)
+
+    async def removeAssociation(self, server_url, handle):
+        return await self._call(
+            self.store.removeAssociation, server_url, handle)
+
+    async def useNonce(self, server_url, timestamp, salt):
+        return await self._call(
+            self.store.useNonce, server_url, timestamp, salt)
+
+    async def cleanupNonces(self):
+        return await self._call(self.store.cleanupNonces)
+
+    async def cleanupAssociations(self):
+        return await self._call(self.store.cleanupAssociations)
+
+
+def asyncStore(store, executor=None):
+    """Return an C{L{AsyncOpenIDStore}} for a store.
+
+      - An C{L{AsyncOpenIDStore}} is returned as it is.
+
+      - Memory stores are called directly, with C{L{AsyncMemoryStore}}.
+
+      - Other stores are run in a thread pool with
+        C{L{ThreadedAsyncStore}}: a C{L{FileOpenIDStore}} with four
+        threads, a pooled C{L{SQLStore}} with as many threads as its
+        pool has connections, and any other store, including an
+        C{L{SQLStore}} with a single connection, with one thread.
+
+    @param store: The store to adapt.
+    @type store: C{L{OpenIDStore<openid.store.interface.OpenIDStore>}}
+        or C{L{AsyncOpenIDStore}}
+
+    @param executor: The executor to give a C{L{ThreadedAsyncStore}},
+        instead of making one for it.  It must not run more of the
+        store's calls at once than the store can handle.
+    @type executor: C{concurrent.futures.Executor} or C{NoneType}
+
+    @rtype: C{L{AsyncOpenIDStore}}
+    """
+    if isinstance(store, AsyncOpenIDStore):
+        return store
+    elif isinstance(store, (MemoryStore, ShardedMemoryStore)):
+        return AsyncMemoryStore(store)
+
+    if isinstance(store, FileOpenIDStore):
+        max_workers = 4
+    elif (SQLStore is not None and isinstance(store, SQLStore) and
+          store._pool is not None):
+        max_workers = store._pool.size
+    else:
+        max_workers = 1
+    return ThreadedAsyncStore(store, executor, max_workers)
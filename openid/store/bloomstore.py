@@ -0,0 +1,275 @@
+"""
+This module contains C{L{BloomNonceStore}}, which keeps a record of
+recent nonces in Bloom filters in front of another store, so that
+fresh nonces can be written to that store in batches, and helpers for
+sizing the filters.
+
+A Bloom filter of M{m} bits with M{k} hash functions, holding M{n}
+items, wrongly reports an item it does not hold with probability
+about M{(1 - e^(-kn/m))^k}.  For a wanted error rate M{p}, the
+smallest filter has M{m = -n ln p / (ln 2)^2} bits and
+M{k = (m/n) ln 2} hash functions, which is about 1.2 bytes per item
+at M{p = 0.001}.
+"""
+
+import math
+import threading
+import time
+
+from openid import cryptutil
+from openid.store.interface import OpenIDStore
+from openid.store import nonce
+
+
+def bloomSize(capacity, error_rate):
+    """Return the number of bits and hash functions for a Bloom
+    filter holding capacity items with the given false positive rate.
+
+    (int, float) -> (int, int)
+    """
+    if capacity <= 0 or not 0 < error_rate < 1:
+        raise ValueError('Capacity must be positive and error rate '
+                         'between 0 and 1')
+    bits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+    hashes = max(1, int(round(bits / capacity * math.log(2))))
+    return bits, hashes
+
+
+def bloomErrorRate(bits, hashes, count):
+    """Return the false positive rate of a Bloom filter of that many
+    bits and hash functions, holding count items.
+
+    (int, int, int) -> float
+    """
+    return (1 - math.exp(-hashes * count / bits)) ** hashes
+
+
+class _BloomFilter(object):
+    """A Bloom filter over 128-bit digests, using double hashing."""
+
+    def __init__(self, bits, hashes):
+        self.bits = bits
+        self.hashes = hashes
+        self.count = 0
+        self._array = bytearray((bits + 7) // 8)
+
+    def _positions(self, digest):
+        h1 = int.from_bytes(digest[:8], 'big')
+        h2 = int.from_bytes(digest[8:16], 'big') | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def add(self, digest):
+        array = self._array
+        for position in self._positions(digest):
+            array[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, digest):
+        array = self._array
+        for position in self._positions(digest):
+            if not array[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+class _Batch(object):
+    """Nonces to be written to the backend together."""
+
+    def __init__(self):
+        self.nonces = []
+        self.results = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class BloomNonceStore(OpenIDStore):
+    """
+    An C{L{OpenIDStore}} that keeps Bloom filters of the nonces it has
+    seen in front of the C{backend} store, and writes nonces it has
+    not seen to the backend in batches.
+
+    The filters are indexed by nonce timestamp, one for each
+    C{nonce.SKEW} seconds, and a filter is dropped once all of its
+    nonces are too old to be used.  Only two or three filters are
+    live at once.
+
+    If the backend has a C{useNonces} method (as
+    C{L{SQLStore<openid.store.sqlstore.SQLStore>}} does), nonces that
+    are not in their filter are written to it together: the first
+    thread with such a nonce writes its batch once the batch before
+    it is written, and nonces arriving in the meantime join it.  The
+    nonces the filter may hold, which are likely replays, every nonce
+    while C{nonce.SKEW} differs from what it was when the store was
+    made, and every nonce when the backend has no C{useNonces}, go
+    through the backend's C{useNonce} on their own, at the same time
+    as other threads' nonces, so the backend must be safe to share
+    between threads if this store is; only the batches are written
+    one at a time.
+
+    Either way, C{L{useNonce}} only returns once the nonce is in the
+    backend, and returns the backend's answer, so replays are caught
+    as well as by the backend alone, across crashes and processes.
+    The filters only decide which nonces are batched, and batching
+    only helps when many threads use nonces at once with a backend
+    that can take them together.
+
+    Association methods are passed through to the backend.
+
+    @ivar backend: The store that holds the nonces.
+    @type backend: L{OpenIDStore}
+
+    @ivar batched: The number of nonces written in batches.
+    @type batched: C{int}
+
+    @ivar batches: The number of batches written.
+    @type batches: C{int}
+
+    @ivar backend_checks: The number of nonces checked with the
+        backend's C{useNonce} on their own.
+    @type backend_checks: C{int}
+    """
+
+    def __init__(self, backend, capacity=100000, error_rate=0.001,
+                 batch_size=100):
+        """
+        @param backend: The store to use for nonces and associations.
+        @type backend: L{OpenIDStore}
+
+        @param capacity: The number of nonces expected in
+            C{nonce.SKEW} seconds, which each filter is sized for.
+        @type capacity: C{int}
+
+        @param error_rate: The false positive rate each filter is
+            sized for.
+        @type error_rate: C{float}
+
+        @param batch_size: The most nonces to write in one batch.
+        @type batch_size: C{int}
+        """
+        self.backend = backend
+        self.bits, self.hashes = bloomSize(capacity, error_rate)
+        self.batch_size = batch_size
+        self.batched = 0
+        self.batches = 0
+        self.backend_checks = 0
+
+        self._skew = nonce.SKEW
+        # filter index -> _BloomFilter; filter i holds the nonces with
+        # timestamps in [i * SKEW, (i + 1) * SKEW).
+        self._filters = {}
+        self._lock = threading.Lock()
+        # The batch that nonces are joining, and a lock held while
+        # writing to the backend.
+        self._batch = None
+        self._backend_lock = threading.Lock()
+
+    def getStats(self):
+        """Return the filters' sizes and how full they are.
+
+        @rtype: C{dict}
+        """
+        with self._lock:
+            counts = [f.count for f in self._filters.values()]
+        return {
+            'filters': len(counts),
+            'bytes': len(counts) * ((self.bits + 7) // 8),
+            'nonces': sum(counts),
+            'error_rate': max([bloomErrorRate(self.bits, self.hashes, c)
+                               for c in counts] or [0.0]),
+            'batched': self.batched,
+            'batches': self.batches,
+            'backend_checks': self.backend_checks,
+            }
+
+    def _digest(self, server_url, timestamp, salt):
+        return cryptutil.sha1('%d:%d:%s%s' % (
+            timestamp, len(server_url), server_url, salt))
+
+    def useNonce(self, server_url, timestamp, salt):
+        now = time.time()
+        if abs(timestamp - now) > nonce.SKEW:
+            return False
+
+        digest = self._digest(server_url, timestamp, salt)
+        new = False
+        if nonce.SKEW == self._skew:
+            index = int(timestamp) // self._skew
+            with self._lock:
+                # Drop the filters whose nonces have all expired.
+                oldest = int(now - self._skew) // self._skew
+                for old in [i for i in self._filters if i < oldest]:
+                    del self._filters[old]
+
+                bloom = self._filters.get(index)
+                if bloom is None:
+                    bloom = _BloomFilter(self.bits, self.hashes)
+                    self._filters[index] = bloom
+
+                new = digest not in bloom
+                if new:
+                    bloom.add(digest)
+
+        if new and getattr(self.backend, 'useNonces', None) is not None:
+            return self._useBatched((server_url, timestamp, salt))
+
+        with self._lock:
+            self.backend_checks += 1
+        used = self.backend.useNonce(server_url, timestamp, salt)
+
+        if used and nonce.SKEW == self._skew:
+            with self._lock:
+                bloom = self._filters.get(int(timestamp) // self._skew)
+                if bloom is not None:
+                    bloom.add(digest)
+        return used
+
+    def _useBatched(self, args):
+        """Add a nonce to the current batch, and return the backend's
+        answer for it once the batch is written."""
+        with self._lock:
+            batch = self._batch
+            if batch is None or len(batch.nonces) >= self.batch_size:
+                batch = _Batch()
+                self._batch = batch
+            index = len(batch.nonces)
+            batch.nonces.append(args)
+
+        if index == 0:
+            # This thread writes the batch, once the one before it is
+            # written.  Nonces join it until then.
+            with self._backend_lock:
+                with self._lock:
+                    if self._batch is batch:
+                        self._batch = None
+                self._writeBatch(batch)
+        else:
+            batch.done.wait()
+
+        if batch.error is not None:
+            raise batch.error
+        return batch.results[index]
+
+    def _writeBatch(self, batch):
+        try:
+            batch.results = self.backend.useNonces(batch.nonces)
+            self.batched += len(batch.nonces)
+            self.batches += 1
+        except Exception as why:
+            batch.error = why
+        finally:
+            batch.done.set()
+
+    def cleanupNonces(self):
+        return self.backend.cleanupNonces()
+
+    def storeAssociation(self, server_url, association):
+        return self.backend.storeAssociation(server_url, association)
+
+    def getAssociation(self, server_url, handle=None):
+        return self.backend.getAssociation(server_url, handle)
+
+    def removeAssociation(self, server_url, handle):
+        return self.backend.removeAssociation(server_url, handle)
+
+    def cleanupAssociations(self):
+        return self.backend.cleanupAssociations()
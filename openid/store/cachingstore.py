@@ -0,0 +1,174 @@
+"""
+This module contains an C{L{OpenIDStore}} that keeps a small cache of
+associations in memory in front of another store, so that looking up
+an association does not always go to disk or to the database.
+
+Example of using it in front of an SQL store::
+
+    from openid.store.cachingstore import CachingStore
+
+    store = CachingStore(sqlstore.PostgreSQLStore(conn))
+"""
+
+import collections
+import copy
+import threading
+import time
+
+from openid.store.interface import OpenIDStore
+
+
+class CachingStore(OpenIDStore):
+    """
+    An C{L{OpenIDStore}} that caches the associations it stores and
+    looks up from its C{backend}, which holds the data.
+
+    Associations do not change once stored, so a cached association
+    can be used until it expires.  Entries are kept for at most C{ttl}
+    seconds, and never past the association's expiry, so that a store
+    shared with other processes is checked every so often for
+    associations they have removed.  Up to C{max_entries} entries are
+    kept; the least recently used ones are dropped first.
+
+    The newest association for each server is cached as well, so it
+    too may be up to C{ttl} seconds out of date when another process
+    stores a newer one.  Any unexpired association is a correct answer
+    for that lookup.
+
+    C{L{removeAssociation}} drops the association from this cache,
+    and a lookup that read it from the backend before it was removed
+    does not cache it again.  It then calls C{on_remove}, if given,
+    with the server URL and handle.  The caches of other processes
+    keep serving the association for up to C{ttl} seconds; use
+    C{on_remove} to tell their C{CachingStore}s to C{L{invalidate}}
+    their entries if they cannot wait that long.
+
+    Nonces are not cached; they always go to the backend.
+
+    @ivar backend: The store holding the data.
+    @type backend: L{OpenIDStore}
+
+    @ivar hits: The number of lookups answered from the cache.
+    @type hits: C{int}
+
+    @ivar misses: The number of lookups passed to the backend.
+    @type misses: C{int}
+    """
+
+    def __init__(self, backend, max_entries=1000, ttl=300, on_remove=None):
+        """
+        @param backend: The store to cache.
+        @type backend: L{OpenIDStore}
+
+        @param max_entries: The most entries to cache.
+        @type max_entries: C{int}
+
+        @param ttl: The most seconds to keep an entry for.
+        @type ttl: C{float}
+
+        @param on_remove: Called with the server URL and handle after
+            an association is removed.
+        @type on_remove: callable or C{NoneType}
+        """
+        self.backend = backend
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.on_remove = on_remove
+        self.hits = 0
+        self.misses = 0
+
+        # (server_url, handle or None) -> (expiry time, association),
+        # least recently used first
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+        # Counts calls to removeAssociation, so that lookups running
+        # at the same time do not cache what they removed.
+        self._removals = 0
+
+    def _put(self, key, assoc, removals=None):
+        """Cache an association, unless removals is given and an
+        association has been removed since it was read."""
+        expires = time.time() + min(self.ttl, assoc.expiresIn)
+        with self._lock:
+            if removals is not None and removals != self._removals:
+                return
+            self._cache[key] = (expires, assoc)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+
+    def _get(self, key):
+        with self._lock:
+            try:
+                expires, assoc = self._cache[key]
+            except KeyError:
+                self.misses += 1
+                return None
+
+            if expires <= time.time():
+                del self._cache[key]
+                self.misses += 1
+                return None
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return assoc
+
+    def invalidate(self, server_url, handle):
+        """Drop an association from this cache, without removing it
+        from the backend.  For use when another process has removed
+        it.
+        """
+        with self._lock:
+            self._cache.pop((server_url, handle), None)
+            entry = self._cache.get((server_url, None))
+            if entry is not None and entry[1].handle == handle:
+                del self._cache[(server_url, None)]
+
+    def storeAssociation(self, server_url, association):
+        self.backend.storeAssociation(server_url, association)
+        # Cache a copy, so that the caller's changes to their object
+        # do not show up in what we hand out.
+        self._put((server_url, association.handle), copy.copy(association))
+        with self._lock:
+            # The new association may now be the newest.
+            self._cache.pop((server_url, None), None)
+
+    def getAssociation(self, server_url, handle=None):
+        key = (server_url, handle)
+        assoc = self._get(key)
+        if assoc is not None:
+            return assoc
+
+        removals = self._removals
+        assoc = self.backend.getAssociation(server_url, handle)
+        if assoc is not None and assoc.expiresIn > 0:
+            self._put(key, assoc, removals)
+            if handle is None:
+                self._put((server_url, assoc.handle), assoc, removals)
+        return assoc
+
+    def removeAssociation(self, server_url, handle):
+        self.invalidate(server_url, handle)
+        removed = self.backend.removeAssociation(server_url, handle)
+        with self._lock:
+            self._removals += 1
+        # A lookup may have cached it again before the backend removed
+        # it.
+        self.invalidate(server_url, handle)
+        if self.on_remove is not None:
+            self.on_remove(server_url, handle)
+        return removed
+
+    def useNonce(self, server_url, timestamp, salt):
+        return self.backend.useNonce(server_url, timestamp, salt)
+
+    def cleanupNonces(self):
+        return self.backend.cleanupNonces()
+
+    def cleanupAssociations(self):
+        now = time.time()
+        with self._lock:
+            for key, (expires, assoc) in list(self._cache.items()):
+                if expires <= now:
+                    del self._cache[key]
+        return self.backend.cleanupAssociations()
@@ -0,0 +1,372 @@
+"""
+This module contains an C{L{OpenIDStore}} implementation that keeps
+associations and nonces in a single C{dbm} database, for a persistent
+store on one host without an SQL server.
+
+The database is made with whichever of C{dbm.gnu}, C{dbm.ndbm} and
+C{dbm.dumb} is available, in that order.  C{dbm.dumb} works, but
+reads its whole key index each time it is opened and rewrites it each
+time it is changed, so it only suits small stores; install Python
+with gdbm support for anything larger.
+
+This module needs C{fcntl}, so it is only available on POSIX systems.
+
+Example of using it::
+
+    from openid.store.dbmstore import DBMStore
+
+    store = DBMStore('/var/lib/openid/openid.db')
+"""
+
+import dbm
+import fcntl
+import os
+import struct
+import threading
+import time
+
+from openid import cryptutil
+from openid.association import Association
+from openid.store.interface import OpenIDStore
+from openid.store import nonce
+
+# Count of changes made to the database, kept at the start of the
+# lock file so that processes know when to reopen it.
+_generation = struct.Struct('>Q')
+
+
+def _counted(s):
+    """Encode a string so that it can be followed by another one
+    without ambiguity."""
+    s = s.encode('utf-8')
+    return b'%d:%s' % (len(s), s)
+
+
+class DBMStore(OpenIDStore):
+    """
+    An C{L{OpenIDStore}} that keeps everything in one C{dbm} database.
+
+    The database holds these keys:
+
+      - C{a}I{server_url}I{handle}: an association, serialized,
+
+      - C{h}I{server_url}: the handles of the server's associations,
+        one per line,
+
+      - C{l}I{server_url}: the handle of the server's most recently
+        issued association, so that it can be found without reading
+        the others, and
+
+      - C{n}I{timestamp}I{digest}: a used nonce, with its timestamp
+        in hex at the start of the key so that C{L{cleanupNonces}} can
+        sweep the keys without reading any values.
+
+    Server URLs are prefixed with their length.
+
+    Each operation takes an C{fcntl} lock on I{filename}C{.lock},
+    shared for reads and exclusive for writes, so any number of
+    processes may use the store at once, as may the threads of one
+    process.  The lock file also counts the changes made to the
+    database; a process keeps the database open between operations,
+    and reopens it when another process has changed it.
+
+    @ivar filename: The database file.
+    @type filename: C{str}
+
+    @ivar backend: The C{dbm} module the database is in, such as
+        C{'dbm.gnu'}.
+    @type backend: C{str}
+    """
+
+    def __init__(self, filename, mode=0o600):
+        """
+        Open the database in filename, creating it if it does not
+        exist yet.
+
+        @param filename: The database file to use.  Some C{dbm}
+            modules add an extension to it.
+        @type filename: C{str}
+
+        @param mode: The permissions to create files with.
+        @type mode: C{int}
+        """
+        self.filename = filename
+        self.mode = mode
+        self._thread_lock = threading.Lock()
+        self._db = None
+        self._writable = False
+        self._db_generation = None
+        self._pid = None
+
+        self._lock_fd = os.open(filename + '.lock', os.O_RDWR | os.O_CREAT,
+                                mode)
+        self._lock(True)
+        try:
+            dbm.open(filename, 'c', mode).close()
+            self.backend = dbm.whichdb(filename)
+        finally:
+            self._unlock()
+
+    def close(self):
+        """Close the database and the lock file."""
+        with self._thread_lock:
+            self._discard()
+            if self._lock_fd is not None:
+                os.close(self._lock_fd)
+                self._lock_fd = None
+
+    def _lock(self, exclusive):
+        self._thread_lock.acquire()
+        try:
+            fcntl.lockf(self._lock_fd,
+                        fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        except:
+            self._thread_lock.release()
+            raise
+
+    def _unlock(self):
+        try:
+            fcntl.lockf(self._lock_fd, fcntl.LOCK_UN)
+        finally:
+            self._thread_lock.release()
+
+    def _readGeneration(self):
+        data = os.pread(self._lock_fd, _generation.size, 0)
+        if len(data) < _generation.size:
+            return 0
+        (generation,) = _generation.unpack(data)
+        return generation
+
+    def _discard(self):
+        if self._db is not None:
+            if self._pid == os.getpid():
+                self._db.close()
+            # else it was opened before a fork; leave it to the parent.
+            self._db = None
+
+    def _begin(self, write):
+        """Lock the database and return it, opened for writing if
+        write is true."""
+        self._lock(write)
+        try:
+            generation = self._readGeneration()
+            if (self._db is not None and
+                    (generation != self._db_generation or
+                     self._pid != os.getpid() or
+                     (write and not self._writable))):
+                self._discard()
+
+            if self._db is None:
+                # gdbm is always opened for writing, without its own
+                # locking, so that one handle serves every operation.
+                if self.backend == 'dbm.gnu':
+                    flag = 'wu'
+                elif write:
+                    flag = 'w'
+                else:
+                    flag = 'r'
+                self._db = dbm.open(self.filename, flag, self.mode)
+                self._writable = flag != 'r'
+                self._db_generation = generation
+                self._pid = os.getpid()
+            return self._db
+        except:
+            self._unlock()
+            raise
+
+    def _end(self, changed=False):
+        """Unlock the database, first writing out any changes made to
+        it if changed is true."""
+        try:
+            if changed:
+                if self.backend == 'dbm.gnu':
+                    self._db.sync()
+                else:
+                    # Other modules only reliably write everything out
+                    # on close.  dbm.dumb also rewrites its index from
+                    # memory on close, so a handle that has made
+                    # changes must not outlive the lock.
+                    self._db.close()
+                    self._db = None
+                self._db_generation = self._readGeneration() + 1
+                os.pwrite(self._lock_fd,
+                          _generation.pack(self._db_generation), 0)
+        finally:
+            self._unlock()
+
+    def _assocKey(self, server_url, handle):
+        return b'a' + _counted(server_url) + handle.encode('utf-8')
+
+    def _handlesKey(self, server_url):
+        return b'h' + _counted(server_url)
+
+    def _latestKey(self, server_url):
+        return b'l' + _counted(server_url)
+
+    def _nonceKey(self, server_url, timestamp, salt):
+        digest = cryptutil.sha1(
+            '%d:%s%s' % (len(server_url), server_url, salt))
+        return b'n%08x%s' % (timestamp, digest[:16])
+
+    def _getHandles(self, db, server_url):
+        try:
+            handles = db[self._handlesKey(server_url)]
+        except KeyError:
+            return []
+        return handles.decode('utf-8').split('\n')
+
+    def _setHandles(self, db, server_url, handles):
+        key = self._handlesKey(server_url)
+        if handles:
+            db[key] = '\n'.join(handles).encode('utf-8')
+        elif key in db:
+            del db[key]
+
+    def _load(self, db, server_url, handle):
+        try:
+            data = db[self._assocKey(server_url, handle)]
+        except KeyError:
+            return None
+        return Association.deserialize(data)
+
+    def _getLatest(self, db, server_url):
+        try:
+            handle = db[self._latestKey(server_url)]
+        except KeyError:
+            return None
+        return self._load(db, server_url, handle.decode('utf-8'))
+
+    def _setLatest(self, db, server_url, handles):
+        """Point the latest key at the newest of handles."""
+        newest = None
+        for handle in handles:
+            assoc = self._load(db, server_url, handle)
+            if assoc is not None and (newest is None or
+                                      newest.issued < assoc.issued):
+                newest = assoc
+
+        key = self._latestKey(server_url)
+        if newest is not None:
+            db[key] = newest.handle.encode('utf-8')
+        elif key in db:
+            del db[key]
+
+    def storeAssociation(self, server_url, association):
+        db = self._begin(True)
+        try:
+            db[self._assocKey(server_url, association.handle)] = (
+                association.serialize())
+
+            handles = self._getHandles(db, server_url)
+            if association.handle not in handles:
+                handles.append(association.handle)
+                self._setHandles(db, server_url, handles)
+
+            latest = self._getLatest(db, server_url)
+            if latest is None or latest.issued <= association.issued:
+                db[self._latestKey(server_url)] = (
+                    association.handle.encode('utf-8'))
+        finally:
+            self._end(True)
+
+    def getAssociation(self, server_url, handle=None):
+        db = self._begin(False)
+        try:
+            if handle is not None:
+                assoc = self._load(db, server_url, handle)
+                if assoc is not None and assoc.expiresIn <= 0:
+                    assoc = None
+                return assoc
+
+            assoc = self._getLatest(db, server_url)
+            if assoc is not None and assoc.expiresIn > 0:
+                return assoc
+
+            # The newest association has expired; look for an older
+            # one that has not.
+            best = None
+            for handle in self._getHandles(db, server_url):
+                assoc = self._load(db, server_url, handle)
+                if (assoc is not None and assoc.expiresIn > 0 and
+                        (best is None or best.issued < assoc.issued)):
+                    best = assoc
+            return best
+        finally:
+            self._end()
+
+    def removeAssociation(self, server_url, handle):
+        db = self._begin(True)
+        changed = False
+        try:
+            key = self._assocKey(server_url, handle)
+            if key not in db:
+                return False
+
+            del db[key]
+            changed = True
+            handles = self._getHandles(db, server_url)
+            if handle in handles:
+                handles.remove(handle)
+                self._setHandles(db, server_url, handles)
+
+            latest_key = self._latestKey(server_url)
+            if latest_key in db and db[latest_key] == handle.encode('utf-8'):
+                self._setLatest(db, server_url, handles)
+            return True
+        finally:
+            self._end(changed)
+
+    def useNonce(self, server_url, timestamp, salt):
+        if abs(timestamp - time.time()) > nonce.SKEW:
+            return False
+
+        key = self._nonceKey(server_url, timestamp, salt)
+        db = self._begin(True)
+        added = False
+        try:
+            if key in db:
+                return False
+            db[key] = b''
+            added = True
+            return True
+        finally:
+            self._end(added)
+
+    def cleanupNonces(self):
+        cutoff = int(time.time()) - nonce.SKEW
+        db = self._begin(True)
+        removed = 0
+        try:
+            for key in db.keys():
+                if key[:1] == b'n' and int(key[1:9], 16) < cutoff:
+                    del db[key]
+                    removed += 1
+            return removed
+        finally:
+            self._end(removed > 0)
+
+    def cleanupAssociations(self):
+        db = self._begin(True)
+        removed = 0
+        try:
+            servers = set()
+            for key in db.keys():
+                if key[:1] != b'a':
+                    continue
+
+                assoc = Association.deserialize(db[key])
+                if assoc.expiresIn <= 0:
+                    length, rest = key[1:].split(b':', 1)
+                    servers.add(rest[:int(length)].decode('utf-8'))
+                    del db[key]
+                    removed += 1
+
+            for server_url in servers:
+                handles = [
+                    handle for handle in self._getHandles(db, server_url)
+                    if self._assocKey(server_url, handle) in db]
+                self._setHandles(db, server_url, handles)
+                self._setLatest(db, server_url, handles)
+            return removed
+        finally:
+            self._end(removed > 0)
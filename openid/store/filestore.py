@@ -3,11 +3,14 @@ This module contains an C{L{OpenIDStore}} implementation backed by
 flat files.
 """
 
+import collections
 import string
 import os
 import os.path
+import threading
 import time
 import logging
+import weakref
 
 from errno import EEXIST, ENOENT
 
@@ -18,8 +21,16 @@ from openid.store.interface import OpenIDStore
 from openid.store import nonce
 from openid import cryptutil, oidutil
 
+# Durability levels for FileOpenIDStore writes, see
+# FileOpenIDStore.__init__
+SYNC_FULL = 'full'
+SYNC_DIRECTORY = 'directory'
+SYNC_GROUP = 'group'
+
 _filename_allowed = string.ascii_letters + string.digits + '.'
 _isFilenameSafe = set(_filename_allowed).__contains__
+# The characters of the names made by _safe64
+_isSafe64 = set(_filename_allowed + '_').__contains__
 
 
 def _safe64(s):
@@ -42,6 +53,30 @@ def _filenameEscape(s):
     return ''.join(filename_chunks)
 
 
+def _unquoteBytes(s):
+    """Strip the b'...' that earlier versions of this store left in
+    file names by formatting the bytes returned by _safe64 with %s.
+
+    str -> str
+    """
+    if s.startswith("b'") and s.endswith("'"):
+        return s[2:-1]
+    return s
+
+
+def _fileIdentity(stat_result):
+    """Return the parts of a file's status that change whenever an
+    association file is replaced.
+
+    Associations are always renamed into place, so a new association
+    has a new inode and change time even if it is the same size.
+
+    os.stat_result -> tuple
+    """
+    return (stat_result.st_dev, stat_result.st_ino, stat_result.st_size,
+            stat_result.st_mtime_ns, stat_result.st_ctime_ns)
+
+
 def _removeIfPresent(filename):
     """Attempt to remove a file, returning whether the file existed at
     the time of the call.
@@ -74,6 +109,100 @@ def _ensureDir(dir_name):
         if why.errno != EEXIST or not os.path.isdir(dir_name):
             raise
 
+def _fsyncDir(dir_name):
+    """Flush a directory's entries to disk, where the platform allows
+    it.
+
+    str -> NoneType
+    """
+    if not hasattr(os, 'O_DIRECTORY'):
+        return
+
+    try:
+        fd = os.open(dir_name, os.O_RDONLY | os.O_DIRECTORY)
+    except OSError as why:
+        if why.errno == ENOENT:
+            return
+        raise
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class _GroupCommitter(object):
+    """Flush recently written files to disk in batches from a
+    background thread.
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def add(self, filename):
+        """Schedule filename to be flushed with the next batch, or
+        flush it now if the committer has been stopped."""
+        with self._lock:
+            stopped = self._stopped.is_set()
+            if not stopped:
+                self._pending.add(filename)
+                # Threads do not survive a fork, so start one in each
+                # process that writes.
+                if self._thread is None or self._pid != os.getpid():
+                    self._pid = os.getpid()
+                    self._thread = threading.Thread(
+                        target=self._run, name='FileOpenIDStore group commit')
+                    self._thread.daemon = True
+                    self._thread.start()
+
+        if stopped:
+            # There is no thread to flush it any more.
+            self._flushFiles([filename])
+
+    def flush(self):
+        """Flush everything written so far."""
+        with self._lock:
+            pending, self._pending = self._pending, set()
+        self._flushFiles(pending)
+
+    def _flushFiles(self, pending):
+        dirs = set()
+        for filename in pending:
+            try:
+                fd = os.open(filename, os.O_RDONLY)
+            except OSError as why:
+                if why.errno == ENOENT:
+                    # Removed or replaced since it was written
+                    continue
+                raise
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            dirs.add(os.path.dirname(filename))
+
+        for dir_name in dirs:
+            _fsyncDir(dir_name)
+
+    def stop(self):
+        self._stopped.set()
+        thread = self._thread
+        if (thread is not None and self._pid == os.getpid() and
+                thread is not threading.current_thread()):
+            thread.join()
+        self.flush()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.flush()
+            except Exception:
+                logging.exception('Error flushing FileOpenIDStore writes')
+
+
 class FileOpenIDStore(OpenIDStore):
     """
     This is a filesystem-based store for OpenID associations and
@@ -89,19 +218,116 @@ class FileOpenIDStore(OpenIDStore):
 
     Methods of this object can raise OSError if unexpected filesystem
     conditions, such as bad permissions or missing directories, occur.
+
+    Associations are kept in one directory per server URL, alongside a
+    C{latest} file naming the most recently issued association for
+    that server, so that looking up an association without a handle
+    only has to read two files.  Association files left directly in
+    the association directory by earlier versions of this store are
+    moved into place when the store is created.
+
+    Nonces are kept in one directory per C{nonce_bucket_width} seconds
+    of timestamps, so that expired nonces can be cleaned up a
+    directory at a time.  As with associations, nonce files from
+    earlier versions are moved into their directory on creation.
+
+    @cvar nonce_bucket_width: The number of seconds of nonce
+        timestamps that share a directory.
+    @type nonce_bucket_width: int
     """
 
-    def __init__(self, directory):
+    # Name of the file in each server's association directory that
+    # holds the file name of the most recently issued association.
+    latest_filename = 'latest'
+
+    # Name of the file in each server's association directory that
+    # holds the server URL, which the directory name only has a hash
+    # of, so that the associations can be exported.
+    server_url_filename = 'server_url'
+
+    nonce_bucket_width = 10 * 60
+
+    def __init__(self, directory, durability=SYNC_FULL,
+                 commit_interval=0.05, cache_size=0):
         """
         Initializes a new FileOpenIDStore.  This initializes the
         nonce and association directories, which are subdirectories of
         the directory passed in.
 
+        Associations are always written to a temporary file and
+        renamed into place, so a reader never sees a partly written
+        association.  The durability level decides what is flushed to
+        disk before C{L{storeAssociation}} returns, and so what can be
+        lost if the machine crashes:
+
+          - C{SYNC_FULL}: the association file is flushed before it is
+            renamed into place.  After a crash the association is
+            either there and complete, or (if the rename itself was
+            not yet on disk) missing.
+
+          - C{SYNC_DIRECTORY}: the directory is flushed after the
+            rename, but the file is not flushed first.  After a crash
+            the association may be missing or, on filesystems that do
+            not write file data before renames, empty.  Empty or
+            corrupt associations fail to parse and are removed when
+            read, so the worst case is a consumer having to associate
+            again.
+
+          - C{SYNC_GROUP}: nothing is flushed on the request path.  A
+            background thread flushes the files written in the last
+            C{commit_interval} seconds, and their directories, in a
+            single batch.  A crash can lose any association stored
+            since the last batch, with the same outcomes as for
+            C{SYNC_DIRECTORY}.  Call C{L{flush}} to force a batch out,
+            and C{L{close}} when done with the store.  Writes made
+            after C{L{close}} are flushed before they return.
+
+        In no case will a crash leave a different association's
+        contents under a handle.  Nonces are never flushed; a crash
+        can lose recently used nonces at any level.
+
         @param directory: This is the directory to put the store
             directories in.
 
         @type directory: C{str}
+
+        @param durability: One of C{SYNC_FULL}, C{SYNC_DIRECTORY} or
+            C{SYNC_GROUP}.
+
+        @type durability: C{str}
+
+        @param commit_interval: The number of seconds between batches
+            for C{SYNC_GROUP}.
+
+        @type commit_interval: C{float}
+
+        @param cache_size: The number of parsed associations to keep
+            in memory.  A cached association is used as long as
+            C{os.stat} shows its file unchanged, so changes made by
+            other processes sharing the directory are always seen.
+            Zero turns the cache off.
+
+        @type cache_size: C{int}
         """
+        if durability not in (SYNC_FULL, SYNC_DIRECTORY, SYNC_GROUP):
+            raise ValueError('Unknown durability level: %r' % (durability,))
+
+        self.durability = durability
+        if durability == SYNC_GROUP:
+            self._committer = _GroupCommitter(commit_interval)
+            # Stop the background thread when the store goes away
+            self._finalizer = weakref.finalize(self, self._committer.stop)
+        else:
+            self._committer = None
+
+        self.cache_size = cache_size
+        if cache_size:
+            # filename -> (file identity, Association)
+            self._cache = collections.OrderedDict()
+            self._cache_lock = threading.Lock()
+        else:
+            self._cache = None
+
         # Make absolute
         directory = os.path.normpath(os.path.abspath(directory))
 
@@ -126,6 +352,76 @@ class FileOpenIDStore(OpenIDStore):
         _ensureDir(self.nonce_dir)
         _ensureDir(self.association_dir)
         _ensureDir(self.temp_dir)
+        self._upgradeFlatAssociations()
+        self._upgradeFlatNonces()
+
+    def _upgradeFlatNonces(self):
+        """Move nonce files stored by earlier versions of this store,
+        which kept all nonces directly in self.nonce_dir, into their
+        time bucket.
+
+        () -> int
+        """
+        moved = 0
+        for entry in os.scandir(self.nonce_dir):
+            if not entry.is_file():
+                continue
+
+            # Flat file names are "timestamp-proto-domain-urlhash-salthash"
+            try:
+                prefix, url_hash, salt_hash = entry.name.rsplit('-', 2)
+                timestamp = int(prefix.split('-', 1)[0], 16)
+            except ValueError:
+                continue
+
+            bucket = self._getNonceBucket(timestamp)
+            _ensureDir(bucket)
+            try:
+                os.rename(entry.path, os.path.join(bucket, '%s-%s-%s' % (
+                    prefix, _unquoteBytes(url_hash),
+                    _unquoteBytes(salt_hash))))
+            except OSError as why:
+                # Another process may have moved it already
+                if why.errno != ENOENT:
+                    raise
+            else:
+                moved += 1
+        return moved
+
+    def _upgradeFlatAssociations(self):
+        """Move association files stored by earlier versions of this
+        store, which kept all associations directly in
+        self.association_dir, into their server's directory.
+
+        () -> int
+        """
+        moved = 0
+        for entry in os.scandir(self.association_dir):
+            if not entry.is_file():
+                continue
+
+            # Flat file names are "proto-domain-urlhash-handlehash",
+            # where neither hash contains a dash.
+            try:
+                server_part, handle_hash = entry.name.rsplit('-', 1)
+                prefix, url_hash = server_part.rsplit('-', 1)
+            except ValueError:
+                continue
+
+            server_dir = os.path.join(
+                self.association_dir,
+                '%s-%s' % (prefix, _unquoteBytes(url_hash)))
+            _ensureDir(server_dir)
+            try:
+                os.rename(entry.path, os.path.join(
+                    server_dir, _unquoteBytes(handle_hash)))
+            except OSError as why:
+                # Another process may have moved it already
+                if why.errno != ENOENT:
+                    raise
+            else:
+                moved += 1
+        return moved
 
     def _mktemp(self):
         """Create a temporary file on the same filesystem as
@@ -153,6 +449,9 @@ class FileOpenIDStore(OpenIDStore):
         contain the domain name from the server URL for ease of human
         inspection of the data directory.
 
+        If no handle is given, the name of the directory holding all
+        of the associations for the server url is returned.
+
         (str, str) -> str
         """
         if server_url.find('://') == -1:
@@ -160,29 +459,30 @@ class FileOpenIDStore(OpenIDStore):
 
         proto, rest = server_url.split('://', 1)
         domain = _filenameEscape(rest.split('/', 1)[0])
-        url_hash = _safe64(server_url)
+        url_hash = _safe64(server_url).decode('ascii')
+        server_dir = os.path.join(
+            self.association_dir, '%s-%s-%s' % (proto, domain, url_hash))
+
         if handle:
-            handle_hash = _safe64(handle)
+            return os.path.join(server_dir, _safe64(handle).decode('ascii'))
         else:
-            handle_hash = ''
+            return server_dir
 
-        filename = '%s-%s-%s-%s' % (proto, domain, url_hash, handle_hash)
+    def _writeFile(self, filename, data, sync=True):
+        """Atomically replace the contents of filename with data, by
+        writing to a temporary file and renaming it into place.  If
+        sync is true, flush it to disk according to the store's
+        durability level.
 
-        return os.path.join(self.association_dir, filename)
-
-    def storeAssociation(self, server_url, association):
-        """Store an association in the association directory.
-
-        (str, Association) -> NoneType
+        (str, bytes, bool) -> NoneType
         """
-        association_s = association.serialize()  # NOTE: UTF-8 encoded bytes
-        filename = self.getAssociationFilename(server_url, association.handle)
         tmp_file, tmp = self._mktemp()
 
         try:
             try:
-                tmp_file.write(association_s)
-                os.fsync(tmp_file.fileno())
+                tmp_file.write(data)
+                if sync and self.durability == SYNC_FULL:
+                    os.fsync(tmp_file.fileno())
             finally:
                 tmp_file.close()
 
@@ -212,49 +512,168 @@ class FileOpenIDStore(OpenIDStore):
             _removeIfPresent(tmp)
             raise
 
+        if sync:
+            if self.durability == SYNC_DIRECTORY:
+                _fsyncDir(os.path.dirname(filename))
+            elif self.durability == SYNC_GROUP:
+                self._committer.add(filename)
+
+    def flush(self):
+        """Flush any writes that are waiting for the next group
+        commit.  Does nothing for other durability levels.
+
+        () -> NoneType
+        """
+        if self._committer is not None:
+            self._committer.flush()
+
+    def close(self):
+        """Flush any pending writes and stop the group commit thread,
+        if there is one.  The store can still be used, but with
+        C{SYNC_GROUP} each write is then flushed as it is made.
+
+        () -> NoneType
+        """
+        if self._committer is not None:
+            self._finalizer()
+
+    def storeAssociation(self, server_url, association):
+        """Store an association in its server's association directory,
+        and make it the server's latest association if it was issued
+        after the current one.
+
+        (str, Association) -> NoneType
+        """
+        association_s = association.serialize()  # NOTE: UTF-8 encoded bytes
+        filename = self.getAssociationFilename(server_url, association.handle)
+        server_dir = os.path.dirname(filename)
+        _ensureDir(server_dir)
+        try:
+            self._writeFile(filename, association_s)
+        except OSError as why:
+            if why.errno != ENOENT:
+                raise
+            # The directory was removed by a concurrent cleanup; put
+            # it back.
+            _ensureDir(server_dir)
+            self._writeFile(filename, association_s)
+
+        url_filename = os.path.join(server_dir, self.server_url_filename)
+        if not os.path.exists(url_filename):
+            self._writeFile(url_filename, server_url.encode('utf-8'))
+
+        latest = self._getLatest(server_dir)
+        if latest is None or latest.issued <= association.issued:
+            self._setLatest(server_dir, filename)
+
+    def _setLatest(self, server_dir, filename):
+        """Point the server's latest file at the named association
+        file.
+
+        There is a race between processes storing associations for the
+        same server at the same time, which may leave the pointer at
+        an association that is valid but not the newest one.
+
+        (str, str) -> NoneType
+        """
+        name = os.path.basename(filename).encode('ascii')
+        # The latest file is only a hint, so it need not survive a crash
+        self._writeFile(os.path.join(server_dir, self.latest_filename), name,
+                        sync=False)
+
+    def _getLatest(self, server_dir):
+        """Read the association that the server's latest file points
+        to, or None if it is missing, expired or not there.
+
+        str -> Association or NoneType
+        """
+        try:
+            latest_file = open(
+                os.path.join(server_dir, self.latest_filename), 'rb')
+        except IOError as why:
+            if why.errno == ENOENT:
+                return None
+            else:
+                raise
+
+        try:
+            name = latest_file.read().decode('ascii', 'replace')
+        finally:
+            latest_file.close()
+
+        if not name or not all(map(_isSafe64, name)):
+            return None
+
+        return self._getAssociation(os.path.join(server_dir, name))
+
     def getAssociation(self, server_url, handle=None):
         """Retrieve an association. If no handle is specified, return
-        the association with the latest expiration.
+        the association with the latest issue date.
 
         (str, str or NoneType) -> Association or NoneType
         """
-        if handle is None:
-            handle = ''
-
-        # The filename with the empty handle is a prefix of all other
-        # associations for the given server URL.
-        filename = self.getAssociationFilename(server_url, handle)
-
         if handle:
+            filename = self.getAssociationFilename(server_url, handle)
             return self._getAssociation(filename)
-        else:
-            association_files = os.listdir(self.association_dir)
-            matching_files = []
-            # strip off the path to do the comparison
-            name = os.path.basename(filename)
-            for association_file in association_files:
-                if association_file.startswith(name):
-                    matching_files.append(association_file)
-
-            matching_associations = []
-            # read the matching files and sort by time issued
-            for name in matching_files:
-                full_name = os.path.join(self.association_dir, name)
-                association = self._getAssociation(full_name)
-                if association is not None:
-                    matching_associations.append(
-                        (association.issued, association))
 
-            matching_associations.sort()
+        server_dir = self.getAssociationFilename(server_url, None)
+        association = self._getLatest(server_dir)
+        if association is not None:
+            return association
 
-            # return the most recently issued one.
-            if matching_associations:
-                (_, assoc) = matching_associations[-1]
-                return assoc
-            else:
+        # The latest file is missing or points at an association that
+        # has been removed, so find the newest remaining association.
+        try:
+            association_files = os.listdir(server_dir)
+        except OSError as why:
+            if why.errno == ENOENT:
                 return None
+            else:
+                raise
+
+        newest = None
+        newest_filename = None
+        for name in association_files:
+            if name in (self.latest_filename, self.server_url_filename):
+                continue
+
+            full_name = os.path.join(server_dir, name)
+            association = self._getAssociation(full_name)
+            if association is not None and (
+                    newest is None or newest.issued < association.issued):
+                newest = association
+                newest_filename = full_name
+
+        if newest is not None:
+            self._setLatest(server_dir, newest_filename)
+        return newest
 
     def _getAssociation(self, filename):
+        if self._cache is not None:
+            try:
+                identity = _fileIdentity(os.stat(filename))
+            except OSError as why:
+                if why.errno == ENOENT:
+                    self._uncache(filename)
+                    return None
+                else:
+                    raise
+
+            with self._cache_lock:
+                cached = self._cache.get(filename)
+                if cached is not None and cached[0] == identity:
+                    self._cache.move_to_end(filename)
+                    association = cached[1]
+                else:
+                    association = None
+
+            if association is not None:
+                if association.expiresIn == 0:
+                    self._uncache(filename)
+                    _removeIfPresent(filename)
+                    return None
+                return association
+
         try:
             assoc_file = open(filename, 'rb')
         except IOError as why:
@@ -266,6 +685,8 @@ class FileOpenIDStore(OpenIDStore):
 
         try:
             assoc_s = assoc_file.read()
+            if self._cache is not None:
+                identity = _fileIdentity(os.fstat(assoc_file.fileno()))
         finally:
             assoc_file.close()
 
@@ -279,21 +700,44 @@ class FileOpenIDStore(OpenIDStore):
         if association.expiresIn == 0:
             _removeIfPresent(filename)
             return None
-        else:
-            return association
+
+        if self._cache is not None:
+            with self._cache_lock:
+                self._cache[filename] = (identity, association)
+                self._cache.move_to_end(filename)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return association
+
+    def _uncache(self, filename):
+        if self._cache is not None:
+            with self._cache_lock:
+                self._cache.pop(filename, None)
 
     def removeAssociation(self, server_url, handle):
         """Remove an association if it exists. Do nothing if it does not.
 
         (str, str) -> bool
         """
+        if not handle:
+            return 0
+
         assoc = self.getAssociation(server_url, handle)
         if assoc is None:
             return 0
         else:
             filename = self.getAssociationFilename(server_url, handle)
+            self._uncache(filename)
             return _removeIfPresent(filename)
 
+    def _getNonceBucket(self, timestamp):
+        """Return the directory holding nonces issued at timestamp.
+
+        int -> str
+        """
+        start = timestamp - timestamp % self.nonce_bucket_width
+        return os.path.join(self.nonce_dir, '%08x' % (start,))
+
     def useNonce(self, server_url, timestamp, salt):
         """Return whether this nonce is valid.
 
@@ -310,28 +754,49 @@ class FileOpenIDStore(OpenIDStore):
             proto, rest = '', ''
 
         domain = _filenameEscape(rest.split('/', 1)[0])
-        url_hash = _safe64(server_url)
-        salt_hash = _safe64(salt)
+        url_hash = _safe64(server_url).decode('ascii')
+        salt_hash = _safe64(salt).decode('ascii')
 
         filename = '%08x-%s-%s-%s-%s' % (timestamp, proto, domain,
                                          url_hash, salt_hash)
 
-        filename = os.path.join(self.nonce_dir, filename)
+        bucket = self._getNonceBucket(timestamp)
+        filename = os.path.join(bucket, filename)
         try:
             fd = os.open(filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o200)
         except OSError as why:
             if why.errno == EEXIST:
                 return False
+            elif why.errno == ENOENT:
+                # The bucket is new, or was removed by a concurrent
+                # cleanup; make it.
+                _ensureDir(bucket)
+                try:
+                    fd = os.open(filename,
+                                 os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o200)
+                except OSError as why:
+                    if why.errno == EEXIST:
+                        return False
+                    raise
             else:
                 raise
-        else:
-            os.close(fd)
-            return True
+
+        os.close(fd)
+        return True
 
     def _allAssocs(self):
         all_associations = []
 
-        association_filenames = [os.path.join(self.association_dir, filename) for filename in os.listdir(self.association_dir)]
+        association_filenames = []
+        for server_entry in os.scandir(self.association_dir):
+            if not server_entry.is_dir():
+                continue
+            for name in os.listdir(server_entry.path):
+                if name not in (self.latest_filename,
+                                self.server_url_filename):
+                    association_filenames.append(
+                        os.path.join(server_entry.path, name))
+
         for association_filename in association_filenames:
             try:
                 association_file = open(association_filename, 'rb')
@@ -358,6 +823,81 @@ class FileOpenIDStore(OpenIDStore):
 
         return all_associations
 
+    def iterAssociations(self, after=None):
+        """Yield the unexpired associations in the store with their
+        server URLs, in order of server URL and handle, reading one
+        server's associations at a time.
+
+        The associations of servers whose directories were made by
+        earlier versions of this library, which did not record the
+        server URL, cannot be exported and are skipped; see
+        C{L{countUnexportableServers}}.
+
+        @param after: A (server URL, handle) pair; only associations
+            after it are yielded.
+
+        ((str, str) or NoneType) -> iter((str, Association))
+        """
+        servers = []
+        skipped = 0
+        for server_entry in os.scandir(self.association_dir):
+            if not server_entry.is_dir():
+                continue
+            try:
+                with open(os.path.join(server_entry.path,
+                                       self.server_url_filename), 'rb') as f:
+                    server_url = f.read().decode('utf-8')
+            except IOError as why:
+                if why.errno == ENOENT:
+                    skipped += 1
+                    continue
+                raise
+            if after is None or server_url >= after[0]:
+                servers.append((server_url, server_entry.path))
+
+        if skipped:
+            logging.warning('Skipped the associations of %d servers with '
+                            'no recorded server URL', skipped)
+
+        servers.sort()
+        for server_url, server_dir in servers:
+            try:
+                names = os.listdir(server_dir)
+            except OSError as why:
+                if why.errno == ENOENT:
+                    continue
+                raise
+
+            associations = []
+            for name in names:
+                if name in (self.latest_filename, self.server_url_filename):
+                    continue
+                association = self._getAssociation(
+                    os.path.join(server_dir, name))
+                if association is not None:
+                    associations.append(association)
+
+            associations.sort(key=lambda a: a.handle)
+            for association in associations:
+                if after is None or (server_url, association.handle) > after:
+                    yield server_url, association
+
+    def countUnexportableServers(self):
+        """Return the number of servers whose associations
+        C{L{iterAssociations}} skips because their directories do not
+        record the server URL.  Directories moved out of the flat
+        layout of earlier versions of this library are like this until
+        an association is next stored for their server.
+
+        () -> int
+        """
+        count = 0
+        for server_entry in os.scandir(self.association_dir):
+            if server_entry.is_dir() and not os.path.exists(os.path.join(
+                    server_entry.path, self.server_url_filename)):
+                count += 1
+        return count
+
     def cleanup(self):
         """Remove expired entries from the database. This is
         potentially expensive, so only run when it is acceptable to
@@ -374,19 +914,84 @@ class FileOpenIDStore(OpenIDStore):
             if assoc.expiresIn == 0:
                 _removeIfPresent(assoc_filename)
                 removed += 1
+
+        for server_entry in os.scandir(self.association_dir):
+            if server_entry.is_dir():
+                self._removeServerDir(server_entry.path)
         return removed
 
+    def _removeServerDir(self, server_dir):
+        """Remove a server's association directory if it holds no
+        associations.
+
+        str -> NoneType
+        """
+        try:
+            names = os.listdir(server_dir)
+        except OSError as why:
+            if why.errno == ENOENT:
+                return
+            raise
+
+        if set(names) - set([self.latest_filename, self.server_url_filename]):
+            return
+
+        url_filename = os.path.join(server_dir, self.server_url_filename)
+        try:
+            with open(url_filename, 'rb') as f:
+                server_url = f.read()
+        except IOError as why:
+            if why.errno != ENOENT:
+                raise
+            server_url = None
+
+        for name in names:
+            _removeIfPresent(os.path.join(server_dir, name))
+
+        try:
+            os.rmdir(server_dir)
+        except OSError:
+            # An association was stored here meanwhile; keep its
+            # server URL.
+            if (server_url is not None and os.path.isdir(server_dir) and
+                    not os.path.exists(url_filename)):
+                self._writeFile(url_filename, server_url)
+
     def cleanupNonces(self):
-        nonces = os.listdir(self.nonce_dir)
         now = time.time()
+        oldest_allowed = now - nonce.SKEW
+        newest_allowed = now + nonce.SKEW
 
         removed = 0
-        # Check all nonces for expiry
-        for nonce_fname in nonces:
-            timestamp = nonce_fname.split('-', 1)[0]
-            timestamp = int(timestamp, 16)
-            if abs(timestamp - now) > nonce.SKEW:
-                filename = os.path.join(self.nonce_dir, nonce_fname)
-                _removeIfPresent(filename)
-                removed += 1
+        for bucket in os.scandir(self.nonce_dir):
+            try:
+                start = int(bucket.name, 16)
+            except ValueError:
+                continue
+            if not bucket.is_dir():
+                continue
+
+            end = start + self.nonce_bucket_width - 1
+            if start >= oldest_allowed and end <= newest_allowed:
+                # Every nonce in the bucket is still current
+                continue
+
+            expired = end < oldest_allowed or start > newest_allowed
+            for nonce_fname in os.listdir(bucket.path):
+                if not expired:
+                    # The bucket straddles the edge of the window, so
+                    # check each nonce in it.
+                    timestamp = int(nonce_fname.split('-', 1)[0], 16)
+                    if oldest_allowed <= timestamp <= newest_allowed:
+                        continue
+                filename = os.path.join(bucket.path, nonce_fname)
+                removed += _removeIfPresent(filename)
+
+            if expired:
+                try:
+                    os.rmdir(bucket.path)
+                except OSError:
+                    # Not empty or already gone; the next cleanup will
+                    # get it.
+                    pass
         return removed
@@ -0,0 +1,261 @@
+"""
+This module contains C{L{InstrumentedStore}}, which times the calls
+made to another C{L{OpenIDStore}} and reports them to sinks, and the
+sinks that come with it:
+
+  - C{L{StoreMetrics}} keeps call counts, error counts and latency
+    histograms for each method, and formats them for Prometheus,
+
+  - C{L{LoggingSink}} logs failed and slow calls, and
+
+  - any callable taking the method name, the seconds the call took
+    and whether it raised an exception.
+
+Example of exposing a file store's timings to Prometheus::
+
+    from openid.store.filestore import FileOpenIDStore
+    from openid.store.instrumentedstore import (
+        InstrumentedStore, LoggingSink, StoreMetrics)
+
+    metrics = StoreMetrics()
+    store = InstrumentedStore(FileOpenIDStore('/var/lib/openid'),
+                              [metrics, LoggingSink(slow=0.5)])
+    ...
+    # In the /metrics handler:
+    body = metrics.prometheusText()
+"""
+
+import bisect
+import logging
+import threading
+import time
+
+from openid.store.interface import OpenIDStore
+
+# Upper bounds of the latency histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# The store methods that are timed
+METHODS = ('storeAssociation', 'getAssociation', 'removeAssociation',
+           'useNonce', 'cleanupNonces', 'cleanupAssociations')
+
+# The batch methods that some stores have, which are timed when the
+# backend has them
+OPTIONAL_METHODS = ('storeAssociations', 'useNonces')
+
+
+def _instrumented(name):
+    def method(self, *args, **kwargs):
+        backend_method = getattr(self.backend, name)
+        if not self.sinks:
+            return backend_method(*args, **kwargs)
+
+        start = time.perf_counter()
+        try:
+            result = backend_method(*args, **kwargs)
+        except:
+            self._report(name, time.perf_counter() - start, True)
+            raise
+        self._report(name, time.perf_counter() - start, False)
+        return result
+
+    method.__name__ = name
+    method.__doc__ = getattr(getattr(OpenIDStore, name, None), '__doc__',
+                             None)
+    return method
+
+
+class InstrumentedStore(OpenIDStore):
+    """
+    An C{L{OpenIDStore}} that passes every call on to its C{backend},
+    timing it and reporting it to each of its C{sinks}.
+
+    A sink is called with the method name, the number of seconds the
+    call took and whether it raised an exception.  Sinks may be added
+    to and removed from C{sinks} at any time; while there are none,
+    calls are passed on without being timed.  An exception raised by
+    a sink is logged, and does not affect the call being reported.
+
+    Other attributes are looked up on the backend, so that the store
+    has the same optional methods, such as C{iterAssociations}, as the
+    backend.  Of those, the batch methods in C{OPTIONAL_METHODS} are
+    timed too.
+
+    @ivar backend: The store being instrumented.
+    @type backend: L{OpenIDStore}
+
+    @ivar sinks: The sinks calls are reported to.
+    @type sinks: C{list}
+    """
+
+    def __init__(self, backend, sinks=()):
+        """
+        @param backend: The store to instrument.
+        @type backend: L{OpenIDStore}
+
+        @param sinks: The sinks to report calls to.
+        """
+        self.backend = backend
+        self.sinks = list(sinks)
+
+    def _report(self, name, seconds, error):
+        for sink in self.sinks:
+            try:
+                sink(name, seconds, error)
+            except Exception:
+                logging.exception('Error reporting OpenID store call to %r',
+                                  sink)
+
+    def __getattr__(self, name):
+        # Only called for attributes not found on the store itself.
+        if name == 'backend':
+            raise AttributeError(name)
+        value = getattr(self.backend, name)
+        if name in OPTIONAL_METHODS:
+            return _instrumented(name).__get__(self, type(self))
+        return value
+
+    storeAssociation = _instrumented('storeAssociation')
+    getAssociation = _instrumented('getAssociation')
+    removeAssociation = _instrumented('removeAssociation')
+    useNonce = _instrumented('useNonce')
+    cleanupNonces = _instrumented('cleanupNonces')
+    cleanupAssociations = _instrumented('cleanupAssociations')
+
+
+class StoreMetrics(object):
+    """
+    A sink that counts calls and errors, and keeps a histogram of call
+    latency, for each store method.
+
+    @ivar buckets: The upper bounds of the histogram buckets, in
+        seconds, in increasing order.
+    @type buckets: C{tuple} of C{float}
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # method -> [calls, errors, total seconds, bucket counts]
+        self._methods = {}
+
+    def __call__(self, name, seconds, error):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            stats = self._methods.get(name)
+            if stats is None:
+                stats = [0, 0, 0.0, [0] * (len(self.buckets) + 1)]
+                self._methods[name] = stats
+            stats[0] += 1
+            if error:
+                stats[1] += 1
+            stats[2] += seconds
+            stats[3][index] += 1
+
+    def snapshot(self):
+        """Return the metrics gathered so far.
+
+        @return: A dict from method name to a dict with the number of
+            C{calls} and C{errors}, the total C{seconds}, and
+            C{buckets}, a list of (upper bound, cumulative count)
+            pairs ending with C{float('inf')}.
+        @rtype: C{dict}
+        """
+        bounds = self.buckets + (float('inf'),)
+        with self._lock:
+            methods = dict((name, (calls, errors, seconds, list(counts)))
+                           for name, (calls, errors, seconds, counts)
+                           in self._methods.items())
+
+        result = {}
+        for name, (calls, errors, seconds, counts) in methods.items():
+            cumulative = []
+            total = 0
+            for bound, count in zip(bounds, counts):
+                total += count
+                cumulative.append((bound, total))
+            result[name] = {
+                'calls': calls,
+                'errors': errors,
+                'seconds': seconds,
+                'buckets': cumulative,
+                }
+        return result
+
+    def reset(self):
+        """Forget the metrics gathered so far."""
+        with self._lock:
+            self._methods = {}
+
+    def prometheusText(self, prefix='openid_store'):
+        """Return the metrics in the Prometheus text exposition format,
+        as a latency histogram and an error counter, each labelled by
+        method.
+
+        @param prefix: The start of the metric names.
+        @type prefix: C{str}
+
+        @rtype: C{str}
+        """
+        snapshot = self.snapshot()
+        names = sorted(snapshot)
+        lines = [
+            '# HELP %s_call_seconds Time spent in OpenID store calls.'
+            % (prefix,),
+            '# TYPE %s_call_seconds histogram' % (prefix,),
+            ]
+        for name in names:
+            stats = snapshot[name]
+            for bound, count in stats['buckets']:
+                if bound == float('inf'):
+                    le = '+Inf'
+                else:
+                    le = repr(bound)
+                lines.append('%s_call_seconds_bucket{method="%s",le="%s"} %d'
+                             % (prefix, name, le, count))
+            lines.append('%s_call_seconds_sum{method="%s"} %r'
+                         % (prefix, name, stats['seconds']))
+            lines.append('%s_call_seconds_count{method="%s"} %d'
+                         % (prefix, name, stats['calls']))
+
+        lines.extend([
+            '# HELP %s_errors_total OpenID store calls that raised an '
+            'exception.' % (prefix,),
+            '# TYPE %s_errors_total counter' % (prefix,),
+            ])
+        for name in names:
+            lines.append('%s_errors_total{method="%s"} %d'
+                         % (prefix, name, snapshot[name]['errors']))
+        return '\n'.join(lines) + '\n'
+
+
+class LoggingSink(object):
+    """
+    A sink that logs store calls that raised an exception, or that
+    took at least C{slow} seconds.
+
+    @ivar logger: The logger to log to.
+    @type logger: C{logging.Logger}
+
+    @ivar slow: Calls taking at least this many seconds are logged.
+    @type slow: C{float}
+
+    @ivar level: The level to log at.
+    @type level: C{int}
+    """
+
+    def __init__(self, logger=None, slow=0.1, level=logging.WARNING):
+        if logger is None:
+            logger = logging.getLogger('openid.store')
+        self.logger = logger
+        self.slow = slow
+        self.level = level
+
+    def __call__(self, name, seconds, error):
+        if error:
+            self.logger.log(self.level, 'OpenID store %s failed after '
+                            '%.3f seconds', name, seconds)
+        elif seconds >= self.slow:
+            self.logger.log(self.level, 'OpenID store %s took %.3f seconds',
+                            name, seconds)
@@ -1,17 +1,60 @@
 """A simple store using only in-process memory."""
 
+from openid import cryptutil
 from openid.store import nonce
+from openid.store.interface import OpenIDStore
 
+import collections
 import copy
+import heapq
+import itertools
+import struct
+import sys
+import threading
 import time
 
+# Nonce keys start with the big-endian timestamp
+_nonce_stamp = struct.Struct('>q')
+_nonce_key_size = sys.getsizeof(bytes(_nonce_stamp.size + 16))
+
 
 class ServerAssocs(object):
+    """The associations for a single server URL.
+
+    Besides the handle lookup table, two heaps index the associations
+    by issue time and by expiry time, so that finding the newest
+    association and expiring old ones do not have to look at every
+    association.  Newly stored associations are added to the heaps on
+    the next lookup.  Entries for associations that have been removed
+    or replaced are left in the heaps and skipped when they come up.
+    """
     def __init__(self):
         self.assocs = {}
+        self._by_issued = []
+        self._by_expiry = []
+        self._pending = []
+        self._counter = itertools.count()
 
     def set(self, assoc):
         self.assocs[assoc.handle] = assoc
+        self._pending.append(assoc)
+        if len(self._pending) > 2 * len(self.assocs) + 16:
+            self._pending = [pending for pending in self._pending
+                             if self._isCurrent(pending)]
+
+    def _index(self):
+        """Add associations stored since the last lookup to the heaps."""
+        for assoc in self._pending:
+            seq = next(self._counter)
+            heapq.heappush(self._by_issued, (-assoc.issued, seq, assoc))
+            heapq.heappush(self._by_expiry,
+                           (assoc.issued + assoc.lifetime, seq, assoc))
+        self._pending = []
+        # best() and expire() each pop stale entries from only one of
+        # the heaps, so either may be the one that grows.
+        if (max(len(self._by_issued), len(self._by_expiry)) >
+                2 * len(self.assocs) + 16):
+            self._compact()
 
     def get(self, handle):
         return self.assocs.get(handle)
@@ -24,39 +67,122 @@ class ServerAssocs(object):
         else:
             return True
 
+    def _isCurrent(self, assoc):
+        return self.assocs.get(assoc.handle) is assoc
+
+    def _compact(self):
+        """Drop heap entries for associations that are no longer stored."""
+        self._by_issued = [entry for entry in self._by_issued
+                           if self._isCurrent(entry[2])]
+        heapq.heapify(self._by_issued)
+        self._by_expiry = [entry for entry in self._by_expiry
+                           if self._isCurrent(entry[2])]
+        heapq.heapify(self._by_expiry)
+
     def best(self):
-        """Returns association with the oldest issued date.
+        """Returns association with the newest issued date.
 
         or None if there are no associations.
         """
-        best = None
-        for assoc in list(self.assocs.values()):
-            if best is None or best.issued < assoc.issued:
-                best = assoc
-        return best
+        self._index()
+        heap = self._by_issued
+        while heap:
+            assoc = heap[0][2]
+            if self._isCurrent(assoc):
+                return assoc
+            heapq.heappop(heap)
+        return None
+
+    def expire(self):
+        """Remove expired associations.
+
+        @return: the associations that were removed
+        """
+        self._index()
+        now = int(time.time())
+        removed = []
+        heap = self._by_expiry
+        while heap and heap[0][0] <= now:
+            _, _, assoc = heapq.heappop(heap)
+            if self._isCurrent(assoc):
+                del self.assocs[assoc.handle]
+                removed.append(assoc)
+        return removed
+
+    def nextExpiry(self):
+        """Return a time no later than when the next association
+        expires, or None if there are no associations.
+        """
+        self._index()
+        if self._by_expiry:
+            return self._by_expiry[0][0]
+        return None
 
     def cleanup(self):
         """Remove expired associations.
 
         @return: tuple of (removed associations, remaining associations)
         """
-        remove = []
-        for handle, assoc in self.assocs.items():
-            if assoc.expiresIn == 0:
-                remove.append(handle)
-        for handle in remove:
-            del self.assocs[handle]
-        return len(remove), len(self.assocs)
+        return len(self.expire()), len(self.assocs)
 
 
 class MemoryStore(object):
     """In-process memory store.
 
     Use for single long-running processes.  No persistence supplied.
+
+    Nonces are kept in buckets of C{nonce_bucket_width} seconds, keyed
+    by a packed timestamp and a digest of the server URL and salt, so
+    that C{L{cleanupNonces}} can drop whole buckets at a time.
+
+    The store can be given a capacity, in which case it will not hold
+    more than C{max_associations} associations or C{max_nonces}
+    nonces.  When full, expired associations are dropped first, and
+    then the least recently used ones.  Nonces are only ever dropped
+    once they are outside of the L{nonce.SKEW} window; if the store is
+    full of current nonces, new ones are refused (C{L{useNonce}}
+    returns C{False}) rather than risking a replay.  A full store only
+    looks for expired associations to drop once one is due to expire,
+    and for expired nonces once its oldest bucket has expired.  See
+    C{L{getStats}} for eviction counters and the store's footprint.
+
+    @cvar nonce_bucket_width: The number of seconds of nonce
+        timestamps that share a bucket.
+    @type nonce_bucket_width: int
     """
-    def __init__(self):
+    nonce_bucket_width = 60
+
+    def __init__(self, max_associations=None, max_nonces=None):
+        """
+        @param max_associations: The maximum number of associations to
+            hold, or C{None} for no limit.
+        @type max_associations: C{int} or C{NoneType}
+
+        @param max_nonces: The maximum number of nonces to hold, or
+            C{None} for no limit.
+        @type max_nonces: C{int} or C{NoneType}
+        """
         self.server_assocs = {}
         self.nonces = {}
+        self.max_associations = max_associations
+        self.max_nonces = max_nonces
+
+        # (server_url, handle) in least to most recently used order.
+        # Only tracked when there is an association limit.
+        if max_associations is None:
+            self._lru = None
+        else:
+            self._lru = collections.OrderedDict()
+
+        # No association expires before this time.  Only tracked when
+        # there is an association limit.
+        self._next_expiry = float('inf')
+
+        self._nonce_count = 0
+        self.expired_associations = 0
+        self.evicted_associations = 0
+        self.expired_nonces = 0
+        self.refused_nonces = 0
 
     def _getServerAssocs(self, server_url):
         try:
@@ -65,61 +191,312 @@ class MemoryStore(object):
             assocs = self.server_assocs[server_url] = ServerAssocs()
             return assocs
 
+    def _touch(self, server_url, assoc):
+        if self._lru is not None and assoc is not None:
+            self._lru.move_to_end((server_url, assoc.handle))
+
+    def _makeRoom(self):
+        """Expire or evict associations until there is room for one
+        more."""
+        if len(self._lru) < self.max_associations:
+            return
+
+        # Only clean up once an association is due to expire, so that
+        # a store kept at capacity does not scan every association on
+        # each insert.
+        if self._next_expiry <= int(time.time()):
+            self.cleanupAssociations()
+        while self._lru and len(self._lru) >= self.max_associations:
+            (server_url, handle), _ = self._lru.popitem(last=False)
+            self.server_assocs[server_url].remove(handle)
+            self.evicted_associations += 1
+
     def storeAssociation(self, server_url, assoc):
         assocs = self._getServerAssocs(server_url)
+        if self._lru is not None:
+            key = (server_url, assoc.handle)
+            if key in self._lru:
+                self._lru.move_to_end(key)
+            else:
+                self._makeRoom()
+                self._lru[key] = None
+            self._next_expiry = min(self._next_expiry,
+                                    assoc.issued + assoc.lifetime)
+            # cleanupAssociations may have dropped this server's entry
+            assocs = self._getServerAssocs(server_url)
         assocs.set(copy.deepcopy(assoc))
 
     def getAssociation(self, server_url, handle=None):
         assocs = self._getServerAssocs(server_url)
         if handle is None:
-            return assocs.best()
+            assoc = assocs.best()
         else:
-            return assocs.get(handle)
+            assoc = assocs.get(handle)
+        self._touch(server_url, assoc)
+        return assoc
 
     def removeAssociation(self, server_url, handle):
         assocs = self._getServerAssocs(server_url)
-        return assocs.remove(handle)
+        removed = assocs.remove(handle)
+        if removed and self._lru is not None:
+            del self._lru[(server_url, handle)]
+        return removed
+
+    def _nonceKey(self, server_url, timestamp, salt):
+        digest = cryptutil.sha1(
+            '%d:%s%s' % (len(server_url), server_url, salt))
+        return _nonce_stamp.pack(timestamp) + digest[:16]
 
     def useNonce(self, server_url, timestamp, salt):
         if abs(timestamp - time.time()) > nonce.SKEW:
             return False
 
-        anonce = (str(server_url), int(timestamp), str(salt))
-        if anonce in self.nonces:
+        timestamp = int(timestamp)
+        key = self._nonceKey(str(server_url), timestamp, str(salt))
+        index = timestamp // self.nonce_bucket_width
+        bucket = self.nonces.get(index)
+        if bucket is not None and key in bucket:
             return False
-        else:
-            self.nonces[anonce] = None
-            return True
+
+        if (self.max_nonces is not None and
+                self._nonce_count >= self.max_nonces):
+            # Only clean up once the oldest bucket has expired, so that
+            # a flood of nonces against a store full of current ones
+            # does not scan the store each time.
+            width = self.nonce_bucket_width
+            if (self.nonces and (min(self.nonces) + 1) * width <=
+                    time.time() - nonce.SKEW):
+                self.cleanupNonces()
+            if self._nonce_count >= self.max_nonces:
+                self.refused_nonces += 1
+                return False
+            bucket = self.nonces.get(index)
+
+        if bucket is None:
+            bucket = self.nonces[index] = set()
+        bucket.add(key)
+        self._nonce_count += 1
+        return True
 
     def cleanupNonces(self):
         now = time.time()
-        expired = []
-        for anonce in self.nonces.keys():
-            if abs(anonce[1] - now) > nonce.SKEW:
-                # removing items while iterating over the set could be bad.
-                expired.append(anonce)
+        oldest_allowed = now - nonce.SKEW
+        newest_allowed = now + nonce.SKEW
+        width = self.nonce_bucket_width
+
+        removed = 0
+        for index in list(self.nonces.keys()):
+            oldest = index * width
+            newest = oldest + width - 1
+            if oldest >= oldest_allowed and newest <= newest_allowed:
+                # The whole bucket is still current
+                continue
 
-        for anonce in expired:
-            del self.nonces[anonce]
-        return len(expired)
+            bucket = self.nonces[index]
+            if newest < oldest_allowed or oldest > newest_allowed:
+                # The whole bucket has expired
+                removed += len(bucket)
+                del self.nonces[index]
+                continue
+
+            # The bucket straddles the edge of the window, so check
+            # each nonce in it.
+            expired = []
+            for key in bucket:
+                (stamp,) = _nonce_stamp.unpack_from(key)
+                if stamp < oldest_allowed or stamp > newest_allowed:
+                    expired.append(key)
+            bucket.difference_update(expired)
+            removed += len(expired)
+            if not bucket:
+                del self.nonces[index]
+
+        self._nonce_count -= removed
+        self.expired_nonces += removed
+        return removed
 
     def cleanupAssociations(self):
         remove_urls = []
         removed_assocs = 0
+        next_expiry = float('inf')
         for server_url, assocs in self.server_assocs.items():
-            removed, remaining = assocs.cleanup()
-            removed_assocs += removed
-            if not remaining:
+            removed = assocs.expire()
+            removed_assocs += len(removed)
+            if self._lru is not None:
+                for assoc in removed:
+                    del self._lru[(server_url, assoc.handle)]
+            if not assocs.assocs:
                 remove_urls.append(server_url)
+            else:
+                next_expiry = min(next_expiry, assocs.nextExpiry())
 
         # Remove entries from server_assocs that had none remaining.
         for server_url in remove_urls:
             del self.server_assocs[server_url]
+        self._next_expiry = next_expiry
+        self.expired_associations += removed_assocs
         return removed_assocs
 
+    def iterAssociations(self, after=None):
+        """Yield the unexpired associations in the store with their
+        server URLs, in order of server URL and handle.
+
+        @param after: A (server URL, handle) pair; only associations
+            after it are yielded.
+
+        ((str, str) or NoneType) -> iter((str, Association))
+        """
+        found = []
+        for server_url, assocs in self.server_assocs.items():
+            if after is not None and server_url < after[0]:
+                continue
+            for handle, assoc in assocs.assocs.items():
+                if after is None or (server_url, handle) > after:
+                    found.append((server_url, handle, assoc))
+
+        found.sort(key=lambda item: item[:2])
+        for server_url, handle, assoc in found:
+            if assoc.expiresIn > 0:
+                yield server_url, assoc
+
+    def getStats(self):
+        """Return counters describing the contents of this store.
+
+        The byte count is an estimate of the memory held by stored
+        associations and nonces, not counting the interpreter's own
+        bookkeeping.
+
+        @return: a dictionary with the keys C{associations},
+            C{nonces}, C{bytes}, C{expired_associations},
+            C{evicted_associations}, C{expired_nonces} and
+            C{refused_nonces}
+        @rtype: C{dict}
+        """
+        assoc_count = 0
+        assoc_bytes = 0
+        for assocs in self.server_assocs.values():
+            assoc_count += len(assocs.assocs)
+            for assoc in assocs.assocs.values():
+                assoc_bytes += (sys.getsizeof(assoc) +
+                                sys.getsizeof(assoc.__dict__) +
+                                sys.getsizeof(assoc.handle) +
+                                sys.getsizeof(assoc.secret))
+
+        nonce_bytes = sum(map(sys.getsizeof, self.nonces.values()))
+        nonce_bytes += self._nonce_count * _nonce_key_size
+
+        return {
+            'associations': assoc_count,
+            'nonces': self._nonce_count,
+            'bytes': assoc_bytes + nonce_bytes,
+            'expired_associations': self.expired_associations,
+            'evicted_associations': self.evicted_associations,
+            'expired_nonces': self.expired_nonces,
+            'refused_nonces': self.refused_nonces,
+            }
+
     def __eq__(self, other):
         return ((self.server_assocs == other.server_assocs) and
                 (self.nonces == other.nonces))
 
     def __ne__(self, other):
         return not (self == other)
+
+
+class ShardedMemoryStore(OpenIDStore):
+    """In-process memory store that is safe to share between threads.
+
+    Associations are spread across a number of independent
+    C{L{MemoryStore}} shards by server URL, and nonces by their
+    (server URL, timestamp, salt) tuple.  Each shard has its own lock,
+    so threads working on different servers or nonces rarely wait on
+    each other.
+
+    Use for multi-threaded long-running processes.  No persistence
+    supplied.
+    """
+    def __init__(self, shards=16, max_associations=None, max_nonces=None):
+        """
+        @param shards: The number of independently locked shards.
+        @type shards: C{int}
+
+        @param max_associations: The maximum number of associations to
+            hold, or C{None} for no limit.  The limit is split evenly
+            between the shards.
+        @type max_associations: C{int} or C{NoneType}
+
+        @param max_nonces: The maximum number of nonces to hold, or
+            C{None} for no limit.  The limit is split evenly between
+            the shards.
+        @type max_nonces: C{int} or C{NoneType}
+        """
+        if shards < 1:
+            raise ValueError('shards must be at least 1, got %r' % (shards,))
+
+        def perShard(limit):
+            if limit is None:
+                return None
+            return max(1, limit // shards)
+
+        self.shards = [MemoryStore(perShard(max_associations),
+                                   perShard(max_nonces))
+                       for _ in range(shards)]
+        self.locks = [threading.Lock() for _ in range(shards)]
+
+    def _shardFor(self, key):
+        index = hash(key) % len(self.shards)
+        return self.shards[index], self.locks[index]
+
+    def storeAssociation(self, server_url, assoc):
+        shard, lock = self._shardFor(server_url)
+        with lock:
+            shard.storeAssociation(server_url, assoc)
+
+    def getAssociation(self, server_url, handle=None):
+        shard, lock = self._shardFor(server_url)
+        with lock:
+            return shard.getAssociation(server_url, handle)
+
+    def removeAssociation(self, server_url, handle):
+        shard, lock = self._shardFor(server_url)
+        with lock:
+            return shard.removeAssociation(server_url, handle)
+
+    def useNonce(self, server_url, timestamp, salt):
+        shard, lock = self._shardFor((server_url, timestamp, salt))
+        with lock:
+            return shard.useNonce(server_url, timestamp, salt)
+
+    def cleanupNonces(self):
+        removed = 0
+        for shard, lock in zip(self.shards, self.locks):
+            with lock:
+                removed += shard.cleanupNonces()
+        return removed
+
+    def cleanupAssociations(self):
+        removed = 0
+        for shard, lock in zip(self.shards, self.locks):
+            with lock:
+                removed += shard.cleanupAssociations()
+        return removed
+
+    def iterAssociations(self, after=None):
+        """As C{L{MemoryStore.iterAssociations}}, over all shards."""
+        snapshots = []
+        for shard, lock in zip(self.shards, self.locks):
+            with lock:
+                snapshots.append(list(shard.iterAssociations(after)))
+        return heapq.merge(*snapshots,
+                           key=lambda item: (item[0], item[1].handle))
+
+    def getStats(self):
+        """Return the sum of C{L{MemoryStore.getStats}} over all shards.
+
+        @rtype: C{dict}
+        """
+        totals = collections.Counter()
+        for shard, lock in zip(self.shards, self.locks):
+            with lock:
+                totals.update(shard.getStats())
+        return dict(totals)
@@ -0,0 +1,269 @@
+"""
+This module copies the contents of one C{L{OpenIDStore}} into another,
+for moving to a different kind of store, and contains
+C{L{MigratingStore}}, for doing so without downtime.
+
+Stores that can be copied from have an C{iterAssociations} method, and
+an C{iterNonces} method if they keep nonces in a form that can be read
+back.  Of the bundled stores,
+C{L{MemoryStore<openid.store.memstore.MemoryStore>}},
+C{L{FileOpenIDStore<openid.store.filestore.FileOpenIDStore>}} and the
+C{L{SQLStore<openid.store.sqlstore.SQLStore>}}s can export
+associations, and only the C{L{SQLStore<openid.store.sqlstore.SQLStore>}}s
+can export nonces; the others keep only hashes of them.
+
+To move a live site from one store to another:
+
+  1. Make every process use a C{L{MigratingStore}} with the old store
+     and the new one.  New associations and nonces then go to the new
+     store, while those in the old store are still honoured.
+
+  2. Copy the associations (and nonces, where the old store can
+     export them) with a C{L{Migration}}, or the
+     C{contrib/migrate-store} script.
+
+  3. Once the C{L{MigratingStore}} has been in use for
+     C{L{nonce.SKEW}} seconds, every nonce the old store knows of has
+     expired.  Switch every process to the new store alone.
+"""
+
+import collections
+import concurrent.futures
+import json
+import logging
+import os
+import threading
+
+from openid.store.interface import OpenIDStore
+
+
+class MigratingStore(OpenIDStore):
+    """
+    An C{L{OpenIDStore}} for use while moving from an C{old} store to
+    a C{new} one.  Associations are stored in the new store, and looked
+    up in the new store and then the old one.  A nonce is only
+    accepted if neither store has seen it, and is recorded in both,
+    so that processes still using only the old store see it too.
+    Removals and cleanups go to both stores.
+
+    @ivar old: The store being moved from.
+    @type old: L{OpenIDStore}
+
+    @ivar new: The store being moved to.
+    @type new: L{OpenIDStore}
+    """
+
+    def __init__(self, old, new):
+        self.old = old
+        self.new = new
+
+    def storeAssociation(self, server_url, association):
+        self.new.storeAssociation(server_url, association)
+
+    def getAssociation(self, server_url, handle=None):
+        association = self.new.getAssociation(server_url, handle)
+        if association is None:
+            association = self.old.getAssociation(server_url, handle)
+        return association
+
+    def removeAssociation(self, server_url, handle):
+        removed_new = self.new.removeAssociation(server_url, handle)
+        removed_old = self.old.removeAssociation(server_url, handle)
+        return removed_new or removed_old
+
+    def useNonce(self, server_url, timestamp, salt):
+        if not self.new.useNonce(server_url, timestamp, salt):
+            return False
+        return self.old.useNonce(server_url, timestamp, salt)
+
+    def cleanupNonces(self):
+        # Nonces used through this store are in both, so count them
+        # once.
+        return max(self.new.cleanupNonces(), self.old.cleanupNonces())
+
+    def cleanupAssociations(self):
+        return self.new.cleanupAssociations() + self.old.cleanupAssociations()
+
+
+class Migration(object):
+    """
+    Copies the unexpired associations and nonces from a C{source}
+    store into a C{dest} store, in batches, holding no more than a few
+    batches in memory at once.
+
+    If given a C{state_file}, the migration records there how far it
+    has got after each batch, and a migration made later with the same
+    state file carries on from there.  Copying an item twice is
+    harmless, so a migration that was interrupted between writing a
+    batch and recording it does no damage when resumed.
+
+    With more than one worker, batches are written by that many
+    threads at once, so C{dest} must be safe to share between threads,
+    such as a C{L{FileOpenIDStore<openid.store.filestore.FileOpenIDStore>}}
+    or a pooled C{L{SQLStore<openid.store.sqlstore.SQLStore>}}.  Each
+    batch holds one server URL's associations, or part of them, so the
+    servers are copied in parallel.
+
+    Batches of associations are written with C{dest.storeAssociations}
+    and of nonces with C{dest.useNonces} where C{dest} has them, as
+    C{L{SQLStore<openid.store.sqlstore.SQLStore>}} does, so that each
+    batch is one transaction.
+
+    @ivar batch_size: The most items to copy in one batch.
+    @type batch_size: C{int}
+
+    @ivar workers: The number of threads writing batches.
+    @type workers: C{int}
+
+    @ivar progress: If not C{None}, called after each batch with the
+        kind of item (C{'associations'} or C{'nonces'}) and the number
+        copied so far.
+    """
+
+    def __init__(self, source, dest, batch_size=1000, state_file=None,
+                 workers=1, progress=None):
+        """
+        @param source: The store to copy from.  It must have an
+            C{iterAssociations} method.
+        @type source: L{OpenIDStore}
+
+        @param dest: The store to copy into.
+        @type dest: L{OpenIDStore}
+
+        @param state_file: The file to record progress in.
+        @type state_file: C{str} or C{NoneType}
+        """
+        if not hasattr(source, 'iterAssociations'):
+            raise ValueError('%r cannot export its associations' % (source,))
+
+        self.source = source
+        self.dest = dest
+        self.batch_size = batch_size
+        self.state_file = state_file
+        self.workers = workers
+        self.progress = progress
+        self._state_lock = threading.Lock()
+
+        self.state = {'associations': None, 'associations_done': False,
+                      'nonces': None, 'nonces_done': False,
+                      'copied': {'associations': 0, 'nonces': 0}}
+        if state_file is not None and os.path.exists(state_file):
+            with open(state_file) as f:
+                self.state.update(json.load(f))
+
+    def _saveState(self):
+        if self.state_file is None:
+            return
+        temp_name = self.state_file + '.tmp'
+        with open(temp_name, 'w') as f:
+            json.dump(self.state, f)
+        os.replace(temp_name, self.state_file)
+
+    def run(self):
+        """Copy everything not already copied.
+
+        @return: The number of associations and nonces copied, over
+            every run with the same state file.  The nonce count is
+            C{None} if the source cannot export nonces.
+        @rtype: (C{int}, C{int} or C{NoneType})
+        """
+        if not self.state['associations_done']:
+            after = self.state['associations']
+            if after is not None:
+                after = tuple(after)
+            self._copy('associations',
+                       self.source.iterAssociations(after),
+                       self._writeAssociations,
+                       lambda item: [item[0], item[1].handle],
+                       lambda item: item[0])
+
+        if not hasattr(self.source, 'iterNonces'):
+            logging.warning('%r cannot export its nonces; keep using the '
+                            'old store alongside the new one for nonce.SKEW '
+                            'seconds', self.source)
+            return self.state['copied']['associations'], None
+
+        if not self.state['nonces_done']:
+            after = self.state['nonces']
+            if after is not None:
+                after = tuple(after)
+            self._copy('nonces', self.source.iterNonces(after),
+                       self._writeNonces,
+                       lambda item: [item[1], item[0], item[2]],
+                       None)
+
+        copied = self.state['copied']
+        return copied['associations'], copied['nonces']
+
+    def _writeAssociations(self, batch):
+        store_many = getattr(self.dest, 'storeAssociations', None)
+        if store_many is not None:
+            store_many(batch)
+        else:
+            for server_url, association in batch:
+                self.dest.storeAssociation(server_url, association)
+
+    def _writeNonces(self, batch):
+        use_many = getattr(self.dest, 'useNonces', None)
+        if use_many is not None:
+            use_many(batch)
+        else:
+            for server_url, timestamp, salt in batch:
+                self.dest.useNonce(server_url, timestamp, salt)
+
+    def _batches(self, items, group_key):
+        """Split items into batches of at most batch_size, starting a
+        new batch at each change of group_key when there are several
+        workers."""
+        batch = []
+        group = None
+        for item in items:
+            if batch and (len(batch) >= self.batch_size or (
+                    group_key is not None and self.workers > 1 and
+                    group_key(item) != group)):
+                yield batch
+                batch = []
+            batch.append(item)
+            if group_key is not None:
+                group = group_key(item)
+        if batch:
+            yield batch
+
+    def _copy(self, kind, items, write, position, group_key):
+        # Batches in flight, oldest first, with the position of their
+        # last item.  Progress is recorded up to the oldest unfinished
+        # batch, so that resuming never skips one.
+        in_flight = collections.deque()
+
+        def finish(future, last):
+            future.result()
+            with self._state_lock:
+                self.state[kind] = last
+                self._saveState()
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.workers) as executor:
+            for batch in self._batches(items, group_key):
+                while len(in_flight) >= 2 * self.workers:
+                    finish(*in_flight.popleft())
+                future = executor.submit(write, batch)
+                future.count = len(batch)
+                future.add_done_callback(self._counter(kind))
+                in_flight.append((future, position(batch[-1])))
+
+            while in_flight:
+                finish(*in_flight.popleft())
+
+        with self._state_lock:
+            self.state[kind + '_done'] = True
+            self._saveState()
+
+    def _counter(self, kind):
+        def count(future):
+            if future.exception() is None:
+                with self._state_lock:
+                    self.state['copied'][kind] += future.count
+                    copied = self.state['copied'][kind]
+                if self.progress is not None:
+                    self.progress(kind, copied)
+        return count
@@ -0,0 +1,294 @@
+"""
+This module contains an C{L{OpenIDStore}} implementation that keeps
+nonces in a single memory-mapped hash table file, shared between the
+processes on one host.  Associations are handed to another store.
+
+This module needs C{fcntl}, so it is only available on POSIX systems.
+
+Example of using it for nonces, with associations kept in a
+C{L{FileOpenIDStore<openid.store.filestore.FileOpenIDStore>}}::
+
+    from openid.store.filestore import FileOpenIDStore
+    from openid.store.mmapstore import MmapNonceStore
+
+    store = MmapNonceStore('/var/lib/openid/nonces.tbl',
+                           FileOpenIDStore('/var/lib/openid'))
+"""
+
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+
+from openid import cryptutil
+from openid.store.interface import OpenIDStore
+from openid.store.memstore import MemoryStore
+from openid.store import nonce
+
+# File header: magic, format version, number of slots
+_header = struct.Struct('>8sII')
+_MAGIC = b'OIDNONCE'
+_VERSION = 1
+
+# Slot: nonce timestamp (0 for an empty slot), SHA1 of the server URL
+# and salt, and padding to 32 bytes.
+_slot = struct.Struct('>q20s4x')
+_stamp = struct.Struct('>q')
+_EMPTY_SLOT = bytes(_slot.size)
+
+# Multiplier used to mix the timestamp into the slot index
+_STAMP_MIX = 0x9E3779B97F4A7C15
+
+
+class _TableFull(Exception):
+    """Raised internally when there is no free slot for a nonce."""
+
+
+class MmapNonceStore(OpenIDStore):
+    """
+    An C{L{OpenIDStore}} that keeps nonces in an open-addressing hash
+    table in a memory-mapped file.  Using a nonce touches a handful of
+    slots in the table rather than creating a file, and the table can
+    be shared by any number of processes on the same host.
+
+    Each slot holds a nonce's timestamp and a SHA1 digest of its
+    server URL and salt.  Nonces outside of L{nonce.SKEW} are deleted
+    as they are found while probing, by shifting the nonces after
+    them back, so the table does not fill up with dead slots even if
+    C{L{cleanupNonces}} is never called; that method deletes every
+    expired nonce the same way.  If the table has no free slot left,
+    new nonces are refused (C{L{useNonce}} returns C{False}) rather
+    than forgetting a current one, so size the table for at least
+    twice the number of nonces you expect to see in 2 * C{nonce.SKEW}
+    seconds.
+
+    Processes take an C{fcntl} lock on the file for each operation,
+    and threads within a process share a lock as well.
+
+    Association methods are passed through to C{association_store}.
+
+    @ivar filename: The hash table file.
+    @type filename: C{str}
+
+    @ivar slots: The number of slots in the hash table.
+    @type slots: C{int}
+
+    @ivar association_store: The store used for associations.
+    @type association_store: L{OpenIDStore}
+    """
+
+    def __init__(self, filename, association_store=None, slots=2 ** 18):
+        """
+        Open the hash table in filename, creating it with the given
+        number of slots if it does not exist yet.
+
+        @param filename: The file to keep the hash table in.
+        @type filename: C{str}
+
+        @param association_store: The store to keep associations in.
+            If none is given, associations are kept in a
+            L{MemoryStore<openid.store.memstore.MemoryStore>}, which
+            is not shared between processes.
+        @type association_store: L{OpenIDStore} or C{NoneType}
+
+        @param slots: The number of slots to create the table with.
+            Each slot takes 32 bytes.  Ignored if the file exists.
+        @type slots: C{int}
+        """
+        if association_store is None:
+            association_store = MemoryStore()
+
+        self.filename = filename
+        self.association_store = association_store
+        self._thread_lock = threading.Lock()
+
+        fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(fd).st_size == 0:
+                    os.ftruncate(fd, _header.size + slots * _slot.size)
+                    os.pwrite(fd, _header.pack(_MAGIC, _VERSION, slots), 0)
+                self._map = mmap.mmap(fd, 0)
+            finally:
+                fcntl.lockf(fd, fcntl.LOCK_UN)
+        except:
+            os.close(fd)
+            raise
+        self._fd = fd
+
+        magic, version, self.slots = _header.unpack_from(self._map, 0)
+        if magic != _MAGIC or version != _VERSION:
+            self.close()
+            raise ValueError('%r is not a nonce table' % (filename,))
+        if len(self._map) != _header.size + self.slots * _slot.size:
+            self.close()
+            raise ValueError('Nonce table %r is truncated' % (filename,))
+
+    def close(self):
+        """Unmap and close the hash table file."""
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+            os.close(self._fd)
+
+    def _lock(self):
+        self._thread_lock.acquire()
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+        except:
+            self._thread_lock.release()
+            raise
+
+    def _unlock(self):
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN)
+        finally:
+            self._thread_lock.release()
+
+    def _digest(self, server_url, salt):
+        return cryptutil.sha1(
+            '%d:%s%s' % (len(server_url), server_url, salt))
+
+    def _offset(self, index):
+        return _header.size + index * _slot.size
+
+    def _home(self, timestamp, digest):
+        """Return the slot a nonce's probe sequence starts at."""
+        return ((int.from_bytes(digest[:8], 'big') ^
+                 (timestamp * _STAMP_MIX)) % self.slots)
+
+    def _delete(self, index):
+        """Empty a slot, moving the nonces after it in its run back so
+        that every nonce can still be found from its home slot.
+
+        A nonce is copied into the hole before its old slot becomes
+        the next hole, and only the last hole is emptied, so a process
+        that dies part way through leaves at worst a nonce in two
+        slots, never one that cannot be found."""
+        mm = self._map
+        slots = self.slots
+        hole = index
+        while True:
+            index = (index + 1) % slots
+            if index == hole:
+                break
+            offset = self._offset(index)
+            stamp, digest = _slot.unpack_from(mm, offset)
+            if stamp == 0:
+                break
+
+            # A nonce may move into the hole unless its home slot lies
+            # cyclically in (hole, index].
+            home = self._home(stamp, digest)
+            if hole <= index:
+                stays = hole < home <= index
+            else:
+                stays = home > hole or home <= index
+            if not stays:
+                mm[self._offset(hole):self._offset(hole) + _slot.size] = (
+                    mm[offset:offset + _slot.size])
+                hole = index
+        mm[self._offset(hole):self._offset(hole) + _slot.size] = _EMPTY_SLOT
+
+    def _insert(self, timestamp, digest, oldest_allowed, newest_allowed):
+        """Add a nonce to the table, deleting the expired nonces met
+        on the way.
+
+        @return: C{False} if the nonce is already in the table,
+            C{True} if it was added.
+
+        @raises _TableFull: if there is no slot left for the nonce.
+        """
+        mm = self._map
+        slots = self.slots
+        index = self._home(timestamp, digest)
+
+        probed = 0
+        while probed < slots:
+            offset = self._offset(index)
+            stamp, slot_digest = _slot.unpack_from(mm, offset)
+            if stamp == 0:
+                # End of the probe sequence; the nonce is not present.
+                _slot.pack_into(mm, offset, timestamp, digest)
+                return True
+            elif stamp == timestamp and slot_digest == digest:
+                return False
+            elif not oldest_allowed <= stamp <= newest_allowed:
+                # An expired nonce.  Deleting it may move a later
+                # nonce into this slot, so look at it again.
+                self._delete(index)
+                continue
+            index = (index + 1) % slots
+            probed += 1
+
+        raise _TableFull()
+
+    def useNonce(self, server_url, timestamp, salt):
+        now = time.time()
+        if abs(timestamp - now) > nonce.SKEW:
+            return False
+
+        digest = self._digest(str(server_url), str(salt))
+        self._lock()
+        try:
+            return self._insert(int(timestamp), digest,
+                                now - nonce.SKEW, now + nonce.SKEW)
+        except _TableFull:
+            return False
+        finally:
+            self._unlock()
+
+    def cleanupNonces(self):
+        """Delete every expired nonce from the hash table, in place.
+
+        @return: the number of nonces expired.
+        @returntype: int
+        """
+        now = time.time()
+        oldest_allowed = now - nonce.SKEW
+        newest_allowed = now + nonce.SKEW
+        mm = self._map
+        slots = self.slots
+
+        self._lock()
+        try:
+            # Start the sweep just after an empty slot, so that no run
+            # of nonces wraps around past it.  Deleting a nonce only
+            # moves nonces from later in its run back into the slot
+            # being looked at, so look at that slot again.
+            start = 0
+            for index in range(slots):
+                (stamp,) = _stamp.unpack_from(mm, self._offset(index))
+                if stamp == 0:
+                    start = index
+                    break
+
+            removed = 0
+            for step in range(1, slots + 1):
+                index = (start + step) % slots
+                offset = self._offset(index)
+                while True:
+                    (stamp,) = _stamp.unpack_from(mm, offset)
+                    if stamp == 0 or oldest_allowed <= stamp <= newest_allowed:
+                        break
+                    self._delete(index)
+                    removed += 1
+            return removed
+        finally:
+            self._unlock()
+
+    def storeAssociation(self, server_url, association):
+        return self.association_store.storeAssociation(
+            server_url, association)
+
+    def getAssociation(self, server_url, handle=None):
+        return self.association_store.getAssociation(server_url, handle)
+
+    def removeAssociation(self, server_url, handle):
+        return self.association_store.removeAssociation(server_url, handle)
+
+    def cleanupAssociations(self):
+        return self.association_store.cleanupAssociations()
@@ -7,7 +7,11 @@ Example of how to initialize a store database::
 python -c 'from openid.store import sqlstore; import pysqlite2.dbapi2;'
   'sqlstore.SQLiteStore(pysqlite2.dbapi2.connect("cstore.db")).createTables()'
 """
+import logging
+import os
+import queue
 import re
+import threading
 import time
 
 try:
@@ -21,6 +25,10 @@ from openid.store.interface import OpenIDStore
 from openid.store import nonce
 
 
+# Matches the start timestamp at the end of a nonce partition's name
+_partition_suffix = re.compile(r'_p(\d+)$')
+
+
 def _inTxn(func):
     def wrapped(self, *args, **kwargs):
         return self._callInTransaction(func, self, *args, **kwargs)
@@ -37,6 +45,100 @@ def _inTxn(func):
     return wrapped
 
 
+class _ConnectionPool(object):
+    """A bounded pool of (connection, cursor) pairs, created on demand
+    by a connection factory."""
+
+    def __init__(self, factory, size, timeout):
+        self.factory = factory
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._pid = os.getpid()
+        # Connections inherited across a fork.  They are kept, unused,
+        # rather than closed, since closing them in the child could
+        # disturb the parent's use of them (SQLite's locks, for one).
+        self._inherited = []
+
+    def _checkFork(self):
+        """Start afresh in a child process, so that no connection is
+        ever used by two processes."""
+        if self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid != os.getpid():
+                while True:
+                    try:
+                        self._inherited.append(self._idle.get_nowait())
+                    except queue.Empty:
+                        break
+                self._created = 0
+                self._pid = os.getpid()
+
+    def add(self, conn):
+        """Put a connection made outside of the pool into it."""
+        with self._lock:
+            self._created += 1
+        self._idle.put((conn, conn.cursor()))
+
+    def acquire(self):
+        self._checkFork()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            create = self._created < self.size
+            if create:
+                self._created += 1
+
+        if create:
+            try:
+                conn = self.factory()
+                return conn, conn.cursor()
+            except:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise RuntimeError('No database connection became free '
+                               'within %s seconds' % (self.timeout,))
+
+    def release(self, entry):
+        if self._pid != os.getpid():
+            # Taken from the pool before a fork.
+            self._inherited.append(entry)
+            return
+        self._idle.put(entry)
+
+    def discard(self, entry):
+        """Throw away a connection that is no longer usable."""
+        conn, cur = entry
+        with self._lock:
+            self._created -= 1
+        try:
+            cur.close()
+            conn.close()
+        except Exception:
+            pass
+
+    def close(self):
+        """Close all of the idle connections."""
+        while True:
+            try:
+                entry = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self.discard(entry)
+
+
 class SQLStore(OpenIDStore):
     """
     This is the parent class for the SQL stores, which contains the
@@ -50,6 +152,11 @@ class SQLStore(OpenIDStore):
     To create the tables with the proper schema, see the
     C{L{createTables}} method.
 
+    A store made with a single connection must not be used by more
+    than one thread at a time.  To share a store between threads, give
+    it a C{connection_factory} instead; it will then keep a pool of up
+    to C{pool_size} connections, each used by one thread at a time.
+
     This class shouldn't be used directly.  Use one of its subclasses
     instead, as those contain the code necessary to use a specific
     database.
@@ -71,11 +178,12 @@ class SQLStore(OpenIDStore):
     associations_table = 'oid_associations'
     nonces_table = 'oid_nonces'
 
-    def __init__(self, conn, associations_table=None, nonces_table=None):
+    def __init__(self, conn=None, associations_table=None, nonces_table=None,
+                 connection_factory=None, pool_size=10, pool_timeout=30):
         """
-        This creates a new SQLStore instance.  It requires an
-        established database connection be given to it, and it allows
-        overriding the default table names.
+        This creates a new SQLStore instance.  It requires either an
+        established database connection or a function that makes
+        them, and it allows overriding the default table names.
 
 
         @param conn: This must be an established connection to a
@@ -99,9 +207,48 @@ class SQLStore(OpenIDStore):
             default value is specified in C{L{SQLStore.nonces_table}}.
 
         @type nonces_table: C{str}
+
+
+        @param connection_factory: A function taking no arguments that
+            returns a new connection, for use instead of C{conn}.  The
+            connections it makes will be used from whichever thread
+            is using the store, so for SQLite they must be made with
+            C{check_same_thread=False}.
+
+        @type connection_factory: callable
+
+
+        @param pool_size: The most connections to open with
+            C{connection_factory}.
+
+        @type pool_size: C{int}
+
+
+        @param pool_timeout: How many seconds to wait for a connection
+            when all C{pool_size} of them are in use, before raising
+            C{RuntimeError}.
+
+        @type pool_timeout: C{float}
         """
-        self.conn = conn
-        self.cur = None
+        if (conn is None) == (connection_factory is None):
+            raise ValueError('Exactly one of conn and connection_factory '
+                             'must be given')
+
+        # The connection and cursor in use by each thread
+        self._local = threading.local()
+
+        if connection_factory is None:
+            self._pool = None
+            self._conn = conn
+        else:
+            self._pool = _ConnectionPool(
+                connection_factory, pool_size, pool_timeout)
+            self._conn = None
+            # Check the first connection's exception classes below,
+            # and keep it for the pool.
+            conn = connection_factory()
+            self._pool.add(conn)
+
         self._statement_cache = {}
         self._table_names = {
             'associations': associations_table or self.associations_table,
@@ -112,15 +259,44 @@ class SQLStore(OpenIDStore):
         # DB API extension: search for "Connection Attributes .Error,
         # .ProgrammingError, etc." in
         # http://www.python.org/dev/peps/pep-0249/
-        if (hasattr(self.conn, 'IntegrityError') and
-            hasattr(self.conn, 'OperationalError')):
-            self.exceptions = self.conn
+        if (hasattr(conn, 'IntegrityError') and
+            hasattr(conn, 'OperationalError')):
+            self.exceptions = conn
 
         if not (hasattr(self.exceptions, 'IntegrityError') and
                 hasattr(self.exceptions, 'OperationalError')):
             raise RuntimeError("Error using database connection module "
                                "(Maybe it can't be imported?)")
 
+    @property
+    def conn(self):
+        """The connection given to the store, or in pooled mode the
+        connection in use by the current thread's transaction."""
+        if self._pool is None:
+            return self._conn
+        return getattr(self._local, 'conn', None)
+
+    @conn.setter
+    def conn(self, conn):
+        if self._pool is not None:
+            raise AttributeError('Cannot set conn on a pooled store')
+        self._conn = conn
+
+    @property
+    def cur(self):
+        """The cursor of the current thread's transaction."""
+        return getattr(self._local, 'cur', None)
+
+    @cur.setter
+    def cur(self, cur):
+        self._local.cur = cur
+
+    def close(self):
+        """Close the pooled connections that are not in use.  Does
+        nothing for a store made with a single connection."""
+        if self._pool is not None:
+            self._pool.close()
+
     def blobDecode(self, blob):
         """Convert a blob as returned by the SQL engine into a str object.
 
@@ -132,6 +308,11 @@ class SQLStore(OpenIDStore):
         in the database as a blob."""
         return s
 
+    def saltDecode(self, salt):
+        """Convert a nonce salt as returned by the SQL engine into the
+        str it was stored as."""
+        return salt
+
     def _getSQL(self, sql_name):
         try:
             return self._statement_cache[sql_name]
@@ -172,6 +353,9 @@ class SQLStore(OpenIDStore):
         """Execute the given function inside of a transaction, with an
         open cursor. If no exception is raised, the transaction is
         comitted, otherwise it is rolled back."""
+        if self._pool is not None:
+            return self._callInPooledTransaction(func, *args, **kwargs)
+
         # No nesting of transactions
         self.conn.rollback()
 
@@ -190,6 +374,36 @@ class SQLStore(OpenIDStore):
 
         return ret
 
+    def _callInPooledTransaction(self, func, *args, **kwargs):
+        """Like _callInTransaction, using a connection from the pool.
+
+        Connections go back to the pool committed or rolled back, and
+        one that can be neither is thrown away, so there is no need to
+        roll back before starting."""
+        entry = self._pool.acquire()
+        conn, cur = entry
+        self._local.conn = conn
+        self._local.cur = cur
+        try:
+            try:
+                ret = func(*args, **kwargs)
+                conn.commit()
+            except:
+                try:
+                    conn.rollback()
+                except Exception:
+                    # The connection is broken; don't hand it out again.
+                    self._pool.discard(entry)
+                    entry = None
+                raise
+        finally:
+            self._local.conn = None
+            self._local.cur = None
+            if entry is not None:
+                self._pool.release(entry)
+
+        return ret
+
     def txn_createTables(self):
         """
         This method creates the database tables necessary for this
@@ -198,9 +412,21 @@ class SQLStore(OpenIDStore):
         """
         self.db_create_nonce()
         self.db_create_assoc()
+        self.txn_createIndexes()
 
     createTables = _inTxn(txn_createTables)
 
+    def txn_createIndexes(self):
+        """
+        This method creates the indexes used to find the newest
+        association for a server.  C{L{createTables}} creates them
+        too; call this to add them to tables created by earlier
+        versions of this library.
+        """
+        self.db_create_assoc_index()
+
+    createIndexes = _inTxn(txn_createIndexes)
+
     def txn_storeAssociation(self, server_url, association):
         """Set the association for the server URL.
 
@@ -221,13 +447,22 @@ class SQLStore(OpenIDStore):
         """Get the most recent association that has been set for this
         server URL and handle.
 
+        If no handle is given, the newest unexpired association is
+        picked by the database.  Expired associations are left for
+        C{L{cleanupAssociations}}.
+
         str -> NoneType or Association
         """
-        if handle is not None:
-            self.db_get_assoc(server_url, handle)
-        else:
-            self.db_get_assocs(server_url)
+        if handle is None:
+            self.db_get_newest_assoc(server_url, int(time.time()))
+            row = self.cur.fetchone()
+            if row is None:
+                return None
+            values = list(row)
+            values[1] = self.blobDecode(values[1])
+            return Association(*values)
 
+        self.db_get_assoc(server_url, handle)
         rows = self.cur.fetchall()
         if len(rows) == 0:
             return None
@@ -280,6 +515,26 @@ class SQLStore(OpenIDStore):
 
     useNonce = _inTxn(txn_useNonce)
 
+    def txn_useNonces(self, nonces):
+        """Use several nonces in one transaction, each as
+        C{L{useNonce}} would.
+
+        [(str, int, str)] -> [bool]
+        """
+        now = time.time()
+        results = []
+        for server_url, timestamp, salt in nonces:
+            if abs(timestamp - now) > nonce.SKEW:
+                results.append(False)
+            else:
+                # Inserts that ignore duplicates, so that one used
+                # nonce does not abort the whole transaction.
+                self.db_add_nonce_ignore(server_url, timestamp, salt)
+                results.append(self.cur.rowcount == 1)
+        return results
+
+    useNonces = _inTxn(txn_useNonces)
+
     def txn_cleanupNonces(self):
         self.db_clean_nonce(int(time.time()) - nonce.SKEW)
         return self.cur.rowcount
@@ -292,17 +547,232 @@ class SQLStore(OpenIDStore):
 
     cleanupAssociations = _inTxn(txn_cleanupAssociations)
 
+    def txn_cleanupNoncesBatch(self, limit):
+        """Remove up to limit expired nonces.
+
+        int -> int
+        """
+        self.db_clean_nonce_batch(int(time.time()) - nonce.SKEW, limit)
+        return self.cur.rowcount
+
+    cleanupNoncesBatch = _inTxn(txn_cleanupNoncesBatch)
+
+    def txn_cleanupAssociationsBatch(self, limit):
+        """Remove up to limit expired associations.
+
+        int -> int
+        """
+        self.db_clean_assoc_batch(int(time.time()), limit)
+        return self.cur.rowcount
+
+    cleanupAssociationsBatch = _inTxn(txn_cleanupAssociationsBatch)
+
+    def txn_storeAssociations(self, associations):
+        """Store several associations in one transaction.
+
+        [(str, Association)] -> NoneType
+        """
+        for server_url, association in associations:
+            self.txn_storeAssociation(server_url, association)
+
+    storeAssociations = _inTxn(txn_storeAssociations)
+
+    def txn_exportAssociations(self, after, limit):
+        """Return up to limit associations, expired or not, with their
+        server URLs, in order of server URL and handle, starting after
+        the given (server URL, handle) pair if there is one.
+
+        ((str, str) or NoneType, int) -> [(str, Association)]
+        """
+        if after is None:
+            self.db_export_assocs(limit)
+        else:
+            self.db_export_assocs_after(after[0], after[0], after[1], limit)
+
+        associations = []
+        for (server_url, handle, secret, issued, lifetime,
+             assoc_type) in self.cur.fetchall():
+            if isinstance(server_url, bytes):
+                server_url = server_url.decode('utf-8')
+            associations.append((server_url, Association(
+                handle, self.blobDecode(secret), issued, lifetime,
+                assoc_type)))
+        return associations
+
+    exportAssociations = _inTxn(txn_exportAssociations)
+
+    def txn_exportNonces(self, after, limit):
+        """Return up to limit unexpired nonces, in order of timestamp,
+        server URL and salt, starting after the given (timestamp,
+        server URL, salt) triple if there is one.
+
+        ((int, str, str) or NoneType, int) -> [(str, int, str)]
+        """
+        oldest = int(time.time()) - nonce.SKEW
+        if after is None:
+            self.db_export_nonces(oldest, limit)
+        else:
+            timestamp, server_url, salt = after
+            self.db_export_nonces_after(oldest, timestamp, timestamp,
+                                        server_url, server_url, salt, limit)
+
+        nonces = []
+        for server_url, timestamp, salt in self.cur.fetchall():
+            if isinstance(server_url, bytes):
+                server_url = server_url.decode('utf-8')
+            nonces.append((server_url, timestamp, self.saltDecode(salt)))
+        return nonces
+
+    exportNonces = _inTxn(txn_exportNonces)
+
+    def iterAssociations(self, after=None, batch_size=1000):
+        """Yield the unexpired associations in the store with their
+        server URLs, in order of server URL and handle, reading
+        batch_size rows at a time, each batch in its own transaction.
+
+        @param after: A (server URL, handle) pair; only associations
+            after it are yielded.
+
+        ((str, str) or NoneType, int) -> iter((str, Association))
+        """
+        while True:
+            associations = self.exportAssociations(after, batch_size)
+            for server_url, association in associations:
+                if association.expiresIn > 0:
+                    yield server_url, association
+            if len(associations) < batch_size:
+                return
+            server_url, association = associations[-1]
+            after = (server_url, association.handle)
+
+    def iterNonces(self, after=None, batch_size=1000):
+        """Yield the unexpired nonces in the store as (server URL,
+        timestamp, salt) triples, in order of timestamp, server URL and
+        salt, reading batch_size rows at a time, each batch in its own
+        transaction.
+
+        @param after: A (timestamp, server URL, salt) triple; only
+            nonces after it are yielded.
+
+        ((int, str, str) or NoneType, int) -> iter((str, int, str))
+        """
+        while True:
+            nonces = self.exportNonces(after, batch_size)
+            for entry in nonces:
+                yield entry
+            if len(nonces) < batch_size:
+                return
+            server_url, timestamp, salt = nonces[-1]
+            after = (timestamp, server_url, salt)
+
 
 class SQLiteStore(SQLStore):
     """
     This is an SQLite-based specialization of C{L{SQLStore}}.
 
-    To create an instance, see C{L{SQLStore.__init__}}.  To create the
-    tables it will use, see C{L{SQLStore.createTables}}.
+    To create an instance, see C{L{SQLStore.__init__}}, or
+    C{L{concurrent}} for a database file shared by many threads and
+    processes.  To create the tables it will use, see
+    C{L{SQLStore.createTables}}.
 
     All other methods are implementation details.
+
+    @cvar synchronous_levels: The values C{L{concurrent}} accepts for
+        its C{synchronous} argument.
     """
 
+    synchronous_levels = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+    def __init__(self, *args, without_rowid=False, **kwargs):
+        """
+        Create a new SQLiteStore.  The arguments are as for
+        C{L{SQLStore.__init__}}, with one more.
+
+        @param without_rowid: Whether C{L{createTables}} should make
+            the nonces table a C{WITHOUT ROWID} table, clustered on
+            its primary key, so that each nonce is stored once rather
+            than in both a table and an index.
+
+        @type without_rowid: C{bool}
+        """
+        SQLStore.__init__(self, *args, **kwargs)
+        self.without_rowid = without_rowid
+
+    @classmethod
+    def concurrent(cls, filename, synchronous='NORMAL', busy_timeout=30,
+                   pool_size=10, pool_timeout=30, **kwargs):
+        """
+        Make a store for an SQLite database file that is used by many
+        threads or processes at once, such as the workers of a
+        pre-forking server.
+
+        The store keeps a pool of connections, each set up with
+
+          - C{journal_mode=WAL}, so that readers do not block the
+            writer or each other,
+
+          - the given C{synchronous} level; C{NORMAL} only syncs at
+            WAL checkpoints, which in WAL mode keeps the database
+            consistent but may lose the last transactions on power
+            loss,
+
+          - a busy timeout, so that writers queue for the lock
+            instead of failing with "database is locked", and
+
+          - C{BEGIN IMMEDIATE} transactions, which take the write
+            lock when they begin.  The C{sqlite3} module only begins
+            a transaction at the first statement that changes the
+            database, so reads made before it, such as the expiry
+            check in C{L{getAssociation}}, run outside of the
+            transaction; the tables' uniqueness constraints keep
+            concurrent writes consistent.
+
+        Its nonces table is created C{WITHOUT ROWID}.  A child process
+        does not use the connections it inherits, so the store may be
+        made before forking.
+
+        @param filename: The database file.
+        @type filename: C{str}
+
+        @param synchronous: One of C{L{synchronous_levels}}.
+        @type synchronous: C{str}
+
+        @param busy_timeout: How many seconds to wait for another
+            connection's lock before giving up.
+        @type busy_timeout: C{float}
+
+        @param pool_size: As for C{L{SQLStore.__init__}}.
+        @param pool_timeout: As for C{L{SQLStore.__init__}}.
+
+        @param kwargs: Passed on to C{L{__init__}}, for example to set
+            the table names.
+
+        @rtype: C{L{SQLiteStore}}
+        """
+        import sqlite3
+
+        synchronous = synchronous.upper()
+        if synchronous not in cls.synchronous_levels:
+            raise ValueError('Unknown synchronous level %r' % (synchronous,))
+
+        def connect():
+            conn = sqlite3.connect(filename, timeout=busy_timeout,
+                                   isolation_level='IMMEDIATE',
+                                   check_same_thread=False)
+            try:
+                conn.execute('PRAGMA busy_timeout = %d'
+                             % (busy_timeout * 1000,))
+                conn.execute('PRAGMA journal_mode = WAL')
+                conn.execute('PRAGMA synchronous = %s' % (synchronous,))
+            except:
+                conn.close()
+                raise
+            return conn
+
+        kwargs.setdefault('without_rowid', True)
+        return cls(connection_factory=connect, pool_size=pool_size,
+                   pool_timeout=pool_timeout, **kwargs)
+
     create_nonce_sql = """
     CREATE TABLE %(nonces)s (
         server_url VARCHAR,
@@ -312,6 +782,15 @@ class SQLiteStore(SQLStore):
     );
     """
 
+    create_nonce_without_rowid_sql = """
+    CREATE TABLE %(nonces)s (
+        server_url VARCHAR NOT NULL,
+        timestamp INTEGER NOT NULL,
+        salt CHAR(40) NOT NULL,
+        PRIMARY KEY (server_url, timestamp, salt)
+    ) WITHOUT ROWID;
+    """
+
     create_assoc_sql = """
     CREATE TABLE %(associations)s
     (
@@ -325,28 +804,67 @@ class SQLiteStore(SQLStore):
     );
     """
 
+    create_assoc_index_sql = (
+        'CREATE INDEX %(associations)s_server_issued '
+        'ON %(associations)s (server_url, issued);')
+
     set_assoc_sql = ('INSERT OR REPLACE INTO %(associations)s '
                      '(server_url, handle, secret, issued, '
                      'lifetime, assoc_type) '
                      'VALUES (?, ?, ?, ?, ?, ?);')
-    get_assocs_sql = ('SELECT handle, secret, issued, lifetime, assoc_type '
-                      'FROM %(associations)s WHERE server_url = ?;')
     get_assoc_sql = (
         'SELECT handle, secret, issued, lifetime, assoc_type '
         'FROM %(associations)s WHERE server_url = ? AND handle = ?;')
-
-    get_expired_sql = ('SELECT server_url '
-                       'FROM %(associations)s WHERE issued + lifetime < ?;')
+    get_newest_assoc_sql = (
+        'SELECT handle, secret, issued, lifetime, assoc_type '
+        'FROM %(associations)s WHERE server_url = ? AND issued + lifetime > ? '
+        'ORDER BY issued DESC LIMIT 1;')
 
     remove_assoc_sql = ('DELETE FROM %(associations)s '
                         'WHERE server_url = ? AND handle = ?;')
 
     clean_assoc_sql = 'DELETE FROM %(associations)s WHERE issued + lifetime < ?;'
 
+    clean_assoc_batch_sql = (
+        'DELETE FROM %(associations)s WHERE (server_url, handle) IN '
+        '(SELECT server_url, handle FROM %(associations)s '
+        'WHERE issued + lifetime < ? LIMIT ?);')
+
     add_nonce_sql = 'INSERT INTO %(nonces)s VALUES (?, ?, ?);'
 
+    add_nonce_ignore_sql = 'INSERT OR IGNORE INTO %(nonces)s VALUES (?, ?, ?);'
+
+    export_assocs_sql = (
+        'SELECT server_url, handle, secret, issued, lifetime, assoc_type '
+        'FROM %(associations)s ORDER BY server_url, handle LIMIT ?;')
+    export_assocs_after_sql = (
+        'SELECT server_url, handle, secret, issued, lifetime, assoc_type '
+        'FROM %(associations)s '
+        'WHERE server_url > ? OR (server_url = ? AND handle > ?) '
+        'ORDER BY server_url, handle LIMIT ?;')
+
+    export_nonces_sql = (
+        'SELECT server_url, timestamp, salt FROM %(nonces)s '
+        'WHERE timestamp >= ? ORDER BY timestamp, server_url, salt '
+        'LIMIT ?;')
+    export_nonces_after_sql = (
+        'SELECT server_url, timestamp, salt FROM %(nonces)s '
+        'WHERE timestamp >= ? AND (timestamp > ? OR (timestamp = ? AND '
+        '(server_url > ? OR (server_url = ? AND salt > ?)))) '
+        'ORDER BY timestamp, server_url, salt LIMIT ?;')
+
     clean_nonce_sql = 'DELETE FROM %(nonces)s WHERE timestamp < ?;'
 
+    clean_nonce_batch_sql = (
+        'DELETE FROM %(nonces)s WHERE (server_url, timestamp, salt) IN '
+        '(SELECT server_url, timestamp, salt FROM %(nonces)s '
+        'WHERE timestamp < ? LIMIT ?);')
+
+    def db_create_nonce(self):
+        if self.without_rowid:
+            return self._execSQL('create_nonce_without_rowid_sql')
+        return self._execSQL('create_nonce_sql')
+
     def blobEncode(self, s):
         return memoryview(s)
 
@@ -403,37 +921,107 @@ class MySQLStore(SQLStore):
     ENGINE=InnoDB;
     """
 
+    create_assoc_index_sql = (
+        'CREATE INDEX %(associations)s_server_issued '
+        'ON %(associations)s (server_url(255), issued);')
+
     set_assoc_sql = ('REPLACE INTO %(associations)s '
                      'VALUES (%%s, %%s, %%s, %%s, %%s, %%s);')
-    get_assocs_sql = ('SELECT handle, secret, issued, lifetime, assoc_type'
-                      ' FROM %(associations)s WHERE server_url = %%s;')
-    get_expired_sql = ('SELECT server_url '
-                       'FROM %(associations)s WHERE issued + lifetime < %%s;')
-
     get_assoc_sql = (
         'SELECT handle, secret, issued, lifetime, assoc_type'
         ' FROM %(associations)s WHERE server_url = %%s AND handle = %%s;')
+    get_newest_assoc_sql = (
+        'SELECT handle, secret, issued, lifetime, assoc_type'
+        ' FROM %(associations)s'
+        ' WHERE server_url = %%s AND issued + lifetime > %%s'
+        ' ORDER BY issued DESC LIMIT 1;')
     remove_assoc_sql = ('DELETE FROM %(associations)s '
                         'WHERE server_url = %%s AND handle = %%s;')
 
     clean_assoc_sql = 'DELETE FROM %(associations)s WHERE issued + lifetime < %%s;'
 
+    clean_assoc_batch_sql = ('DELETE FROM %(associations)s '
+                             'WHERE issued + lifetime < %%s LIMIT %%s;')
+
     add_nonce_sql = 'INSERT INTO %(nonces)s VALUES (%%s, %%s, %%s);'
 
+    add_nonce_ignore_sql = (
+        'INSERT IGNORE INTO %(nonces)s VALUES (%%s, %%s, %%s);')
+
+    export_assocs_sql = (
+        'SELECT server_url, handle, secret, issued, lifetime, assoc_type '
+        'FROM %(associations)s ORDER BY server_url, handle LIMIT %%s;')
+    export_assocs_after_sql = (
+        'SELECT server_url, handle, secret, issued, lifetime, assoc_type '
+        'FROM %(associations)s '
+        'WHERE server_url > %%s OR (server_url = %%s AND handle > %%s) '
+        'ORDER BY server_url, handle LIMIT %%s;')
+
+    export_nonces_sql = (
+        'SELECT server_url, timestamp, salt FROM %(nonces)s '
+        'WHERE timestamp >= %%s ORDER BY timestamp, server_url, salt '
+        'LIMIT %%s;')
+    export_nonces_after_sql = (
+        'SELECT server_url, timestamp, salt FROM %(nonces)s '
+        'WHERE timestamp >= %%s AND (timestamp > %%s OR (timestamp = %%s AND '
+        '(server_url > %%s OR (server_url = %%s AND salt > %%s)))) '
+        'ORDER BY timestamp, server_url, salt LIMIT %%s;')
+
     clean_nonce_sql = 'DELETE FROM %(nonces)s WHERE timestamp < %%s;'
 
+    clean_nonce_batch_sql = ('DELETE FROM %(nonces)s '
+                             'WHERE timestamp < %%s LIMIT %%s;')
+
 
 class PostgreSQLStore(SQLStore):
     """
     This is a PostgreSQL-based specialization of C{L{SQLStore}}.
 
-    To create an instance, see C{L{SQLStore.__init__}}.  To create the
+    To create an instance, see C{L{__init__}}.  To create the
     tables it will use, see C{L{SQLStore.createTables}}.
 
+    Made with a C{nonce_partition_width}, the store creates its nonces
+    table range-partitioned on the nonce timestamp (PostgreSQL 11 or
+    later), one partition for each C{nonce_partition_width} seconds.
+    Partitions wholly older than C{L{nonce.SKEW}} are dropped rather
+    than deleted from, so expiring nonces needs no large C{DELETE}
+    and leaves nothing to vacuum.  The primary key includes the
+    timestamp, so a nonce always lands in the same partition and a
+    replay still fails its uniqueness check.
+
+    Call C{L{maintainNoncePartitions}} every so often (at least once
+    per partition width) to create upcoming partitions and drop
+    expired ones.  C{L{useNonce}} creates any partition it finds
+    missing, so a late maintenance run costs a little time rather than
+    refused nonces.
+
     All other methods are implementation details.
+
+    @cvar nonce_partitions_ahead: How many partitions to create
+        beyond the newest timestamp C{L{useNonce}} currently allows.
     """
     exceptions = None
 
+    nonce_partitions_ahead = 2
+
+    def __init__(self, *args, nonce_partition_width=None, **kwargs):
+        """
+        Create a new PostgreSQLStore.  The arguments are as for
+        C{L{SQLStore.__init__}}, with one more.
+
+        @param nonce_partition_width: The number of seconds of nonce
+            timestamps kept in each partition of the nonces table,
+            such as 3600 for hourly partitions, or C{None} to use an
+            ordinary table.  It must match how the tables were
+            created.
+
+        @type nonce_partition_width: C{int} or C{NoneType}
+        """
+        SQLStore.__init__(self, *args, **kwargs)
+        self.nonce_partition_width = nonce_partition_width
+        # Start timestamps of the nonce partitions known to exist
+        self._nonce_partitions = set()
+
     create_nonce_sql = """
     CREATE TABLE %(nonces)s (
         server_url VARCHAR(2047) NOT NULL,
@@ -443,6 +1031,28 @@ class PostgreSQLStore(SQLStore):
     );
     """
 
+    create_partitioned_nonce_sql = """
+    CREATE TABLE %(nonces)s (
+        server_url VARCHAR(2047) NOT NULL,
+        timestamp INTEGER NOT NULL,
+        salt CHAR(40) NOT NULL,
+        PRIMARY KEY (server_url, timestamp, salt)
+    ) PARTITION BY RANGE (timestamp);
+    """
+
+    # The partition name and bounds are filled in with integers after
+    # the table names.
+    create_nonce_partition_sql = (
+        'CREATE TABLE IF NOT EXISTS %(nonces)s_p%%d PARTITION OF %(nonces)s '
+        'FOR VALUES FROM (%%d) TO (%%d);')
+    drop_nonce_partition_sql = 'DROP TABLE IF EXISTS %(nonces)s_p%%d;'
+    count_nonce_partition_sql = 'SELECT count(*) FROM %(nonces)s_p%%d;'
+
+    list_nonce_partitions_sql = (
+        'SELECT c.relname FROM pg_inherits i '
+        'JOIN pg_class c ON c.oid = i.inhrelid '
+        "WHERE i.inhparent = '%(nonces)s'::regclass;")
+
     create_assoc_sql = """
     CREATE TABLE %(associations)s
     (
@@ -457,6 +1067,10 @@ class PostgreSQLStore(SQLStore):
     );
     """
 
+    create_assoc_index_sql = (
+        'CREATE INDEX %(associations)s_server_issued '
+        'ON %(associations)s (server_url, issued);')
+
     def db_set_assoc(self, server_url, handle, secret, issued, lifetime, assoc_type):
         """
         Set an association.  This is implemented as a method because
@@ -481,23 +1095,179 @@ class PostgreSQLStore(SQLStore):
                         'secret = %%s, issued = %%s, '
                         'lifetime = %%s, assoc_type = %%s '
                         'WHERE server_url = %%s AND handle = %%s;')
-    get_assocs_sql = ('SELECT handle, secret, issued, lifetime, assoc_type'
-                      ' FROM %(associations)s WHERE server_url = %%s;')
-    get_expired_sql = ('SELECT server_url '
-                       'FROM %(associations)s WHERE issued + lifetime < %%s;')
-
     get_assoc_sql = (
         'SELECT handle, secret, issued, lifetime, assoc_type'
         ' FROM %(associations)s WHERE server_url = %%s AND handle = %%s;')
+    get_newest_assoc_sql = (
+        'SELECT handle, secret, issued, lifetime, assoc_type'
+        ' FROM %(associations)s'
+        ' WHERE server_url = %%s AND issued + lifetime > %%s'
+        ' ORDER BY issued DESC LIMIT 1;')
     remove_assoc_sql = ('DELETE FROM %(associations)s '
                         'WHERE server_url = %%s AND handle = %%s;')
 
     clean_assoc_sql = 'DELETE FROM %(associations)s WHERE issued + lifetime < %%s;'
 
+    clean_assoc_batch_sql = (
+        'DELETE FROM %(associations)s WHERE (server_url, handle) IN '
+        '(SELECT server_url, handle FROM %(associations)s '
+        'WHERE issued + lifetime < %%s LIMIT %%s);')
+
     add_nonce_sql = 'INSERT INTO %(nonces)s VALUES (%%s, %%s, %%s);'
 
+    add_nonce_ignore_sql = ('INSERT INTO %(nonces)s VALUES (%%s, %%s, %%s) '
+                            'ON CONFLICT DO NOTHING;')
+
+    export_assocs_sql = (
+        'SELECT server_url, handle, secret, issued, lifetime, assoc_type '
+        'FROM %(associations)s ORDER BY server_url, handle LIMIT %%s;')
+    export_assocs_after_sql = (
+        'SELECT server_url, handle, secret, issued, lifetime, assoc_type '
+        'FROM %(associations)s '
+        'WHERE server_url > %%s OR (server_url = %%s AND handle > %%s) '
+        'ORDER BY server_url, handle LIMIT %%s;')
+
+    export_nonces_sql = (
+        'SELECT server_url, timestamp, salt FROM %(nonces)s '
+        'WHERE timestamp >= %%s ORDER BY timestamp, server_url, salt '
+        'LIMIT %%s;')
+    export_nonces_after_sql = (
+        'SELECT server_url, timestamp, salt FROM %(nonces)s '
+        'WHERE timestamp >= %%s AND (timestamp > %%s OR (timestamp = %%s AND '
+        '(server_url > %%s OR (server_url = %%s AND salt > %%s)))) '
+        'ORDER BY timestamp, server_url, salt LIMIT %%s;')
+
     clean_nonce_sql = 'DELETE FROM %(nonces)s WHERE timestamp < %%s;'
 
+    clean_nonce_batch_sql = (
+        'DELETE FROM %(nonces)s WHERE (server_url, timestamp, salt) IN '
+        '(SELECT server_url, timestamp, salt FROM %(nonces)s '
+        'WHERE timestamp < %%s LIMIT %%s);')
+
+    def db_create_nonce(self):
+        if self.nonce_partition_width is None:
+            return self._execSQL('create_nonce_sql')
+
+        self._execSQL('create_partitioned_nonce_sql')
+        self.txn_createNoncePartitions()
+
+    def _execPartitionSQL(self, sql_name, *args):
+        self.cur.execute(self._getSQL(sql_name) % args)
+
+    def _listNoncePartitions(self):
+        """Return the start timestamps of the nonce partitions."""
+        self.db_list_nonce_partitions()
+        starts = set()
+        for (name,) in self.cur.fetchall():
+            match = _partition_suffix.search(name)
+            if match:
+                starts.add(int(match.group(1)))
+        return starts
+
+    def _wantedNoncePartitions(self):
+        """Return the start timestamps of the partitions that
+        C{L{useNonce}} may need now."""
+        width = self.nonce_partition_width
+        now = int(time.time())
+        first = now - nonce.SKEW
+        first -= first % width
+        last = now + nonce.SKEW + self.nonce_partitions_ahead * width
+        return range(first, last + 1, width)
+
+    def txn_createNoncePartitions(self):
+        """Create any missing nonce partitions, from C{L{nonce.SKEW}}
+        ago through C{nonce_partitions_ahead} partitions past
+        C{L{nonce.SKEW}} from now.
+
+        NoneType -> int
+        """
+        existing = self._listNoncePartitions()
+        created = 0
+        for start in self._wantedNoncePartitions():
+            if start not in existing:
+                self._execPartitionSQL(
+                    'create_nonce_partition_sql', start,
+                    start, start + self.nonce_partition_width)
+                existing.add(start)
+                created += 1
+
+        self._nonce_partitions = existing
+        return created
+
+    createNoncePartitions = _inTxn(txn_createNoncePartitions)
+
+    def _dropNoncePartitions(self, count_rows):
+        """Drop the nonce partitions that end before C{L{nonce.SKEW}}
+        ago, returning the number of partitions dropped, or the number
+        of nonces in them if count_rows is true."""
+        oldest_allowed = int(time.time()) - nonce.SKEW
+        existing = self._listNoncePartitions()
+        dropped = 0
+        for start in sorted(existing):
+            if start + self.nonce_partition_width > oldest_allowed:
+                break
+
+            if count_rows:
+                self._execPartitionSQL('count_nonce_partition_sql', start)
+                dropped += self.cur.fetchone()[0]
+            else:
+                dropped += 1
+            self._execPartitionSQL('drop_nonce_partition_sql', start)
+            existing.discard(start)
+
+        self._nonce_partitions = existing
+        return dropped
+
+    def txn_maintainNoncePartitions(self):
+        """Create upcoming nonce partitions and drop the ones wholly
+        outside of C{L{nonce.SKEW}}.  Nothing to do for a store
+        without a C{nonce_partition_width}.
+
+        @return: The number of partitions created and dropped.
+        @rtype: (C{int}, C{int})
+        """
+        if self.nonce_partition_width is None:
+            return 0, 0
+
+        dropped = self._dropNoncePartitions(False)
+        return self.txn_createNoncePartitions(), dropped
+
+    maintainNoncePartitions = _inTxn(txn_maintainNoncePartitions)
+
+    def _checkNoncePartition(self, timestamp):
+        """Create the nonce partitions if the one for timestamp is
+        missing."""
+        start = int(timestamp) - int(timestamp) % self.nonce_partition_width
+        if (start not in self._nonce_partitions and
+                abs(timestamp - time.time()) <= nonce.SKEW):
+            try:
+                self.createNoncePartitions()
+            except self.exceptions.IntegrityError:
+                # Another process created the partition first.
+                pass
+
+    def useNonce(self, server_url, timestamp, salt):
+        if self.nonce_partition_width is not None:
+            self._checkNoncePartition(timestamp)
+        return SQLStore.useNonce(self, server_url, timestamp, salt)
+
+    def useNonces(self, nonces):
+        if self.nonce_partition_width is not None:
+            for _, timestamp, _ in nonces:
+                self._checkNoncePartition(timestamp)
+        return SQLStore.useNonces(self, nonces)
+
+    def txn_cleanupNonces(self):
+        if self.nonce_partition_width is None:
+            return SQLStore.txn_cleanupNonces(self)
+
+        # Drop the wholly expired partitions, then delete from the one
+        # that straddles the cutoff.
+        removed = self._dropNoncePartitions(True)
+        return removed + SQLStore.txn_cleanupNonces(self)
+
+    cleanupNonces = _inTxn(txn_cleanupNonces)
+
     def blobEncode(self, blob):
         from psycopg2 import Binary
 
@@ -505,3 +1275,103 @@ class PostgreSQLStore(SQLStore):
 
     def blobDecode(self, blob):
         return blob.tobytes()
+
+    def saltDecode(self, salt):
+        # CHAR columns come back padded with spaces.
+        return salt.rstrip(' ')
+
+
+class IncrementalCleanup(object):
+    """
+    Removes expired nonces and associations from an C{L{SQLStore}} in
+    small batches, each in its own short transaction, so that cleanup
+    never holds locks on a large table for long.
+
+    Call C{L{runOnce}} from a periodic job, or C{L{start}} a background
+    thread that does so every C{interval} seconds.  A background thread
+    shares the store with the rest of the process, so the store must
+    be a pooled one (made with a C{connection_factory}), or one made
+    just for the cleanup.
+
+    After each batch, C{report} is called with the kind of record
+    (C{'nonces'} or C{'associations'}), the number of rows removed and
+    the number of seconds the batch took.  By default this is logged
+    at debug level.
+
+    @ivar batch_size: The most rows to delete in one transaction.
+    @type batch_size: C{int}
+
+    @ivar pause: The number of seconds to wait between batches.
+    @type pause: C{float}
+
+    @ivar interval: The number of seconds between runs of the
+        background thread.
+    @type interval: C{float}
+    """
+
+    def __init__(self, store, batch_size=1000, pause=0.05, interval=300,
+                 report=None):
+        self.store = store
+        self.batch_size = batch_size
+        self.pause = pause
+        self.interval = interval
+        if report is None:
+            report = self._logBatch
+        self.report = report
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _logBatch(self, kind, removed, elapsed):
+        logging.debug('Removed %d expired %s in %.3f seconds',
+                      removed, kind, elapsed)
+
+    def _cleanup(self, kind, clean_batch):
+        total = 0
+        while not self._stopped.is_set():
+            start = time.time()
+            removed = clean_batch(self.batch_size)
+            self.report(kind, removed, time.time() - start)
+            total += removed
+            if removed < self.batch_size:
+                break
+            self._stopped.wait(self.pause)
+        return total
+
+    def runOnce(self):
+        """Remove all of the expired records, a batch at a time.
+
+        @return: the number of nonces and associations removed
+        @rtype: (C{int}, C{int})
+        """
+        nonces = self._cleanup('nonces', self.store.cleanupNoncesBatch)
+        associations = self._cleanup(
+            'associations', self.store.cleanupAssociationsBatch)
+        return nonces, associations
+
+    def start(self):
+        """Run C{L{runOnce}} every C{interval} seconds in a background
+        thread until C{L{stop}} is called."""
+        if self._thread is not None:
+            raise RuntimeError('Cleanup is already running')
+
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name='SQLStore cleanup')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background thread, waiting for the current batch
+        to finish."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self.runOnce()
+            except Exception:
+                logging.exception('Error cleaning up expired OpenID records')
+            self._stopped.wait(self.interval)
@@ -1,5 +1,15 @@
 import os.path
-from openid.dh import DiffieHellman, strxor
+import asyncio
+import concurrent.futures
+import random
+import shutil
+import tempfile
+import time
+
+from openid import cryptutil
+from openid.dh import DiffieHellman, FixedBaseExponentiator, KeyPairPool, \
+     getFixedBaseExponentiator, strxor
+from openid.test.support import CatchLogs
 
 
 def test_strxor():
@@ -66,10 +76,143 @@ def test_public():
         f.close()
 
 
+def test_pool():
+    pool = KeyPairPool(depth=4)
+    try:
+        deadline = time.time() + 10
+        while pool.getStats()['depth'] < 4 and time.time() < deadline:
+            time.sleep(0.01)
+        assert pool.getStats()['depth'] == 4, pool.getStats()
+
+        pairs = set()
+        for _ in range(6):
+            dh = DiffieHellman.fromPool(pool)
+            assert dh.usingDefaultValues()
+            assert dh.public == pow(dh.generator, dh.private, dh.modulus)
+            pairs.add(dh.private)
+        assert len(pairs) == 6
+        stats = pool.getStats()
+        assert stats['hits'] + stats['misses'] == 6, stats
+        assert stats['hits'] >= 4, stats
+
+        other = DiffieHellman.fromPool(pool)
+        assert other.getSharedSecret(dh.public) == dh.getSharedSecret(
+            other.public)
+
+        # A child process drops the pairs it inherited, and fills the
+        # pool again with its own thread.
+        with pool._lock:
+            inherited = set(private for private, _ in pool._pairs)
+        pid = os.fork()
+        if pid == 0:
+            ok = False
+            try:
+                private, public = pool.get()
+                ok = (private not in inherited and
+                      public == pow(pool.generator, private, pool.modulus) and
+                      pool._thread.is_alive())
+            finally:
+                os._exit(0 if ok else 1)
+        _, status = os.waitpid(pid, 0)
+        assert status == 0, status
+    finally:
+        pool.close()
+
+    # Pairs can be made by an executor, and a pool that gets none
+    # still hands out pairs.
+    with concurrent.futures.ThreadPoolExecutor(1) as executor:
+        pool = KeyPairPool(7, 3, depth=2, executor=executor)
+        try:
+            private, public = pool.get()
+            assert public == pow(3, private, 7)
+            assert pool.matches(7, 3)
+            assert not pool.matches(DiffieHellman.DEFAULT_MOD, 3)
+        finally:
+            pool.close()
+
+
+def test_fixed_base():
+    modulus = DiffieHellman.DEFAULT_MOD
+    for window in [1, 3, 6, 8]:
+        exponentiator = FixedBaseExponentiator(modulus, 2, window)
+        exponents = [0, 1, 2, (1 << window) - 1, 1 << window, modulus - 2,
+                     modulus - 1, modulus + 5, 1 << 1100]
+        exponents.extend(random.randrange(1, modulus) for _ in range(20))
+        for exponent in exponents:
+            assert exponentiator(exponent) == pow(2, exponent, modulus), (
+                window, exponent)
+
+    exponentiator = FixedBaseExponentiator(1019, 7, 3)
+    for exponent in range(2000):
+        assert exponentiator(exponent) == pow(7, exponent, 1019), exponent
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(temp_dir, 'table')
+        exponentiator = FixedBaseExponentiator(modulus, 2, 4)
+        exponentiator.save(filename)
+        loaded = FixedBaseExponentiator.load(filename, modulus, 2, 4)
+        assert loaded.table == exponentiator.table
+
+        for args in [(modulus, 3, 4), (modulus, 2, 5)]:
+            try:
+                FixedBaseExponentiator.load(filename, *args)
+            except ValueError:
+                pass
+            else:
+                assert False, 'Loaded a table for %r' % (args,)
+
+        with open(filename, 'r+b') as f:
+            f.seek(-1, 2)
+            last = f.read(1)
+            f.seek(-1, 2)
+            f.write(bytes([last[0] ^ 1]))
+        try:
+            FixedBaseExponentiator.load(filename, modulus, 2, 4)
+        except ValueError:
+            pass
+        else:
+            assert False, 'Loaded a corrupt table'
+
+        # A bad cache file is replaced with a good table.
+        logs = CatchLogs()
+        logs.setUp()
+        try:
+            cached = getFixedBaseExponentiator(modulus, 2, 3, filename)
+            logs.failUnlessLogMatches('Not using fixed-base')
+        finally:
+            logs.tearDown()
+        assert cached is getFixedBaseExponentiator(modulus, 2, 3)
+        assert FixedBaseExponentiator.load(
+            filename, modulus, 2, 3).table == cached.table
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def test_executor():
+    dh1 = DiffieHellman.fromDefaults()
+    dh2 = DiffieHellman.fromDefaults()
+    secret = dh1.getSharedSecret(dh2.public)
+    with concurrent.futures.ProcessPoolExecutor(1) as executor:
+        assert dh2.getSharedSecret(dh1.public, executor) == secret
+        assert asyncio.run(
+            dh2.getSharedSecretAsync(dh1.public, executor)) == secret
+
+        mac_key = b'k' * 20
+        encrypted = dh1.xorSecret(dh2.public, mac_key, cryptutil.sha1)
+        assert dh2.xorSecret(dh1.public, encrypted, cryptutil.sha1,
+                             executor) == mac_key
+        assert asyncio.run(dh2.xorSecretAsync(
+            dh1.public, encrypted, cryptutil.sha1)) == mac_key
+
+
 def test():
     test_exchange()
     test_public()
     test_strxor()
+    test_pool()
+    test_fixed_base()
+    test_executor()
 
 if __name__ == '__main__':
     test()
@@ -1,3 +1,4 @@
+import logging
 import unittest
 import string
 import time
@@ -242,7 +243,266 @@ def test_filestore():
 
     testStore(store)
     store.cleanup()
-    shutil.rmtree(temp_dir)
+
+    try:
+        # An empty handle removes nothing
+        server_url = 'http://www.myopenid.com/openid'
+        now = int(time.time())
+        assoc = Association(generateHandle(16), generateSecret(20), now,
+                            600, 'HMAC-SHA1')
+        store.storeAssociation(server_url, assoc)
+        assert not store.removeAssociation(server_url, None)
+        assert not store.removeAssociation(server_url, '')
+        assert store.getAssociation(server_url) == assoc
+
+        # Cleanup removes the directories of servers with no
+        # associations left
+        expired_url = 'http://expired.example.com/openid'
+        store.storeAssociation(expired_url, Association(
+            generateHandle(16), generateSecret(20), now - 7200, 600,
+            'HMAC-SHA1'))
+        expired_dir = store.getAssociationFilename(expired_url, None)
+        assert os.path.isdir(expired_dir)
+        assert store.cleanupAssociations() == 1
+        assert not os.path.exists(expired_dir)
+        assert store.getAssociation(server_url) == assoc
+
+        store.storeAssociation(expired_url, assoc)
+        assert store.getAssociation(expired_url) == assoc
+
+        # The latest pointer is followed for handles whose file names
+        # contain '_'
+        handle = generateHandle(16)
+        while '_' not in filestore._safe64(handle).decode('ascii'):
+            handle = generateHandle(16)
+        latest = Association(handle, generateSecret(20), now + 1, 600,
+                             'HMAC-SHA1')
+        store.storeAssociation(server_url, latest)
+        server_dir = store.getAssociationFilename(server_url, None)
+        assert store._getLatest(server_dir) == latest
+        assert store.getAssociation(server_url) == latest
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def test_filestore_durability():
+    from openid.store import filestore
+    import tempfile
+    import shutil
+
+    for durability in [filestore.SYNC_DIRECTORY, filestore.SYNC_GROUP]:
+        temp_dir = tempfile.mkdtemp()
+        try:
+            store = filestore.FileOpenIDStore(temp_dir, durability=durability,
+                                              commit_interval=0.01)
+            testStore(store)
+            store.flush()
+            store.close()
+
+            # Writes after close are not left waiting for a thread
+            # that has stopped.
+            assoc = Association(generateHandle(16), generateSecret(20),
+                                int(time.time()), 600, 'HMAC-SHA1')
+            store.storeAssociation('http://www.myopenid.com/openid', assoc)
+            if durability == filestore.SYNC_GROUP:
+                assert not store._committer._pending
+                assert not store._committer._thread.is_alive()
+        finally:
+            shutil.rmtree(temp_dir)
+
+    try:
+        filestore.FileOpenIDStore(tempfile.gettempdir(), durability='never')
+    except ValueError:
+        pass
+    else:
+        assert False, 'Expected ValueError for unknown durability level'
+
+
+def test_filestore_cache():
+    from openid.store import filestore
+    import tempfile
+    import shutil
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        store = filestore.FileOpenIDStore(temp_dir, cache_size=2)
+        testStore(store)
+        assert len(store._cache) <= 2, store._cache
+
+        # A second store sharing the directory sees the first store's
+        # changes even though it has the association cached.
+        server_url = 'http://www.myopenid.com/openid'
+        other = filestore.FileOpenIDStore(temp_dir, cache_size=10)
+        assoc = Association(generateHandle(16), generateSecret(20),
+                            int(time.time()), 600, 'HMAC-SHA1')
+        store.storeAssociation(server_url, assoc)
+        assert other.getAssociation(server_url, assoc.handle) == assoc
+        assert other.getAssociation(server_url, assoc.handle) is \
+            other.getAssociation(server_url, assoc.handle)
+
+        replaced = Association(assoc.handle, generateSecret(20),
+                               int(time.time()), 600, 'HMAC-SHA1')
+        store.storeAssociation(server_url, replaced)
+        assert other.getAssociation(server_url, assoc.handle) == replaced
+
+        assert store.removeAssociation(server_url, assoc.handle)
+        assert other.getAssociation(server_url, assoc.handle) is None
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def test_filestore_upgrade():
+    from openid.store import filestore
+    import contextlib
+    import io
+    import runpy
+    import tempfile
+    import shutil
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        # Lay out an association the way earlier versions did, directly
+        # in the associations directory.
+        server_url = 'http://www.myopenid.com/openid'
+        assoc = Association(generateHandle(16), generateSecret(20),
+                            int(time.time()), 600, 'HMAC-SHA1')
+        flat_name = 'http-www.myopenid.com-%s-%s' % (
+            filestore._safe64(server_url), filestore._safe64(assoc.handle))
+        association_dir = os.path.join(temp_dir, 'associations')
+        os.makedirs(association_dir)
+        with open(os.path.join(association_dir, flat_name), 'wb') as f:
+            f.write(assoc.serialize())
+
+        # and a nonce directly in the nonces directory.
+        stamp, salt = split(mkNonce())
+        nonce_name = '%08x-http-www.myopenid.com-%s-%s' % (
+            stamp, filestore._safe64(server_url), filestore._safe64(salt))
+        nonce_dir = os.path.join(temp_dir, 'nonces')
+        os.makedirs(nonce_dir)
+        open(os.path.join(nonce_dir, nonce_name), 'wb').close()
+
+        store = filestore.FileOpenIDStore(temp_dir)
+        assert not os.path.exists(os.path.join(association_dir, flat_name))
+        assert store.getAssociation(server_url, assoc.handle) == assoc
+        assert store.getAssociation(server_url) == assoc
+
+        assert not os.path.exists(os.path.join(nonce_dir, nonce_name))
+        assert not store.useNonce(server_url, stamp, salt)
+
+        # The upgraded directory does not know its server URL, so
+        # migrating the store reports its associations as skipped.
+        assert list(store.iterAssociations()) == []
+        assert store.countUnexportableServers() == 1
+        script = runpy.run_path(os.path.join(
+            os.path.dirname(__file__), '..', '..', 'contrib',
+            'migrate-store'))
+        argv = ['file:' + temp_dir,
+                'sqlite:' + os.path.join(temp_dir, 'dest.db')]
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output), \
+             contextlib.redirect_stderr(io.StringIO()):
+            script['main'](argv)
+        assert 'Copied 0 associations' in output.getvalue()
+        assert 'Skipped the associations of 1 servers' in output.getvalue()
+
+        # Storing an association for the server records its URL.
+        newer = Association(generateHandle(16), generateSecret(20),
+                            int(time.time()) + 1, 600, 'HMAC-SHA1')
+        store.storeAssociation(server_url, newer)
+        assert store.countUnexportableServers() == 0
+        assert sorted(store.iterAssociations(),
+                      key=lambda item: item[1].issued) == [
+            (server_url, assoc), (server_url, newer)]
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def test_mmapstore():
+    from openid.store import mmapstore
+    from openid.store import nonce as nonceModule
+    import tempfile
+    import shutil
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(temp_dir, 'nonces.tbl')
+        store = mmapstore.MmapNonceStore(filename, slots=64)
+        testStore(store)
+
+        # Another instance on the same file sees the same nonces
+        server_url = 'http://www.myopenid.com/openid'
+        stamp, salt = split(mkNonce())
+        other = mmapstore.MmapNonceStore(filename)
+        assert other.slots == 64, other.slots
+        assert store.useNonce(server_url, stamp, salt)
+        assert not other.useNonce(server_url, stamp, salt)
+        other.close()
+
+        # A full table refuses new nonces rather than dropping old ones
+        for _ in range(64):
+            store.useNonce(server_url, *split(mkNonce()))
+        assert not store.useNonce(server_url, *split(mkNonce()))
+        assert not store.useNonce(server_url, stamp, salt)
+        store.close()
+
+        # Expired nonces met while probing are deleted, without
+        # losing the live nonces moved back over them
+        store = mmapstore.MmapNonceStore(
+            os.path.join(temp_dir, 'expiring.tbl'), slots=64)
+        now = int(time.time())
+        orig_skew = nonceModule.SKEW
+        try:
+            nonceModule.SKEW = 100000
+            live = [(now, mkNonce()[-6:]) for _ in range(32)]
+            for timestamp, salt in live:
+                assert store.useNonce(server_url, timestamp, salt)
+            for _ in range(32):
+                assert store.useNonce(server_url, now - 50000,
+                                      mkNonce()[-6:])
+
+            nonceModule.SKEW = 3600
+            assert store.useNonce(server_url, *split(mkNonce()))
+            for timestamp, salt in live:
+                assert not store.useNonce(server_url, timestamp, salt)
+
+            # The table was full, so the new nonce's probe met at
+            # least one expired nonce
+            expired = [store._map[store._offset(index):][:8] ==
+                       (now - 50000).to_bytes(8, 'big')
+                       for index in range(store.slots)]
+            assert sum(expired) < 32, sum(expired)
+        finally:
+            nonceModule.SKEW = orig_skew
+            store.close()
+
+        # cleanupNonces deletes every expired nonce in place, leaving
+        # the live ones where they can be found
+        store = mmapstore.MmapNonceStore(
+            os.path.join(temp_dir, 'cleanup.tbl'), slots=64)
+        try:
+            nonceModule.SKEW = 100000
+            live = []
+            for i in range(48):
+                if i % 3:
+                    assert store.useNonce(server_url, now - 50000,
+                                          mkNonce()[-6:])
+                else:
+                    live.append((now, mkNonce()[-6:]))
+                    assert store.useNonce(server_url, *live[-1])
+
+            nonceModule.SKEW = 3600
+            assert store.cleanupNonces() == 32
+            assert store.cleanupNonces() == 0
+            used = [store._map[store._offset(index):][:8] != bytes(8)
+                    for index in range(store.slots)]
+            assert sum(used) == len(live), sum(used)
+            for timestamp, salt in live:
+                assert not store.useNonce(server_url, timestamp, salt)
+        finally:
+            nonceModule.SKEW = orig_skew
+            store.close()
+    finally:
+        shutil.rmtree(temp_dir)
 
 
 def test_sqlite():
@@ -253,6 +513,254 @@ def test_sqlite():
     store.createTables()
     testStore(store)
 
+    # An expired newest association gives way to an older live one
+    server_url = 'http://expiring.example.com/openid'
+    now = int(time.time())
+    older = Association(generateHandle(16), generateSecret(20), now - 100,
+                        600, 'HMAC-SHA1')
+    newest = Association(generateHandle(16), generateSecret(20), now - 10,
+                         5, 'HMAC-SHA1')
+    store.storeAssociation(server_url, older)
+    store.storeAssociation(server_url, newest)
+    assert store.getAssociation(server_url) == older
+
+
+def test_sqlite_pool():
+    from openid.store import sqlstore
+    import sqlite3
+    import tempfile
+    import shutil
+    import threading
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        db_name = os.path.join(temp_dir, 'openid.db')
+
+        def connect():
+            return sqlite3.connect(db_name, check_same_thread=False)
+
+        store = sqlstore.SQLiteStore(connection_factory=connect, pool_size=4)
+        store.createTables()
+        testStore(store)
+
+        server_url = 'http://www.myopenid.com/openid'
+        stamp, salt = split(mkNonce())
+        results = []
+
+        def worker():
+            results.append(store.useNonce(server_url, stamp, salt))
+            store.getAssociation(server_url)
+
+        threads = [threading.Thread(target=worker) for _ in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert results.count(True) == 1, results
+        assert store.conn is None
+        store.close()
+
+        # A transaction whose commit fails is rolled back before its
+        # connection goes back to the pool
+        class FailingConnection(sqlite3.Connection):
+            fail = False
+
+            def commit(self):
+                if self.fail:
+                    raise sqlite3.OperationalError('commit failed')
+                return sqlite3.Connection.commit(self)
+
+        conns = []
+
+        def connectFailing():
+            conn = sqlite3.connect(db_name, check_same_thread=False,
+                                   factory=FailingConnection)
+            conns.append(conn)
+            return conn
+
+        store = sqlstore.SQLiteStore(connection_factory=connectFailing,
+                                     pool_size=1)
+        stamp, salt = split(mkNonce())
+        assert store.useNonce(server_url, stamp, salt + 'pooled')
+        conns[0].fail = True
+        try:
+            store.useNonce(server_url, stamp, salt)
+        except sqlite3.OperationalError:
+            pass
+        else:
+            assert False, 'commit failure was not raised'
+        conns[0].fail = False
+        assert not conns[0].in_transaction
+        assert store.useNonce(server_url, stamp, salt)
+        assert len(conns) == 1, conns
+        store.close()
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def test_sqlite_concurrent():
+    from openid.store import sqlstore
+    import sqlite3
+    import tempfile
+    import shutil
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        db_name = os.path.join(temp_dir, 'openid.db')
+        store = sqlstore.SQLiteStore.concurrent(db_name, pool_size=4)
+        store.createTables()
+        testStore(store)
+
+        conn = sqlite3.connect(db_name)
+        (journal_mode,) = conn.execute('PRAGMA journal_mode').fetchone()
+        assert journal_mode == 'wal', journal_mode
+        (schema,) = conn.execute(
+            "SELECT sql FROM sqlite_master WHERE name = 'oid_nonces'"
+            ).fetchone()
+        assert 'WITHOUT ROWID' in schema, schema
+        conn.close()
+
+        try:
+            sqlstore.SQLiteStore.concurrent(db_name, synchronous='sometimes')
+        except ValueError:
+            pass
+        else:
+            assert False, 'Bad synchronous level accepted'
+
+        # A child process makes its own connections, and sees the
+        # nonces used by its parent.
+        server_url = 'http://www.myopenid.com/openid'
+        stamp, salt = split(mkNonce())
+        assert store.useNonce(server_url, stamp, salt)
+        pid = os.fork()
+        if pid == 0:
+            ok = False
+            try:
+                ok = (not store.useNonce(server_url, stamp, salt) and
+                      store.useNonce(server_url, stamp, salt + 'child'))
+            finally:
+                os._exit(0 if ok else 1)
+        _, status = os.waitpid(pid, 0)
+        assert status == 0, status
+        assert not store.useNonce(server_url, stamp, salt + 'child')
+        store.close()
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def test_sqlite_incremental_cleanup():
+    from openid.store import sqlstore
+    from openid.store import nonce as nonceModule
+    import sqlite3
+
+    store = sqlstore.SQLiteStore(sqlite3.connect(':memory:'))
+    store.createTables()
+
+    server_url = 'http://www.myopenid.com/openid'
+    now = int(time.time())
+    for i in range(25):
+        store.storeAssociation(server_url, Association(
+            'expired-%d' % i, b'x' * 20, now - 100, 10, 'HMAC-SHA1'))
+    store.storeAssociation(server_url, Association(
+        'current', b'x' * 20, now, 600, 'HMAC-SHA1'))
+
+    orig_skew = nonceModule.SKEW
+    try:
+        for i in range(23):
+            assert store.useNonce(server_url, now - 1000, 'old-%d' % i)
+        assert store.useNonce(server_url, now, 'fresh')
+        nonceModule.SKEW = 100
+
+        batches = []
+        cleanup = sqlstore.IncrementalCleanup(
+            store, batch_size=10, pause=0,
+            report=lambda kind, removed, elapsed: batches.append(
+                (kind, removed)))
+        assert cleanup.runOnce() == (23, 25)
+        assert batches == [('nonces', 10), ('nonces', 10), ('nonces', 3),
+                           ('associations', 10), ('associations', 10),
+                           ('associations', 5)], batches
+        assert cleanup.runOnce() == (0, 0)
+        assert store.getAssociation(server_url).handle == 'current'
+        assert not store.useNonce(server_url, now, 'fresh')
+    finally:
+        nonceModule.SKEW = orig_skew
+
+
+class _AwaitingStore(object):
+    """Runs each call to an asynchronous store to completion, so that
+    testStore can be used on it."""
+
+    def __init__(self, store, loop):
+        self.store = store
+        self.loop = loop
+
+    def __getattr__(self, name):
+        method = getattr(self.store, name)
+
+        def call(*args):
+            return self.loop.run_until_complete(method(*args))
+        return call
+
+
+def test_asyncstore():
+    import asyncio
+    import sqlite3
+    import tempfile
+    import shutil
+    from openid.store import asyncstore, filestore, memstore, sqlstore
+
+    loop = asyncio.new_event_loop()
+    temp_dir = tempfile.mkdtemp()
+    try:
+        db_name = os.path.join(temp_dir, 'openid.db')
+
+        def connect():
+            return sqlite3.connect(db_name, check_same_thread=False)
+
+        single = sqlstore.SQLiteStore(connect())
+        single.createTables()
+        pooled = sqlstore.SQLiteStore(
+            connection_factory=connect, associations_table='pooled_assocs',
+            nonces_table='pooled_nonces', pool_size=3)
+        pooled.createTables()
+
+        stores = [
+            (memstore.MemoryStore(), asyncstore.AsyncMemoryStore, None),
+            (memstore.ShardedMemoryStore(), asyncstore.AsyncMemoryStore,
+             None),
+            (filestore.FileOpenIDStore(os.path.join(temp_dir, 'files')),
+             asyncstore.ThreadedAsyncStore, 4),
+            (single, asyncstore.ThreadedAsyncStore, 1),
+            (pooled, asyncstore.ThreadedAsyncStore, 3),
+            ]
+        for store, store_class, max_workers in stores:
+            async_store = asyncstore.asyncStore(store)
+            assert isinstance(async_store, store_class), (store, async_store)
+            assert asyncstore.asyncStore(async_store) is async_store
+            if max_workers is not None:
+                assert async_store.executor._max_workers == max_workers
+
+            testStore(_AwaitingStore(async_store, loop))
+
+            # Racing uses of one nonce: exactly one of them succeeds.
+            server_url = 'http://www.myopenid.com/openid'
+            stamp, salt = split(mkNonce())
+            async def race():
+                return await asyncio.gather(*[
+                    async_store.useNonce(server_url, stamp, salt)
+                    for _ in range(8)])
+            results = loop.run_until_complete(race())
+            assert results.count(True) == 1, (store, results)
+
+            if max_workers is not None:
+                async_store.close()
+        pooled.close()
+    finally:
+        loop.close()
+        shutil.rmtree(temp_dir)
+
 
 def test_mysql():
     from openid.store import sqlstore
@@ -362,6 +870,15 @@ def test_postgresql():
         # At last, we get to run the test.
         testStore(store)
 
+        # Once more with the nonces table partitioned by the hour.
+        store = sqlstore.PostgreSQLStore(
+            conn_test, associations_table='oid_part_associations',
+            nonces_table='oid_part_nonces', nonce_partition_width=3600)
+        store.createTables()
+        testStore(store)
+        created, dropped = store.maintainNoncePartitions()
+        assert dropped == 0, dropped
+
         # Disconnect.
         conn_test.close()
 
@@ -382,16 +899,618 @@ def test_postgresql():
         conn_remove.close()
 
 
+def test_dbmstore():
+    from openid.store import dbmstore
+    import tempfile
+    import shutil
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(temp_dir, 'openid.db')
+        store = dbmstore.DBMStore(filename)
+        testStore(store)
+
+        # A second handle on the database, as another process would
+        # have, sees the first one's changes and makes its own.
+        other = dbmstore.DBMStore(filename)
+        server_url = 'http://www.myopenid.com/openid'
+        now = int(time.time())
+        assoc = Association('handle', b'x' * 20, now, 600, 'HMAC-SHA1')
+        store.storeAssociation(server_url, assoc)
+        assert other.getAssociation(server_url) == assoc
+        newer = Association('newer', b'y' * 20, now + 1, 600, 'HMAC-SHA1')
+        other.storeAssociation(server_url, newer)
+        assert store.getAssociation(server_url) == newer
+        assert store.removeAssociation(server_url, 'newer')
+        assert other.getAssociation(server_url) == assoc
+
+        stamp, salt = split(mkNonce())
+        assert store.useNonce(server_url, stamp, salt)
+        assert not other.useNonce(server_url, stamp, salt)
+
+        pid = os.fork()
+        if pid == 0:
+            ok = False
+            try:
+                ok = (not store.useNonce(server_url, stamp, salt) and
+                      store.useNonce(server_url, stamp, salt + 'child'))
+            finally:
+                os._exit(0 if ok else 1)
+        _, status = os.waitpid(pid, 0)
+        assert status == 0, status
+        assert not other.useNonce(server_url, stamp, salt + 'child')
+
+        other.close()
+        store.close()
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def test_cachingstore():
+    from openid.store import cachingstore, memstore
+
+    testStore(cachingstore.CachingStore(memstore.MemoryStore()))
+
+    class CountingStore(memstore.MemoryStore):
+        gets = 0
+
+        def getAssociation(self, server_url, handle=None):
+            self.gets += 1
+            return memstore.MemoryStore.getAssociation(
+                self, server_url, handle)
+
+    removed = []
+    backend = CountingStore()
+    store = cachingstore.CachingStore(
+        backend, max_entries=2, on_remove=lambda *args: removed.append(args))
+    server_url = 'http://www.myopenid.com/openid'
+    now = int(time.time())
+    assoc = Association('handle', b'x' * 20, now, 600, 'HMAC-SHA1')
+    backend.storeAssociation(server_url, assoc)
+
+    # Repeated lookups are answered from the cache, by handle too.
+    for _ in range(3):
+        assert store.getAssociation(server_url) == assoc
+        assert store.getAssociation(server_url, 'handle') == assoc
+    assert backend.gets == 1, backend.gets
+    assert (store.hits, store.misses) == (5, 1), (store.hits, store.misses)
+
+    # Entries are kept no longer than the association lasts.
+    short = Association('short', b'y' * 20, now - 595, 600, 'HMAC-SHA1')
+    store.storeAssociation(server_url, short)
+    expires, _ = store._cache[(server_url, 'short')]
+    assert expires <= time.time() + 5, expires - time.time()
+
+    # Storing a newer association shows up in newest lookups.
+    newer = Association('newer', b'z' * 20, now + 1, 600, 'HMAC-SHA1')
+    store.storeAssociation(server_url, newer)
+    assert store.getAssociation(server_url) == newer
+    assert len(store._cache) <= 2
+
+    # Removal drops the cached entries and tells the peers.
+    assert store.removeAssociation(server_url, 'newer')
+    assert removed == [(server_url, 'newer')], removed
+    assert store.getAssociation(server_url, 'newer') is None
+    assert store.getAssociation(server_url) == assoc
+
+    # A peer's removal is seen after invalidating.
+    backend.removeAssociation(server_url, 'handle')
+    assert store.getAssociation(server_url) == assoc
+    store.invalidate(server_url, 'handle')
+    assert store.getAssociation(server_url, 'handle') is None
+
+    # A lookup that read an association before it was removed does
+    # not cache it again.
+    class RacingStore(memstore.MemoryStore):
+        remove_during_get = False
+
+        def getAssociation(self, server_url, handle=None):
+            assoc = memstore.MemoryStore.getAssociation(
+                self, server_url, handle)
+            if self.remove_during_get:
+                self.remove_during_get = False
+                store.removeAssociation(server_url, handle)
+            return assoc
+
+    backend = RacingStore()
+    store = cachingstore.CachingStore(backend)
+    backend.storeAssociation(server_url, assoc)
+    backend.remove_during_get = True
+    assert store.getAssociation(server_url, 'handle') == assoc
+    assert (server_url, 'handle') not in store._cache
+    assert store.getAssociation(server_url, 'handle') is None
+
+
+def test_bloomstore():
+    from openid.store import bloomstore, memstore, sqlstore
+    import sqlite3
+    import threading
+
+    bits, hashes = bloomstore.bloomSize(10000, 0.01)
+    assert 95000 < bits < 96000 and hashes == 7, (bits, hashes)
+    rate = bloomstore.bloomErrorRate(bits, hashes, 10000)
+    assert 0.009 < rate < 0.011, rate
+
+    store = bloomstore.BloomNonceStore(memstore.MemoryStore(),
+                                       capacity=1000)
+    testStore(store)
+
+    class SlowStore(memstore.MemoryStore):
+        """Counts nonce writes, and is slow enough that nonces used
+        by other threads meanwhile make up a batch."""
+        calls = 0
+
+        def useNonce(self, *args):
+            self.calls += 1
+            time.sleep(0.001)
+            return memstore.MemoryStore.useNonce(self, *args)
+
+    class SlowBatchStore(SlowStore):
+        """Also writes a batch of nonces at once."""
+
+        def useNonces(self, nonces):
+            self.calls += 1
+            time.sleep(0.001)
+            return [memstore.MemoryStore.useNonce(self, *args)
+                    for args in nonces]
+
+    conn = sqlite3.connect(':memory:', check_same_thread=False)
+    sqlite_store = sqlstore.SQLiteStore(conn)
+    sqlite_store.createTables()
+    server_url = 'http://www.myopenid.com/openid'
+
+    # Only a backend that can take several nonces at once gets
+    # batches; others have each nonce checked on its own.
+    for backend, batched in [(SlowStore(), 0), (sqlite_store, 1)]:
+        store = bloomstore.BloomNonceStore(
+            backend, capacity=1000, batch_size=10)
+        stamp, salt = split(mkNonce())
+
+        # A fresh nonce is in the backend as soon as it is accepted.
+        assert store.useNonce(server_url, stamp, salt)
+        assert store.batched == batched
+        assert not backend.useNonce(server_url, stamp, salt)
+
+        # A replay is caught by the backend.
+        assert not store.useNonce(server_url, stamp, salt)
+        assert store.backend_checks == 2 - batched
+
+        # So is a nonce used by another process, which the filters
+        # have not seen.
+        assert backend.useNonce(server_url, stamp, salt + 'other')
+        assert not store.useNonce(server_url, stamp, salt + 'other')
+
+    # Nonces used by many threads at once are written in batches as
+    # soon as the store is made, and each is accepted once.
+    backend = SlowBatchStore()
+    store = bloomstore.BloomNonceStore(
+        backend, capacity=1000, batch_size=10)
+    stamp, salt = split(mkNonce())
+    results = []
+
+    def worker(i):
+        for j in range(10):
+            results.append(store.useNonce(server_url, stamp,
+                                          '%s%d' % (salt, j * 10 + i)))
+            results.append(store.useNonce(server_url, stamp, salt + 'dup'))
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results.count(True) == 101, results.count(True)
+    stats = store.getStats()
+    assert stats['batched'] + stats['backend_checks'] == 200, stats
+    assert stats['batched'] >= 100, stats
+    assert stats['batches'] < stats['batched'], stats
+
+
+def test_instrumentedstore():
+    from openid.store import (
+        bloomstore, instrumentedstore, memstore, migrate, sqlstore)
+    import sqlite3
+
+    metrics = instrumentedstore.StoreMetrics(buckets=(0.001, 1.0))
+    calls = []
+    store = instrumentedstore.InstrumentedStore(
+        memstore.MemoryStore(),
+        [metrics, lambda *args: calls.append(args)])
+    testStore(store)
+
+    stats = metrics.snapshot()
+    assert sorted(stats) == sorted(instrumentedstore.METHODS), stats
+    use_nonce = stats['useNonce']
+    assert use_nonce['calls'] == len([c for c in calls if c[0] == 'useNonce'])
+    assert use_nonce['errors'] == 0
+    assert use_nonce['buckets'][-1] == (float('inf'), use_nonce['calls'])
+
+    # Errors are counted, logged and raised.
+    class BrokenStore(memstore.MemoryStore):
+        def useNonce(self, *args):
+            raise IOError('Disk on fire')
+
+    logged = []
+
+    class Handler(logging.Handler):
+        def emit(self, record):
+            logged.append(record.getMessage())
+
+    logger = logging.getLogger('openid.test.instrumentedstore')
+    logger.propagate = False
+    logger.addHandler(Handler())
+    store = instrumentedstore.InstrumentedStore(
+        BrokenStore(), [metrics, instrumentedstore.LoggingSink(logger)])
+    try:
+        store.useNonce('http://www.myopenid.com/openid', 0, 'salt')
+    except IOError:
+        pass
+    else:
+        assert False, 'Error not raised'
+    assert metrics.snapshot()['useNonce']['errors'] == 1
+    assert len(logged) == 1 and 'useNonce failed' in logged[0], logged
+
+    text = metrics.prometheusText()
+    assert '# TYPE openid_store_call_seconds histogram\n' in text, text
+    assert ('openid_store_call_seconds_bucket{method="useNonce",le="+Inf"} %d'
+            % (use_nonce['calls'] + 1)) in text, text
+    assert 'openid_store_errors_total{method="useNonce"} 1\n' in text, text
+
+    # Without sinks, nothing is reported.
+    store.sinks = []
+    assert not store.getAssociation('http://www.myopenid.com/openid')
+    assert metrics.snapshot()['getAssociation'] == stats['getAssociation']
+
+    # The backend's optional methods are there too, and its batch
+    # methods are timed.
+    assert not hasattr(store, 'useNonces')
+    conn = sqlite3.connect(':memory:', check_same_thread=False)
+    backend = sqlstore.SQLiteStore(conn)
+    backend.createTables()
+    metrics = instrumentedstore.StoreMetrics()
+    store = instrumentedstore.InstrumentedStore(backend, [metrics])
+    bloom = bloomstore.BloomNonceStore(store)
+    server_url = 'http://www.myopenid.com/openid'
+    assert bloom.useNonce(server_url, *split(mkNonce()))
+    assert bloom.batched == 1
+    assert metrics.snapshot()['useNonces']['calls'] == 1
+
+    assoc = Association(generateHandle(16), generateSecret(20),
+                        int(time.time()), 600, 'HMAC-SHA1')
+    store.storeAssociation(server_url, assoc)
+    other = memstore.MemoryStore()
+    assert migrate.Migration(store, other).run() == (1, 1)
+    assert other.getAssociation(server_url) == assoc
+
+
+def test_migrate():
+    from openid.store import filestore, memstore, migrate, sqlstore
+    import contextlib
+    import io
+    import json
+    import runpy
+    import sqlite3
+    import tempfile
+    import shutil
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        source = filestore.FileOpenIDStore(os.path.join(temp_dir, 'store'))
+        now = int(time.time())
+        expected = []
+        for i in range(3):
+            server_url = 'http://server%d.example.com/openid' % (i,)
+            for j in range(4):
+                assoc = Association('handle%d' % (j,), b'x' * 20, now + j,
+                                    600, 'HMAC-SHA1')
+                source.storeAssociation(server_url, assoc)
+                expected.append((server_url, assoc))
+        expired = Association('expired', b'x' * 20, now - 1000, 600,
+                              'HMAC-SHA1')
+        source.storeAssociation(server_url, expired)
+        assert list(source.iterAssociations()) == expected
+        assert list(source.iterAssociations(expected[5][:1] + (
+            expected[5][1].handle,))) == expected[6:]
+
+        # Copy in batches, with the progress recorded in a state file.
+        conn = sqlite3.connect(':memory:', check_same_thread=False)
+        dest = sqlstore.SQLiteStore(conn)
+        dest.createTables()
+        state_file = os.path.join(temp_dir, 'state.json')
+        copied = []
+        migration = migrate.Migration(
+            source, dest, batch_size=5, state_file=state_file,
+            progress=lambda kind, count: copied.append((kind, count)))
+        assert migration.run() == (12, None)
+        assert copied == [('associations', 5), ('associations', 10),
+                          ('associations', 12)], copied
+        assert list(dest.iterAssociations(batch_size=5)) == expected
+        assert dest.getAssociation(server_url, 'expired') is None
+
+        # Run again, it has nothing more to do.
+        assert migrate.Migration(source, dest,
+                                 state_file=state_file).run() == (12, None)
+
+        # Resume part way through, in parallel by server URL, into a
+        # store that is safe to share between the workers.
+        with open(state_file, 'w') as f:
+            json.dump({'associations': [expected[5][0],
+                                        expected[5][1].handle]}, f)
+        other = memstore.ShardedMemoryStore()
+        assert migrate.Migration(dest, other, batch_size=3,
+                                 state_file=state_file,
+                                 workers=3).run() == (6, 0)
+        assert list(other.iterAssociations()) == expected[6:]
+
+        # Nonces come out of SQL stores.
+        stamp, salt = split(mkNonce())
+        assert dest.useNonce(server_url, stamp, salt)
+        assert list(dest.iterNonces()) == [(server_url, stamp, salt)]
+        assert migrate.Migration(dest, other).run() == (12, 1)
+        assert not other.useNonce(server_url, stamp, salt)
+
+        # While migrating, both stores are consulted.
+        store = migrate.MigratingStore(source, memstore.MemoryStore())
+        testStore(store)
+        assert store.getAssociation(server_url, 'handle0') == expected[8][1]
+        assert store.new.getAssociation(server_url, 'handle0') is None
+        stamp, salt = split(mkNonce())
+        assert source.useNonce(server_url, stamp, salt)
+        assert not store.useNonce(server_url, stamp, salt)
+        assert store.useNonce(server_url, stamp, salt + 'new')
+        assert not source.useNonce(server_url, stamp, salt + 'new')
+        assert store.removeAssociation(server_url, 'handle0')
+        assert source.getAssociation(server_url, 'handle0') is None
+
+        # The script can be run again into an SQL store that already
+        # has its tables.
+        script = runpy.run_path(os.path.join(
+            os.path.dirname(__file__), '..', '..', 'contrib',
+            'migrate-store'))
+        db_file = os.path.join(temp_dir, 'dest.db')
+        argv = ['file:' + os.path.join(temp_dir, 'store'),
+                'sqlite:' + db_file, '--state', state_file]
+        os.remove(state_file)
+        for _ in range(2):
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output), \
+                 contextlib.redirect_stderr(io.StringIO()):
+                script['main'](argv)
+            assert 'Copied 11 associations' in output.getvalue(), \
+                output.getvalue()
+        conn = sqlite3.connect(db_file)
+        try:
+            assert list(sqlstore.SQLiteStore(conn).iterAssociations()) == \
+                expected[:8] + expected[9:]
+        finally:
+            conn.close()
+    finally:
+        shutil.rmtree(temp_dir)
+
+
 def test_memstore():
     from openid.store import memstore
     testStore(memstore.MemoryStore())
 
+    now = int(time.time())
+
+    def genAssoc(handle, issued, lifetime=600):
+        return Association(handle, generateSecret(20), now + issued,
+                           lifetime, 'HMAC-SHA1')
+
+    assocs = memstore.ServerAssocs()
+    assert assocs.best() is None
+    older = genAssoc('older', -10)
+    newer = genAssoc('newer', 0)
+    assocs.set(older)
+    assocs.set(newer)
+    assert assocs.best() is newer
+
+    # A replaced or removed association is never picked again
+    replaced = genAssoc('newer', -20)
+    assocs.set(replaced)
+    assert assocs.best() is older
+    assert assocs.remove('older')
+    assert not assocs.remove('older')
+    assert assocs.best() is replaced
+
+    # Only stored, expired associations are expired
+    expired = genAssoc('expired', -7200, 3600)
+    removed = genAssoc('removed', -7200, 3600)
+    assocs.set(expired)
+    assocs.set(removed)
+    assert assocs.remove('removed')
+    assert assocs.expire() == [expired]
+    assert assocs.get('expired') is None
+    assert assocs.cleanup() == (0, 1)
+    assert assocs.best() is replaced
+
+    # Cleanup drops the expired nonces of a bucket that straddles the
+    # edge of the window and keeps the rest, and counts what it drops
+    from openid.store import nonce as nonceModule
+    store = memstore.MemoryStore()
+    server_url = 'http://www.myopenid.com/openid'
+    width = store.nonce_bucket_width
+    start = (now - 5000) // width * width
+    stamps = [start - 10 * width, start, start + 10, start + width - 10, now]
+    orig_skew = nonceModule.SKEW
+    try:
+        nonceModule.SKEW = 10000
+        for stamp in stamps:
+            assert store.useNonce(server_url, stamp, 'salt')
+
+        nonceModule.SKEW = now - (start + width // 2)
+        assert store.cleanupNonces() == 3
+        stats = store.getStats()
+        assert stats['nonces'] == 2, stats
+        assert stats['expired_nonces'] == 3, stats
+        assert len(store.nonces[start // width]) == 1
+        assert start // width - 10 not in store.nonces
+        assert not store.useNonce(server_url, start + width - 10, 'salt')
+        assert store.cleanupNonces() == 0
+        assert store.getStats()['nonces'] == 2
+    finally:
+        nonceModule.SKEW = orig_skew
+
+    # Entries for replaced associations do not pile up, even when
+    # lookups only look at one of the heaps
+    for i in range(1000):
+        replaced = genAssoc('newer', -100 - i)
+        assocs.set(replaced)
+        assert assocs.best() is replaced
+        bound = 2 * len(assocs.assocs) + 16
+        assert len(assocs._pending) <= bound
+        assert len(assocs._by_issued) <= bound, len(assocs._by_issued)
+        assert len(assocs._by_expiry) <= bound, len(assocs._by_expiry)
+
+
+def test_bounded_memstore():
+    from openid.store import memstore
+    testStore(memstore.MemoryStore(max_associations=10, max_nonces=10))
+
+    now = int(time.time())
+    server_url = 'http://www.myopenid.com/openid'
+    store = memstore.MemoryStore(max_associations=2, max_nonces=2)
+
+    def genAssoc(issued, lifetime=600):
+        return Association(generateHandle(16), generateSecret(20),
+                           now + issued, lifetime, 'HMAC-SHA1')
+
+    # Expired associations are dropped before live ones
+    expired = genAssoc(issued=-7200, lifetime=3600)
+    oldest = genAssoc(issued=0)
+    newest = genAssoc(issued=1)
+    store.storeAssociation(server_url, expired)
+    store.storeAssociation(server_url, oldest)
+    store.storeAssociation(server_url, newest)
+    assert store.getAssociation(server_url, expired.handle) is None
+    assert store.getAssociation(server_url, oldest.handle) == oldest
+
+    # and then the least recently used one
+    third = genAssoc(issued=2)
+    store.storeAssociation(server_url, third)
+    assert store.getAssociation(server_url, newest.handle) is None
+    assert store.getAssociation(server_url, oldest.handle) == oldest
+    assert store.getAssociation(server_url, third.handle) == third
+
+    # Current nonces are never dropped to make room
+    for stamp, salt in [split(mkNonce()) for _ in range(3)]:
+        store.useNonce(server_url, stamp, salt)
+    assert not store.useNonce(server_url, *split(mkNonce()))
+
+    stats = store.getStats()
+    assert stats['associations'] == 2, stats
+    assert stats['nonces'] == 2, stats
+    assert stats['expired_associations'] == 1, stats
+    assert stats['evicted_associations'] == 1, stats
+    assert stats['refused_nonces'] == 2, stats
+    assert stats['bytes'] > 0, stats
+
+    # A full store only cleans up once its oldest bucket has expired
+    from openid.store import nonce as nonceModule
+
+    class CountingStore(memstore.MemoryStore):
+        cleanups = 0
+
+        def cleanupNonces(self):
+            self.cleanups += 1
+            return memstore.MemoryStore.cleanupNonces(self)
+
+    store = CountingStore(max_nonces=2)
+    orig_skew = nonceModule.SKEW
+    try:
+        nonceModule.SKEW = 10000
+        assert store.useNonce(server_url, now - 5000, 'old')
+        assert store.useNonce(server_url, now, 'current')
+
+        for _ in range(10):
+            assert not store.useNonce(server_url, *split(mkNonce()))
+        assert store.cleanups == 0, store.cleanups
+        assert len(store.nonces) == 2, store.nonces
+
+        nonceModule.SKEW = 1000
+        assert store.useNonce(server_url, *split(mkNonce()))
+        assert store.cleanups == 1, store.cleanups
+        assert store.getStats()['expired_nonces'] == 1
+    finally:
+        nonceModule.SKEW = orig_skew
+
+    # and only looks for expired associations once one is due
+    class CountingAssocStore(memstore.MemoryStore):
+        cleanups = 0
+
+        def cleanupAssociations(self):
+            self.cleanups += 1
+            return memstore.MemoryStore.cleanupAssociations(self)
+
+    store = CountingAssocStore(max_associations=2)
+    for i in range(10):
+        store.storeAssociation(server_url, genAssoc(issued=i))
+    assert store.cleanups == 0, store.cleanups
+    assert store.getStats()['evicted_associations'] == 8
+
+    expired = genAssoc(issued=-7200, lifetime=3600)
+    store.storeAssociation(server_url, expired)
+    live = genAssoc(issued=10)
+    store.storeAssociation(server_url, live)
+    assert store.cleanups == 1, store.cleanups
+    assert store.getStats()['expired_associations'] == 1
+    store.storeAssociation(server_url, genAssoc(issued=11))
+    assert store.cleanups == 1, store.cleanups
+    assert store.getAssociation(server_url, live.handle) == live
+
+
+def test_sharded_memstore():
+    from openid.store import memstore
+    testStore(memstore.ShardedMemoryStore())
+    testStore(memstore.ShardedMemoryStore(shards=1))
+    testStore(memstore.ShardedMemoryStore(shards=1, max_associations=10,
+                                          max_nonces=10))
+
+
+def test_sharded_memstore_threads():
+    from openid.store import memstore
+    import threading
+
+    store = memstore.ShardedMemoryStore(shards=4)
+    server_url = 'http://www.myopenid.com/openid'
+    stamp, salt = split(mkNonce())
+    results = []
+
+    def worker():
+        results.append(store.useNonce(server_url, stamp, salt))
+
+    threads = [threading.Thread(target=worker) for _ in range(32)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Exactly one of the threads gets to use the nonce
+    assert results.count(True) == 1, results
+
 test_functions = [
     test_filestore,
+    test_filestore_durability,
+    test_filestore_cache,
+    test_filestore_upgrade,
+    test_mmapstore,
+    test_dbmstore,
     test_sqlite,
+    test_sqlite_pool,
+    test_asyncstore,
+    test_sqlite_concurrent,
+    test_sqlite_incremental_cleanup,
     test_mysql,
     test_postgresql,
     test_memstore,
+    test_cachingstore,
+    test_bloomstore,
+    test_instrumentedstore,
+    test_migrate,
+    test_bounded_memstore,
+    test_sharded_memstore,
+    test_sharded_memstore_threads,
     ]
 
 
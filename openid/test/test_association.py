@@ -1,11 +1,12 @@
 from openid.test import datadriven
 
+import pickle
 import unittest
 
 from openid.message import Message, BARE_NS, OPENID_NS, OPENID2_NS
 from openid import association
 import time
-from openid import cryptutil
+from openid import cryptutil, kvform
 import warnings
 
 
@@ -126,6 +127,29 @@ class TestMac(unittest.TestCase):
             sig = assoc.sign(self.pairs)
             self.assertEqual(sig, expected)
 
+    def test_cachedKey(self):
+        assoc = association.Association.fromExpiresIn(
+            3600, '{sha1}', 'very_secret', "HMAC-SHA1")
+        other = association.Association(
+            assoc.handle, assoc.secret, assoc.issued, assoc.lifetime,
+            assoc.assoc_type)
+        serialized = assoc.serialize()
+        sig = assoc.sign(self.pairs)
+
+        # Signing again gives the same signature, and the keyed state
+        # is not part of the association.
+        self.assertEqual(assoc.sign(self.pairs), sig)
+        self.assertEqual(assoc, other)
+        self.assertEqual(assoc.serialize(), serialized)
+        copied = pickle.loads(pickle.dumps(assoc))
+        self.assertEqual(copied, assoc)
+        self.assertEqual(copied.sign(self.pairs), sig)
+
+        # A changed secret is used.
+        assoc.secret = b'another_secret'
+        self.assertEqual(assoc.sign(self.pairs), cryptutil.hmacSha1(
+            b'another_secret', kvform.seqToKV(self.pairs)))
+
 
 class TestMessageSigning(unittest.TestCase):
     def setUp(self):
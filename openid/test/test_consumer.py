@@ -381,6 +381,42 @@ class TestIdResCheckSignature(TestIdRes):
             self.message, self.endpoint.server_url)
 
 
+class TestVerifySignatures(unittest.TestCase):
+    def setUp(self):
+        self.store = memstore.MemoryStore()
+        self.consumer = GenericConsumer(self.store)
+        self.server_url = 'http://server.example.com/'
+
+    def _signed(self, assoc, value):
+        message = Message.fromOpenIDArgs({'mode': 'id_res', 'foo': value})
+        return assoc.signMessage(message)
+
+    def test_verifySignatures(self):
+        assoc = association.Association.fromExpiresIn(
+            3600, '{good}', b'x' * 20, 'HMAC-SHA1')
+        expired = association.Association(
+            '{expired}', b'y' * 20, int(time.time()) - 7200, 3600,
+            'HMAC-SHA1')
+        self.store.storeAssociation(self.server_url, assoc)
+        self.store.storeAssociation(self.server_url, expired)
+
+        tampered = self._signed(assoc, 'b')
+        tampered.setArg(OPENID_NS, 'foo', 'changed')
+        responses = [
+            (self.server_url, self._signed(assoc, 'a')),
+            (self.server_url, tampered),
+            (self.server_url, self._signed(expired, 'c')),
+            ('http://other.example.com/', self._signed(assoc, 'd')),
+            (self.server_url, self._signed(assoc, 'e')),
+            ]
+        self.assertEqual(self.consumer.verifySignatures(responses),
+                         [True, False, False, False, True])
+
+        self.consumer.store = None
+        self.assertEqual(self.consumer.verifySignatures(responses),
+                         [False] * 5)
+
+
 class TestQueryFormat(TestIdRes):
     def test_notAList(self):
         # XXX: should be a Message object test, not a consumer test
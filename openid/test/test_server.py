@@ -7,6 +7,7 @@ from urllib.parse import urlparse, parse_qsl, parse_qs
 
 from openid.server import server
 from openid import association, cryptutil, oidutil
+from openid.dh import DiffieHellman
 from openid.message import Message, OPENID_NS, OPENID2_NS, OPENID1_NS, \
      IDENTIFIER_SELECT, no_default, OPENID1_URL_LIMIT
 from openid.store import memstore
@@ -421,6 +422,36 @@ class TestDecode(unittest.TestCase):
         self.assertEqual(r.session.dh.generator, ALT_GEN)
         self.assertTrue(r.session.consumer_pubkey)
 
+    def test_associateDHKeyPool(self):
+        class FakePool(object):
+            modulus = DiffieHellman.DEFAULT_MOD
+            generator = DiffieHellman.DEFAULT_GEN
+
+            def matches(self, modulus, generator):
+                return (modulus, generator) == (self.modulus, self.generator)
+
+            def get(self):
+                return (3, pow(self.generator, 3, self.modulus))
+
+        args = {
+            'openid.mode': 'associate',
+            'openid.session_type': 'DH-SHA1',
+            'openid.dh_consumer_public': "Rzup9265tw==",
+            }
+        server.DiffieHellmanSHA1ServerSession.key_pool = FakePool()
+        try:
+            r = self.decode(args)
+            self.assertEqual(r.session.dh.private, 3)
+
+            # Requests in another group do not use the pool.
+            args['openid.dh_modulus'] = cryptutil.longToBase64(ALT_MODULUS)
+            args['openid.dh_gen'] = cryptutil.longToBase64(ALT_GEN)
+            r = self.decode(args)
+            self.assertEqual(r.session.dh.modulus, ALT_MODULUS)
+            self.assertNotEqual(r.session.dh.private, 3)
+        finally:
+            server.DiffieHellmanSHA1ServerSession.key_pool = None
+
     def test_associateDHCorruptModGen(self):
         # test dh with non-default but valid values for dh_modulus and dh_gen
         args = {
@@ -1427,6 +1458,32 @@ class TestAssociate(unittest.TestCase):
         secret = consumer_dh.xorSecret(spub, enc_key, cryptutil.sha1)
         self.assertEqual(secret, self.assoc.secret)
 
+    def test_dhSHA1Executor(self):
+        import asyncio
+        import concurrent.futures
+        from openid.consumer.consumer import DiffieHellmanSHA1ConsumerSession
+        from openid.server.server import DiffieHellmanSHA1ServerSession
+        self.assoc = self.signatory.createAssociation(
+            dumb=False, assoc_type='HMAC-SHA1')
+        consumer_session = DiffieHellmanSHA1ConsumerSession()
+        server_session = DiffieHellmanSHA1ServerSession(
+            DiffieHellman.fromDefaults(), consumer_session.dh.public)
+        self.request = server.AssociateRequest(server_session, 'HMAC-SHA1')
+
+        with concurrent.futures.ThreadPoolExecutor(2) as executor:
+            server_session.executor = executor
+            consumer_session.executor = executor
+            response = self.request.answer(self.assoc)
+            async_response = asyncio.run(self.request.answerAsync(self.assoc))
+            self.assertEqual(response.fields.toPostArgs(),
+                             async_response.fields.toPostArgs())
+
+            secret = consumer_session.extractSecret(response.fields)
+            self.assertEqual(secret, self.assoc.secret)
+            secret = asyncio.run(
+                consumer_session.extractSecretAsync(response.fields))
+            self.assertEqual(secret, self.assoc.secret)
+
     if not cryptutil.SHA256_AVAILABLE:
         warnings.warn("Not running SHA256 tests.")
     else:
@@ -1959,6 +2016,40 @@ class TestSignatory(unittest.TestCase, CatchLogs):
         self.assertFalse(self.messages, self.messages)
         self.assertFalse(verified)
 
+    def test_verifyMany(self):
+        import concurrent.futures
+        assoc_handle = '{vroom}{zoom}'
+        assoc = association.Association.fromExpiresIn(
+            60, assoc_handle, 'sekrit', 'HMAC-SHA1')
+        self.store.storeAssociation(self._dumb_key, assoc)
+        other = self.signatory.createAssociation(dumb=True)
+
+        def signed(assoc, i):
+            message = Message.fromOpenIDArgs({'foo': str(i)})
+            return assoc.signMessage(message)
+
+        bad = signed(assoc, 2)
+        bad.setArg(OPENID_NS, 'foo', 'changed')
+        unsigned = Message.fromOpenIDArgs({'foo': 'bar'})
+        items = [
+            (assoc_handle, signed(assoc, 0)),
+            (other.handle, signed(other, 1)),
+            (assoc_handle, bad),
+            ('{unknown}', signed(other, 3)),
+            (assoc_handle, unsigned),
+            (assoc_handle, signed(assoc, 5)),
+            ]
+        expected = [True, True, False, False, False, True]
+        self.assertEqual(self.signatory.verifyMany(items), expected)
+        self.failUnlessLogMatches('failed to get assoc with handle')
+        self.assertEqual(
+            [self.signatory.verify(h, m) for h, m in items[:3]],
+            expected[:3])
+
+        with concurrent.futures.ThreadPoolExecutor(2) as executor:
+            self.assertEqual(self.signatory.verifyMany(
+                items, executor, chunk_size=1), expected)
+
     def test_verifyBadHandle(self):
         assoc_handle = '{vroom}{zoom}'
         signed = Message.fromPostArgs({
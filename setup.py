@@ -37,6 +37,7 @@ Includes example code and support for a variety of storage back-ends.''',
     maintainer_email='rami.chowdhury@gmail.com',
     download_url=('http://github.com/necaris/python3-openid/tarball'
                   '/v{}'.format(version)),
+    python_requires='>=3.7',
     install_requires=[
         'defusedxml',
     ],
@@ -48,6 +49,9 @@ Includes example code and support for a variety of storage back-ends.''',
         "Operating System :: POSIX",
         "Programming Language :: Python",
         "Programming Language :: Python :: 3",
+        "Programming Language :: Python :: 3.7",
+        "Programming Language :: Python :: 3.8",
+        "Programming Language :: Python :: 3.9",
         "Topic :: Internet :: WWW/HTTP",
         ("Topic :: Internet :: WWW/HTTP :: Dynamic Content :: "
          "CGI Tools/Libraries"),